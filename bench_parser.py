@@ -0,0 +1,56 @@
+"""
+Micro-benchmark for the request parser.
+
+Times scan_http_request on a few typical request heads and prints
+the cost of one parse in microseconds:
+
+    python bench_parser.py [--number N] [--repeat R]
+"""
+import argparse
+import timeit
+
+from proxy import scan_http_request
+
+
+SAMPLES = {
+    "minimal": b"GET / HTTP/1.0\r\nHost: www.google.com\r\n\r\n",
+    "absolute-url": b"GET http://www.google.com:8080/search?q=proxy HTTP/1.1\r\n"
+                    b"Accept: */*\r\n\r\n",
+    "browser": b"GET /static/app.js?v=3 HTTP/1.1\r\n"
+               b"Host: www.example.com\r\n"
+               b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n"
+               b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+               b"Accept-Language: en-US,en;q=0.5\r\n"
+               b"Accept-Encoding: gzip, deflate, br\r\n"
+               b"Referer: http://www.example.com/index.html\r\n"
+               b"Cookie: session=0123456789abcdef; theme=dark\r\n"
+               b"Connection: keep-alive\r\n"
+               b"If-Modified-Since: Mon, 01 Jan 2024 00:00:00 GMT\r\n\r\n",
+    "invalid": b"GOAT / HTTP/1.0\r\nHost: www.google.com\r\n\r\n",
+}
+
+
+def bench(data: bytes, number, repeat):
+    client_addr = ("127.0.0.1", 9877)
+    timer = timeit.Timer(lambda: scan_http_request(client_addr, data))
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000,
+                        help="parses per timing run")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing runs; the fastest one is reported")
+    args = parser.parse_args()
+
+    results = [(name, len(data), bench(data, args.number, args.repeat))
+               for (name, data) in SAMPLES.items()]
+    print("%-14s %8s %12s" % ("request", "bytes", "us/parse"))
+    for (name, size, cost) in results:
+        print("%-14s %8d %12.2f" % (name, size, cost))
+
+
+if __name__ == "__main__":
+    main()
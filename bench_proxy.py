@@ -0,0 +1,331 @@
+"""
+Load benchmark for the proxy.
+
+Starts a stub origin and a proxy in processes of their own, drives
+the proxy with concurrent keep-alive clients through a set of
+scenarios and prints the results as JSON:
+
+    python bench_proxy.py [--engine threads|asyncio|both] [--concurrency C]
+                          [--requests N] [--scenario NAME ...] [--output FILE]
+
+Each scenario gets a fresh proxy. Reported per scenario: throughput,
+latency percentiles, the cache hit ratio (read from the proxy's
+/metrics endpoint) and the proxy's resident memory.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from proxy import ProxyConfig, entry_point
+
+
+class Scenario(object):
+    """
+    keys: number of distinct URLs requested, or None for a new URL
+    every time. warm: fetch every URL once before timing. requests
+    scales the --requests count.
+    """
+
+    def __init__(self, name, size, delay=0.0, cacheable=True, keys=None,
+                 warm=False, requests=1.0):
+        self.name = name
+        self.size = size
+        self.delay = delay
+        self.cacheable = cacheable
+        self.keys = keys
+        self.warm = warm
+        self.requests = requests
+
+
+SCENARIOS = [
+    Scenario("cold-cache", 1024, keys=None),
+    Scenario("hot-cache", 1024, keys=16, warm=True),
+    Scenario("large-objects", 1024 * 1024, keys=8, warm=True, requests=0.1),
+    Scenario("slow-origin", 1024, delay=0.05, cacheable=False, keys=64, requests=0.25),
+    Scenario("many-small", 128, keys=5000),
+]
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET /<key>?size=&delay=&cache= with size bytes after
+    delay seconds, cacheable for an hour if cache=1.
+    """
+    protocol_version = "HTTP/1.1"
+    # head and body are separate writes; Nagle would hold the body
+    # back until the client's delayed ACK of the head
+    disable_nagle_algorithm = True
+    bodies = {}
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        size = int(query.get("size", ["0"])[0])
+        delay = float(query.get("delay", ["0"])[0])
+        if delay:
+            time.sleep(delay)
+        body = OriginHandler.bodies.get(size)
+        if body is None:
+            body = OriginHandler.bodies.setdefault(size, b"x" * size)
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        if query.get("cache", ["0"])[0] == "1":
+            self.send_header("Cache-Control", "max-age=3600")
+        else:
+            self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def run_origin(port):
+    OriginServer(("127.0.0.1", port), OriginHandler).serve_forever()
+
+
+def run_proxy(port, engine, admin_port, workers):
+    entry_point(port, ProxyConfig(workers=workers, queue_depth=max(128, workers),
+                                  log_level="WARNING", admin_port=admin_port), engine)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("nothing listening on port %s" % port)
+
+
+def memory_kb(pid):
+    """
+    (resident, peak resident) memory of pid in KB from /proc, or
+    (None, None) where there is no /proc.
+    """
+    values = {}
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                (name, _, rest) = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    values[name] = int(rest.split()[0])
+    except OSError:
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+def scrape_requests(admin_port):
+    """
+    Requests answered so far by cache result, from /metrics.
+    """
+    with socket.create_connection(("127.0.0.1", admin_port), timeout=5) as conn:
+        conn.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        data = b""
+        while True:
+            packet = conn.recv(65536)
+            if not packet:
+                break
+            data += packet
+    counts = {}
+    for line in data.decode().splitlines():
+        if line.startswith("proxy_requests_total{"):
+            (labels, value) = line[len("proxy_requests_total{"):].split("} ")
+            cache = labels.split('cache="')[1].rstrip('"')
+            counts[cache] = counts.get(cache, 0) + float(value)
+    return counts
+
+
+def request_bytes(origin_port, scenario: Scenario, key):
+    target = "http://127.0.0.1:%d/%s?size=%d&delay=%s&cache=%d" % (
+        origin_port, key, scenario.size, scenario.delay, scenario.cacheable)
+    return ("GET %s HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n" % (
+        target, origin_port)).encode("ascii")
+
+
+async def fetch(streams, proxy_port, packet):
+    """
+    Sends packet on the connection in streams[0], opening one if
+    needed, and reads the whole response. Returns (status, body size).
+    """
+    if streams[0] is None:
+        streams[0] = await asyncio.open_connection("127.0.0.1", proxy_port)
+    (reader, writer) = streams[0]
+    writer.write(packet)
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("iso-8859-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    length = 0
+    close = False
+    for line in lines[1:]:
+        (name, _, value) = line.partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+        elif name.lower() == "connection" and "close" in value.lower():
+            close = True
+    await reader.readexactly(length)
+    if close:
+        writer.close()
+        streams[0] = None
+    return status, length
+
+
+async def drive(proxy_port, origin_port, scenario: Scenario, keys, concurrency):
+    """
+    Requests every key in keys, concurrency at a time, each client
+    on its own keep-alive connection. Returns (latencies, errors,
+    bytes, seconds).
+    """
+    latencies = []
+    errors = [0]
+    received = [0]
+    pending = iter(keys)
+
+    async def client():
+        streams = [None]
+        for key in pending:
+            packet = request_bytes(origin_port, scenario, key)
+            started = time.perf_counter()
+            try:
+                (status, length) = await fetch(streams, proxy_port, packet)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors[0] += 1
+                if streams[0] is not None:
+                    streams[0][1].close()
+                streams[0] = None
+                continue
+            latencies.append(time.perf_counter() - started)
+            received[0] += length
+            if status != 200:
+                errors[0] += 1
+        if streams[0] is not None:
+            streams[0][1].close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(concurrency)])
+    return latencies, errors[0], received[0], time.perf_counter() - started
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(scenario: Scenario, engine, origin_port, requests, concurrency, workers):
+    proxy_port = free_port()
+    admin_port = free_port()
+    proxy = multiprocessing.Process(target=run_proxy,
+                                    args=(proxy_port, engine, admin_port, workers))
+    proxy.start()
+    try:
+        wait_for_port(proxy_port)
+        wait_for_port(admin_port)
+        count = max(1, int(requests * scenario.requests))
+        prefix = "%s-%s-%d" % (scenario.name, engine, os.getpid())
+        if scenario.keys is None:
+            keys = ["%s/%d" % (prefix, i) for i in range(count)]
+        else:
+            names = ["%s/%d" % (prefix, i) for i in range(scenario.keys)]
+            if scenario.warm:
+                asyncio.run(drive(proxy_port, origin_port, scenario, names, 1))
+            keys = [random.choice(names) for i in range(count)]
+
+        before = scrape_requests(admin_port)
+        (latencies, errors, received, seconds) = asyncio.run(
+            drive(proxy_port, origin_port, scenario, keys, concurrency))
+        after = scrape_requests(admin_port)
+        (rss, peak_rss) = memory_kb(proxy.pid)
+    finally:
+        os.kill(proxy.pid, signal.SIGTERM)
+        proxy.join(30)
+        if proxy.is_alive():
+            proxy.kill()
+
+    counted = dict((cache, after.get(cache, 0) - before.get(cache, 0)) for cache in after)
+    total = sum(counted.values())
+    hits = counted.get("HIT", 0) + counted.get("COALESCED", 0)
+    latencies.sort()
+    return {
+        "scenario": scenario.name,
+        "engine": engine,
+        "requests": len(keys),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(len(latencies) / seconds, 1) if seconds else None,
+        "throughput_mbps": round(received * 8 / seconds / 1e6, 2) if seconds else None,
+        "latency_ms": dict((name, None if value is None else round(value * 1000, 3))
+                           for (name, value) in (("p50", percentile(latencies, 0.5)),
+                                                 ("p99", percentile(latencies, 0.99)),
+                                                 ("p999", percentile(latencies, 0.999)),
+                                                 ("max", latencies[-1] if latencies else None))),
+        "cache_hit_ratio": round(hits / total, 4) if total else None,
+        "proxy_rss_kb": rss,
+        "proxy_peak_rss_kb": peak_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", choices=("threads", "asyncio", "both"), default="threads")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="clients sending requests at once")
+    parser.add_argument("--requests", type=int, default=5000,
+                        help="requests per scenario, before its own scaling")
+    parser.add_argument("--workers", type=int, default=64,
+                        help="worker threads of the threaded engine")
+    parser.add_argument("--scenario", action="append",
+                        choices=[scenario.name for scenario in SCENARIOS],
+                        help="run only these scenarios (repeatable)")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    engines = ("threads", "asyncio") if args.engine == "both" else (args.engine,)
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not args.scenario or scenario.name in args.scenario]
+
+    origin_port = free_port()
+    origin = multiprocessing.Process(target=run_origin, args=(origin_port,), daemon=True)
+    origin.start()
+    try:
+        wait_for_port(origin_port)
+        results = [run_scenario(scenario, engine, origin_port, args.requests,
+                                args.concurrency, args.workers)
+                   for engine in engines for scenario in scenarios]
+    finally:
+        origin.terminate()
+        origin.join()
+
+    report = {"python": sys.version.split()[0], "concurrency": args.concurrency,
+              "results": results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
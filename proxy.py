@@ -2,9 +2,35 @@
 import sys
 import os
 import enum
+import errno
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import copy
+import email.utils
+import hashlib
+import http.server
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import select
+import shutil
+import selectors
+import signal
+import struct
+import tempfile
 import threading
+import time
 import socket
-from urllib.parse import urlparse
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 class HttpRequestInfo(object):
@@ -31,13 +57,32 @@ class HttpRequestInfo(object):
     requested_path: path of the requested resource, without
     including the website name.
 
+    http_version: version from the request line.
+
+    keep_alive: whether the client connection stays open after the
+    response; decided when the request is served.
+
+    status, response_bytes, cache_result and upstream_time describe
+    how the request was answered, for the access log. cache_result is
+    one of HIT, MISS, COALESCED, REVALIDATED, PEER (fetched through
+    the peer owning the URL) or BYPASS.
+
+    deadline: time.monotonic() by which the request must be answered,
+    or None.
+
     NOTE: you need to implement to_http_string() for this class.
     """
 
+    __slots__ = ("method", "client_address_info", "requested_host",
+                 "requested_port", "requested_path", "headers",
+                 "http_version", "keep_alive", "status", "response_bytes",
+                 "cache_result", "upstream_time", "deadline")
+
     def __init__(self, client_info, method: str, requested_host: str,
                  requested_port: int,
                  requested_path: str,
-                 headers: list):
+                 headers: list,
+                 http_version="HTTP/1.0"):
         self.method = method
         self.client_address_info = client_info
         self.requested_host = requested_host
@@ -50,31 +95,34 @@ class HttpRequestInfo(object):
         # convert it to ["Host", "www.google.com"] note that the
         # port is removed (because it goes into the request_port variable)
         self.headers = headers
+        self.http_version = http_version
+        self.keep_alive = False
+        self.status = None
+        self.response_bytes = 0
+        self.cache_result = "-"
+        self.upstream_time = None
+        self.deadline = None
 
-    def to_http_string(self):
-
-        print("*" * 50)
+    def to_http_string(self, http_version="HTTP/1.0"):
         output_string = ""
-        output_string = self.method +" "+ self.requested_path + " HTTP/1.0\r\n"
+        output_string = self.method +" "+ self.requested_path + " " + http_version + "\r\n"
 
         for ls in self.headers:
             output_string = output_string + ls[0]+ ": " + ls[1] +"\r\n"
 
         output_string = output_string + "\r\n"
-        print("*" * 50)
         return output_string
 
     def to_byte_array(self, http_string):
         return bytes(http_string, "UTF-8")
 
     def display(self):
-        print(f"Client:", self.client_address_info)
-        print(f"Method:", self.method)
-        print(f"Host:", self.requested_host)
-        print(f"Port:", self.requested_port)
-        print(f"Path:", self.requested_path)
+        if not log.isEnabledFor(logging.DEBUG):
+            return
         stringified = [": ".join([k, v]) for (k, v) in self.headers]
-        print("Headers:\n", "\n".join(stringified))
+        log.debug("Client: %s Method: %s Host: %s Port: %s Path: %s\nHeaders:\n%s",
+                  self.client_address_info, self.method, self.requested_host,
+                  self.requested_port, self.requested_path, "\n".join(stringified))
 
 
 class HttpErrorResponse(object):
@@ -87,7 +135,9 @@ class HttpErrorResponse(object):
         self.message = message
 
     def to_http_string(self):
-        output_string = str(self.code) +" " + self.message +"\r\n"
+        code = self.code.value if isinstance(self.code, HttpErrorCodes) else self.code
+        output_string = "HTTP/1.0 " + str(code) + " " + self.message + "\r\n"
+        output_string = output_string + "Content-Length: 0\r\nConnection: close\r\n\r\n"
         return output_string
 
     def to_byte_array(self, http_string):
@@ -112,228 +162,5525 @@ class HttpErrorCodes(enum.Enum):
     #enum to hold error codes for HTTP/1.0
 
     BAD_REQUEST = 400
+    FORBIDDEN = 403
+    REQUEST_TIMEOUT = 408
+    TOO_MANY_REQUESTS = 429
+    HEADER_FIELDS_TOO_LARGE = 431
     NOT_IMPLEMENTED = 501
+    BAD_GATEWAY = 502
+    SERVICE_UNAVAILABLE = 503
+    GATEWAY_TIMEOUT = 504
 
 
-def entry_point(proxy_port_number):
-    socket_client = setup_sockets(proxy_port_number)
-    cache = dict()
+# Media types compressed by default.
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript",
+                      "application/xml", "application/xhtml+xml", "image/svg+xml",
+                      "+json", "+xml")
 
-    threads = []
-    for i in range(30):
-        t = threading.Thread(target=get_request, args=(socket_client, cache,))
-        t.start()
-        threads.append(t)
-    for i in threads:
-        i.join()
-    socket_client.close()
-    print("*" * 50)
-    return None
 
+class ProxyConfig(object):
+    """
+    Tunables for the serving loop.
 
-def setup_sockets(proxy_port_number):
-    socket_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    proxy_address = ("127.0.0.1", proxy_port_number)
-    socket_client.bind(proxy_address)
-    socket_client.listen(30)
-    print("Starting HTTP proxy on port:", proxy_port_number)
-    print("*" * 50)
-    return socket_client
+    workers: number of threads serving accepted connections.
 
+    queue_depth: how many accepted connections may wait for a
+    free worker.
 
-def get_request(socket_client: socket, cache: dict):
-    (conn, address) = socket_client.accept()
+    reject_when_full: when the queue is full, answer new clients
+    with 503 right away; if False, stop accepting until a worker
+    frees up (the kernel backlog then absorbs the burst).
 
-    msg = ''
-    while True:
-        packet = conn.recv(500)
-        msg = msg + packet.decode('utf-8')
-        if (msg == ''):
-            continue
-        if msg.endswith('\r\n\r\n'):
-            break
+    drain_timeout: seconds to let queued and in-flight connections
+    finish once shutdown is requested.
+
+    processes: number of forked worker processes. Each one runs
+    its own engine and keeps its own cache; with more than one, a
+    supervisor process restarts any worker that dies.
+
+    cache_bytes: memory budget of the response cache (per process).
+
+    cache_object_limit: largest single response the cache keeps.
+
+    disk_cache_dir: directory of the on-disk second cache level, or
+    None to cache in memory only. The files survive restarts and may
+    be shared by several proxy processes.
+
+    disk_cache_bytes: size budget of the disk cache.
+
+    disk_object_limit: largest single response the disk cache keeps;
+    ones above cache_object_limit stay on disk only.
+
+    coalesce_timeout: how long a client waits for another client's
+    in-progress fetch of the same object before fetching it itself.
+
+    upstream_keepalive: talk HTTP/1.1 to origins and keep idle
+    connections around for reuse.
+
+    upstream_max_idle: idle connections kept per origin.
+
+    upstream_idle_timeout: seconds an idle origin connection is kept.
+
+    client_idle_timeout: seconds a keep-alive client connection may
+    sit between requests before it is closed; also the longest a
+    client may stall while sending a request body or reading the
+    response.
+
+    max_header_bytes: largest request head accepted from a client;
+    bigger ones are answered with 431.
+
+    header_timeout: seconds a client has to finish sending a request
+    head once its first byte arrived; answered with 408.
+
+    tunnel_idle_timeout: seconds a CONNECT tunnel may carry no data
+    in either direction before it is closed.
+
+    connect_ports: ports CONNECT may open tunnels to (403 for
+    others); None allows any port.
+
+    dns_ttl: seconds a resolved name is reused when the lookup does
+    not give a TTL of its own.
+
+    dns_negative_ttl: seconds a failed lookup is remembered.
+
+    happy_eyeballs_delay: seconds to wait for a connection attempt
+    before racing the next address of the origin.
+
+    connect_timeout: seconds to resolve and connect to an origin;
+    answered with 504.
+
+    first_byte_timeout: seconds an origin has to start its response
+    once the request is sent (504), and the longest it may pause
+    while its response is relayed.
+
+    request_timeout: seconds within which a request must be answered,
+    counted from the end of its head; None for no limit. Waits on the
+    client end in 408 and waits on the origin in 504.
+
+    log_level: level of the proxy's own log messages, written to
+    stderr.
+
+    access_log: file that gets one JSON line per request served, "-"
+    for stderr, or None for no access log.
+
+    admin_port: local port serving /metrics in the Prometheus text
+    format, or None. With several processes, worker i listens on
+    admin_port + i.
+
+    compression: compress responses for clients that accept gzip,
+    deflate or, when the brotli module is installed, br. Relayed
+    responses are compressed as they stream; cached ones get a
+    compressed copy stored next to them on first use.
+
+    compress_types: media types that are compressed. An entry ending
+    in "/" matches a whole type and one starting with "+" a suffix.
+
+    compress_min_bytes: smallest body worth compressing, when its
+    length is known up front.
+
+    compress_level: compression level, 1 (fastest) to 9.
+
+    warm_file: JSONL request log (see parse_request_record) whose GET
+    and HEAD objects are fetched into the cache before the listening
+    socket is opened, or None.
+
+    warm_parallelism: fetches made at once while warming the cache.
+
+    peers: "host:port" of the proxies sharing their caches, this one
+    included; empty for no peering. Each URL is owned by one of them
+    (consistent hashing over peer_vnodes points per node); a miss on
+    a URL another node owns is fetched through that node instead of
+    the origin, and not cached here.
+
+    peers_file: file listing the peers, one "host:port" per line; it
+    is read again whenever it changes, on top of peers.
+
+    peer_self: this proxy's own entry in the peer list; defaults to
+    127.0.0.1 and the proxy's port.
+
+    peer_check_interval: seconds between health checks of the peers.
+    A peer that can't be reached, or fails a fetch, is left out of
+    the ring until a check finds it back.
+
+    peer_timeout: seconds a health check waits for a peer.
+
+    client_rate: requests a second one client address may make, with
+    bursts of up to client_burst; None for no limit. A request over
+    the rate waits up to admission_wait for its turn, then gets 429.
+
+    origin_concurrency: fetches one origin (host and port) may have in
+    progress at once; None for no limit. A fetch over the cap waits up
+    to admission_wait for a slot, then gets 503. Cache hits are never
+    held back.
+
+    range_fills: whole objects fetched into the cache at once, in the
+    background, for range requests that missed; 0 turns this off. A
+    missed range is forwarded to the origin as it is; when the 206
+    shows an object the cache can store, the whole of it is fetched
+    so that later ranges are served from the cache.
+    """
+
+    def __init__(self, workers=30, queue_depth=128, reject_when_full=True,
+                 drain_timeout=30.0, processes=1,
+                 cache_bytes=256 * 1024 * 1024,
+                 cache_object_limit=10 * 1024 * 1024,
+                 disk_cache_dir=None, disk_cache_bytes=1024 * 1024 * 1024,
+                 disk_object_limit=256 * 1024 * 1024,
+                 coalesce_timeout=30.0, upstream_keepalive=True,
+                 upstream_max_idle=8, upstream_idle_timeout=30.0,
+                 client_idle_timeout=15.0, max_header_bytes=64 * 1024,
+                 header_timeout=10.0, tunnel_idle_timeout=300.0,
+                 connect_ports=(443,), dns_ttl=60.0, dns_negative_ttl=5.0,
+                 happy_eyeballs_delay=0.25, connect_timeout=10.0,
+                 first_byte_timeout=30.0, request_timeout=300.0,
+                 log_level="INFO", access_log=None, admin_port=None,
+                 compression=False, compress_types=COMPRESSIBLE_TYPES,
+                 compress_min_bytes=1024, compress_level=6, warm_file=None,
+                 warm_parallelism=8, peers=(), peers_file=None, peer_self=None,
+                 peer_vnodes=100, peer_check_interval=5.0, peer_timeout=1.0,
+                 client_rate=None, client_burst=20, origin_concurrency=None,
+                 admission_wait=0.5, range_fills=0):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.reject_when_full = reject_when_full
+        self.drain_timeout = drain_timeout
+        self.processes = processes
+        self.cache_bytes = cache_bytes
+        self.cache_object_limit = cache_object_limit
+        self.disk_cache_dir = disk_cache_dir
+        self.disk_cache_bytes = disk_cache_bytes
+        self.disk_object_limit = disk_object_limit
+        self.coalesce_timeout = coalesce_timeout
+        self.upstream_keepalive = upstream_keepalive
+        self.upstream_max_idle = upstream_max_idle
+        self.upstream_idle_timeout = upstream_idle_timeout
+        self.client_idle_timeout = client_idle_timeout
+        self.max_header_bytes = max_header_bytes
+        self.header_timeout = header_timeout
+        self.tunnel_idle_timeout = tunnel_idle_timeout
+        self.connect_ports = connect_ports
+        self.dns_ttl = dns_ttl
+        self.dns_negative_ttl = dns_negative_ttl
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.request_timeout = request_timeout
+        self.log_level = log_level
+        self.access_log = access_log
+        self.admin_port = admin_port
+        self.compression = compression
+        self.compress_types = compress_types
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+        self.warm_file = warm_file
+        self.warm_parallelism = warm_parallelism
+        self.peers = peers
+        self.peers_file = peers_file
+        self.peer_self = peer_self
+        self.peer_vnodes = peer_vnodes
+        self.peer_check_interval = peer_check_interval
+        self.peer_timeout = peer_timeout
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.origin_concurrency = origin_concurrency
+        self.admission_wait = admission_wait
+        self.range_fills = range_fills
+
+
+class CacheStripe(object):
+    """
+    One lock-protected slice of a ResponseCache, in LRU order
+    (least recently used first).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+
+class ResponseCache(object):
+    """
+    Bounded, thread-safe response cache.
+
+    Keys are spread over a fixed number of stripes, each with its own
+    lock, LRU order and equal share of the byte budget, so workers
+    looking up different keys rarely wait for each other. Values
+    bigger than max_entry_bytes are never stored.
+    """
+
+    STRIPES = 16
+
+    def __init__(self, max_bytes=256 * 1024 * 1024,
+                 max_entry_bytes=10 * 1024 * 1024, stripes=STRIPES):
+        self.stripe_bytes = max(1, max_bytes // stripes)
+        self.max_entry_bytes = min(max_entry_bytes, self.stripe_bytes)
+        self.stripes = [CacheStripe() for i in range(stripes)]
+
+    def stripe_for(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def get(self, key):
+        stripe = self.stripe_for(key)
+        with stripe.lock:
+            item = stripe.entries.get(key)
+            if item is None:
+                stripe.misses += 1
+                return None
+            stripe.entries.move_to_end(key)
+            stripe.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        stripe = self.stripe_for(key)
+        with stripe.lock:
+            if size > self.max_entry_bytes:
+                stripe.rejected += 1
+                return False
+            old = stripe.entries.pop(key, None)
+            if old is not None:
+                stripe.size -= old[1]
+            while stripe.entries and stripe.size + size > self.stripe_bytes:
+                (evicted_key, (evicted, evicted_size)) = stripe.entries.popitem(last=False)
+                stripe.size -= evicted_size
+                stripe.evictions += 1
+            stripe.entries[key] = (value, size)
+            stripe.size += size
+            return True
+
+    def remove(self, key):
+        stripe = self.stripe_for(key)
+        with stripe.lock:
+            item = stripe.entries.pop(key, None)
+            if item is not None:
+                stripe.size -= item[1]
+
+    def __len__(self):
+        return sum(len(stripe.entries) for stripe in self.stripes)
+
+    def stats(self):
+        totals = {"entries": 0, "bytes": 0, "hits": 0, "misses": 0,
+                  "evictions": 0, "rejected": 0}
+        for stripe in self.stripes:
+            with stripe.lock:
+                totals["entries"] += len(stripe.entries)
+                totals["bytes"] += stripe.size
+                totals["hits"] += stripe.hits
+                totals["misses"] += stripe.misses
+                totals["evictions"] += stripe.evictions
+                totals["rejected"] += stripe.rejected
+        return totals
+
+
+def process_exists(pid):
+    if os.name != "posix":
+        return False    # os.kill would end it; one process per directory there
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:     # it exists, as another user's
+        pass
+    return True
+
+
+class DiskCache(object):
+    """
+    Second cache level: one file per stored value under directory,
+    named by a hash of its key. A file holds a magic number, the
+    length of a JSON metadata block, the block (key, status, headers,
+    times) and then the body, so a body can be sent straight from the
+    file.
+
+    Files are written to a temporary name and renamed into place, so
+    a crash never leaves a half-written file under a real name. At
+    startup the directory is scanned to rebuild the index of sizes;
+    damaged files are removed, and so are temporary files whose writer
+    is gone. A temporary name starts with the writer's pid, since
+    other processes sharing the directory may still be writing theirs.
+    Values over
+    max_entry_bytes are not stored, and the least recently used files
+    are deleted to stay within max_bytes.
+
+    Lookups open the file itself rather than trusting the index, so
+    processes sharing the directory see each other's writes.
+    """
+
+    MAGIC = b"PXC1"
+
+    # A temporary file not written to for this long is abandoned, even
+    # if a process with its writer's pid runs (pids are reused).
+    TEMP_FILE_GRACE = 3600
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024,
+                 max_entry_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.lock = threading.Lock()
+        self.files = collections.OrderedDict()     # file name -> size, LRU first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def path_for(self, key):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return name, os.path.join(self.directory, name[:2], name)
+
+    def recover(self):
+        found = []
+        now = time.time()
+        for subdir in os.listdir(self.directory):
+            subdir_path = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                path = os.path.join(subdir_path, name)
+                try:
+                    if name.endswith(".tmp"):
+                        if DiskCache.temp_file_abandoned(name, os.stat(path).st_mtime, now):
+                            os.unlink(path)
+                        continue
+                    with open(path, "rb") as f:
+                        magic = f.read(len(DiskCache.MAGIC))
+                        stat = os.fstat(f.fileno())
+                    if magic != DiskCache.MAGIC:
+                        os.unlink(path)
+                        continue
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        with self.lock:
+            for (_, name, size) in sorted(found):
+                self.files[name] = size
+                self.size += size
+            self.trim(0)
+
+    @staticmethod
+    def temp_file_abandoned(name, mtime, now):
+        """
+        Whether the temporary file name is a write cut short by a crash
+        rather than one a sibling process is still making.
+        """
+        if now - mtime > DiskCache.TEMP_FILE_GRACE:
+            return True
+        pid = name.partition(".")[0]
+        if not pid.isdigit():
+            return False    # no writer named, only its age tells
+        return not process_exists(int(pid))
+
+    def trim(self, incoming):
+        """
+        Deletes least recently used files until incoming bytes fit;
+        called with the lock held.
+        """
+        while self.files and self.size + incoming > self.max_bytes:
+            (name, size) = self.files.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.unlink(os.path.join(self.directory, name[:2], name))
+            except OSError:
+                pass
 
-    response = http_request_pipeline(address, msg)
-
-    if isinstance(response, HttpErrorResponse):
-        print(response.message)
-        packet = response.to_byte_array(response.to_http_string())
-        conn.send(packet)
-    else:  # good
-        url = response.requested_host + response.requested_path
-        if url in cache:
-            packet = cache[url]
-            conn.send(packet)
-            print("Cached")
+    def store(self, key, value):
+        """
+        Writes value (a CacheEntry or a VaryIndex) under key. Returns
+        the body_file of the written entry, (path, file id, length),
+        or None if nothing was written.
+        """
+        if isinstance(value, VaryIndex):
+            meta = {"vary": value.names}
         else:
-            response.display()
-            packet = response.to_byte_array(response.to_http_string())
-            socket_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_address = (response.requested_host, response.requested_port)
-            socket_server.connect(server_address)
-            socket_server.send(packet)
-            response_packet, a = socket_server.recvfrom(10000000)
-            socket_server.close()
-            cache[url] = response_packet
-            conn.send(response_packet)
-    pass
+            if value.in_place and value.body_file[0] == self.path_for(key)[1]:
+                return value.body_file
+            if value.body_length > self.max_entry_bytes:
+                return None
+            meta = entry_metadata(value.status_line, value.status, value.headers,
+                                  value.request_time, value.response_time, value.head_only)
+        writer = self.writer(key, meta)
+        if writer is None:
+            return None
+        try:
+            if isinstance(value, CacheEntry):
+                value.write_body(writer)
+        except (OSError, ValueError) as e:
+            log.warning("Disk cache write failed: %s", e)
+            writer.abort()
+            return None
+        return writer.commit()
 
+    def writer(self, key, meta):
+        """
+        A DiskWriter for a file holding meta under key, with the body
+        still to be written; None if the file can't be created.
+        """
+        meta = dict(meta, key=key, id=os.urandom(8).hex())
+        # body_length goes last, in a slot commit() fills in
+        text = json.dumps(meta)
+        block = (text[:-1] + ', "body_length": ' + " " * DiskWriter.LENGTH_DIGITS +
+                 "}").encode("utf-8")
+        prefix = DiskCache.MAGIC + struct.pack(">I", len(block)) + block
 
-def http_request_pipeline(source_addr, http_raw_data):
-    # Parse HTTP request
-    print("*" * 50)
+        (name, path) = self.path_for(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            (fd, temp_path) = tempfile.mkstemp(suffix=".tmp", prefix="%d." % os.getpid(),
+                                               dir=os.path.dirname(path))
+        except OSError as e:
+            log.warning("Disk cache write failed: %s", e)
+            return None
+        f = os.fdopen(fd, "wb")
+        writer = DiskWriter(self, name, path, temp_path, f, meta["id"],
+                            len(prefix) - 1 - DiskWriter.LENGTH_DIGITS)
+        try:
+            f.write(prefix)
+        except OSError as e:
+            log.warning("Disk cache write failed: %s", e)
+            writer.abort()
+            return None
+        writer.size = len(prefix)
+        return writer
 
-    validity = check_http_request_validity(http_raw_data)
+    def added(self, name, size):
+        """
+        Indexes a file that was just renamed into place.
+        """
+        with self.lock:
+            old = self.files.pop(name, None)
+            if old is not None:
+                self.size -= old
+            self.trim(size)
+            self.files[name] = size
+            self.size += size
+            self.writes += 1
 
-    if validity == HttpRequestState.GOOD:
-        request_info = parse_http_request(source_addr, http_raw_data)
-        sanitize_http_request(request_info)
-        return request_info
+    def load(self, key):
+        """
+        Returns the VaryIndex, or the CacheEntry with its body left on
+        disk, stored under key; None if there is none.
+        """
+        (name, path) = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                meta = read_disk_metadata(f)
+                size = os.fstat(f.fileno()).st_size
+        except (OSError, ValueError):
+            meta = None
+        if meta is None or meta.get("key") != key:
+            with self.lock:
+                self.misses += 1
+                if meta is None:
+                    self.forget(name)
+            return None
+        with self.lock:
+            self.hits += 1
+            if name in self.files:
+                self.files.move_to_end(name)
+            else:   # written by another process
+                self.files[name] = size
+                self.size += size
+        if "vary" in meta:
+            return VaryIndex(meta["vary"])
+        headers = [(name, value) for (name, value) in meta["headers"]]
+        entry = CacheEntry(meta["status_line"], meta["status"], headers, None,
+                           meta["request_time"], meta["response_time"], meta["head_only"],
+                           (path, meta["id"], meta["body_length"]))
+        entry.in_place = True
+        return entry
 
-    elif validity == HttpRequestState.NOT_SUPPORTED:
-        error_response = HttpErrorResponse(HttpErrorCodes.NOT_IMPLEMENTED, "Not Implemented")
-        return error_response
+    def forget(self, name):
+        """
+        Drops name from the index; called with the lock held.
+        """
+        size = self.files.pop(name, None)
+        if size is not None:
+            self.size -= size
 
-    elif validity == HttpRequestState.INVALID_INPUT:
-        error_response = HttpErrorResponse(HttpErrorCodes.BAD_REQUEST, "Bad Request")
-        return error_response
+    def remove(self, key):
+        (name, path) = self.path_for(key)
+        with self.lock:
+            self.forget(name)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
 
-    print("*" * 50)
-    return None
+    def stats(self):
+        with self.lock:
+            return {"files": len(self.files), "bytes": self.size, "hits": self.hits,
+                    "misses": self.misses, "writes": self.writes,
+                    "evictions": self.evictions}
 
 
-def parse_relative_url(host_path):
+def entry_metadata(status_line, status, headers: list, request_time, response_time,
+                   head_only=False):
+    return {"status_line": status_line, "status": status, "headers": headers,
+            "request_time": request_time, "response_time": response_time,
+            "head_only": head_only}
 
-    words = host_path.split(':')
-    if len(words) == 3: #port number is given
-        port = words[2].strip()
-    else:
-        port = 80
-    host = words[1].strip()
-    return host, port
-
-
-def parse_absolute_url(url):
-    url_split = url.split(':')
-    if len(url_split) >= 1 and url_split[0].lower() != "http":
-        url = "http://" + url + "/"
-    parsed_url = urlparse(url)
-    if parsed_url.port == None:
-        port = 80
-    else:
-        port = parsed_url.port
-    host_name = parsed_url.hostname
-    path = parsed_url.path
-    if not host_name:
-        host_name = path
-    print( "Host :", host_name, "path: ", path, "Port: ", port )
-    return host_name, path, port
 
+class DiskWriter(object):
+    """
+    A DiskCache file being written under a temporary name, for a body
+    that may arrive a piece at a time and whose length isn't known up
+    front. commit() fills in body_length and renames the file into
+    place; abort() removes it.
+    """
 
-def parse_http_request(source_addr, http_raw_data):
-    header_list = []
-    http_request_list = http_raw_data.split("\r\n")
-    method = http_request_list[0].split()[0].strip()
+    # room left in the metadata block for body_length
+    LENGTH_DIGITS = 20
 
-    if len( http_request_list) > 1 and http_request_list[1].split(':')[0].strip().lower() == 'host':
-        relative_path = True
-    else:
-        relative_path = False
+    def __init__(self, disk: DiskCache, name, path, temp_path, f, file_id, length_slot):
+        self.disk = disk
+        self.name = name
+        self.path = path
+        self.temp_path = temp_path
+        self.f = f
+        self.file_id = file_id
+        self.length_slot = length_slot
+        self.size = 0
+        self.length = 0
 
-    if relative_path:
-        host, port = parse_relative_url(http_request_list[1])
-        path = http_request_list[0].split()[1].strip()
+    def write(self, data):
+        self.f.write(data)
+        self.length += len(data)
 
-    else:
-        url = http_request_list[0].split()[1].strip()
-        host, path, port = parse_absolute_url(url)
-        if not host:
-            host = path
+    def commit(self):
+        """
+        Returns the body_file of the written entry, or None if it
+        couldn't be put in place.
+        """
+        try:
+            self.f.seek(self.length_slot)
+            self.f.write(str(self.length).encode("ascii"))
+            self.f.close()
+            os.replace(self.temp_path, self.path)
+        except OSError as e:
+            log.warning("Disk cache write failed: %s", e)
+            self.abort()
+            return None
+        self.disk.added(self.name, self.size + self.length)
+        return self.path, self.file_id, self.length
 
-    for i in range(1, len(http_request_list)):
-        if not http_request_list[i]:
-            continue
-        current_list = []
-        splitting = http_request_list[i].split(':')
-        current_list.append(splitting[0].strip())
-        current_list.append(splitting[1].strip())
-        header_list.append(current_list)
+    def abort(self):
+        try:
+            self.f.close()
+        except OSError:
+            pass
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
 
-    print("*" * 50)
-    ret = HttpRequestInfo( source_addr, method, host, port, path, header_list)
-    return ret
+
+def read_disk_metadata(f):
+    """
+    Reads the metadata block at the start of a disk cache file; the
+    file is left positioned at the body. None if it isn't one.
+    """
+    prefix = f.read(len(DiskCache.MAGIC) + 4)
+    if len(prefix) < len(DiskCache.MAGIC) + 4 or not prefix.startswith(DiskCache.MAGIC):
+        return None
+    (length,) = struct.unpack(">I", prefix[len(DiskCache.MAGIC):])
+    return json.loads(f.read(length).decode("utf-8"))
 
 
-def validate_http_request(http_request_list):
-    #checking that all 3 required sections are available
+def open_cached_body(body_file):
+    """
+    Opens the file behind a disk-backed entry, positioned at the body;
+    None if it was evicted or replaced by a newer version since.
+    """
+    (path, file_id, length) = body_file
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    try:
+        meta = read_disk_metadata(f)
+    except (OSError, ValueError):
+        meta = None
+    if meta is None or meta.get("id") != file_id or \
+            os.fstat(f.fileno()).st_size - f.tell() != length:
+        f.close()
+        return None
+    return f
 
-    if len(http_request_list[0].split()) != 3:
-        return HttpRequestState.INVALID_INPUT
 
-    method = http_request_list[0].split()[0]
-    url = http_request_list[0].split()[1]
-    http_version = http_request_list[0].split()[2]
-    check_host_header = False
+class TieredCache(object):
+    """
+    A ResponseCache in front of a DiskCache, with the same interface.
 
-    #checking which form relative or absolute
-    if url[0] == '/':
-        check_host_header = True
+    Every stored value is written through to disk. Memory keeps the
+    entries up to the memory cache's size limit; a bigger entry stays
+    there as metadata only and its body is sent from the file. Disk
+    hits are copied back into memory, bodies included when they fit.
 
-    if http_version.lower() != "http/1.0" and  http_version.lower() != "http/1.1":
-        return HttpRequestState.INVALID_INPUT
+    A relayed body too big for memory is written to disk as it arrives
+    (see BodySpool), so it is never held in memory whole.
+    """
 
-    if check_host_header:
-        host_header_line = http_request_list[1].split(':')
-        if host_header_line[0].lower() != 'host':
-            return HttpRequestState.INVALID_INPUT
-        elif not host_header_line[1]:
-            return HttpRequestState.INVALID_INPUT
+    def __init__(self, memory: ResponseCache, disk: DiskCache):
+        self.memory = memory
+        self.disk = disk
+        self.max_entry_bytes = max(memory.max_entry_bytes, disk.max_entry_bytes)
 
-    #checking headers format
-    if check_host_header:
-        i = 2
-    else:
-        i = 1
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        value = self.disk.load(key)
+        if value is None:
+            return None
+        if isinstance(value, CacheEntry) and value.body_length <= self.memory.max_entry_bytes:
+            value = value.with_body_loaded()
+            if value is None:
+                return None
+        self.memory.put(key, value, value.size)
+        return value
 
-    while i < len(http_request_list) and http_request_list[i]:
-        if len(http_request_list[i].split(':')) != 2:
-            return HttpRequestState.INVALID_INPUT
-        i = i+1
-    return HttpRequestState.GOOD
+    def put(self, key, value, size=None):
+        """
+        Note that a CacheEntry too big for memory has its body moved to
+        the disk file in place.
+        """
+        body_file = self.disk.store(key, value)
+        if isinstance(value, CacheEntry) and body_file is not None:
+            if value.body is None or value.body_length > self.memory.max_entry_bytes:
+                value.move_body_to(body_file)
+        elif isinstance(value, CacheEntry) and value.body is None:
+            return False
+        return self.memory.put(key, value, value.size)
 
+    def remove(self, key):
+        self.memory.remove(key)
+        self.disk.remove(key)
 
-def check_http_request_validity(http_raw_data) -> HttpRequestState:
-    print("*" * 50)
-    http_request_list = http_raw_data.split("\r\n")
-    method = http_request_list[0].split()[0]
-    res = HttpRequestState.GOOD
-    if method == "GET" or method == "POST" or method == "HEAD" or method == "PUT":
-        res = validate_http_request(http_request_list)
-        if method != "GET" and res == HttpRequestState.GOOD:
-            res = HttpRequestState.NOT_SUPPORTED
-    else:
-        res = HttpRequestState.INVALID_INPUT
-    print("*" * 50)
+    def __len__(self):
+        return len(self.memory)
 
-    return res
+    def stats(self):
+        totals = self.memory.stats()
+        for (name, value) in self.disk.stats().items():
+            totals["disk_" + name] = value
+        return totals
 
 
-def sanitize_http_request(request_info: HttpRequestInfo):
+class BodySpool(object):
+    """
+    Collects the copy of a relayed response body that is to be cached,
+    as relay() hands it over. Up to memory_limit bytes are kept in
+    memory. A longer body moves to a DiskWriter for key in the disk
+    tier, decoded from chunked on the way if need be, and carries on
+    straight to the file. A body too long for the disk tier, or for
+    memory without one, is dropped.
+    """
 
-    if not request_info.requested_path:
-        host, path, port = parse_absolute_url(request_info.requested_host)
-        request_info.requested_host = host
-        request_info.requested_path = path
-        request_info.requested_port = port
+    def __init__(self, status_line, status, headers: list, request_time, response_time,
+                 method, memory_limit, disk=None, key=None):
+        self.status_line = status_line
+        self.status = status
+        self.headers = headers
+        self.request_time = request_time
+        self.response_time = response_time
+        self.method = method
+        self.memory_limit = memory_limit
+        self.disk = disk
+        self.key = key
+        self.body = bytearray()
+        self.writer = None
+        # finds the chunk data in what goes to disk
+        self.framer = BodyFramer(BodyFramer.CHUNKED) if is_chunked(headers) else None
+        self.dropped = False
+        # an executor write the asyncio engine gave up waiting for may
+        # still be running when close() is called
+        self.lock = threading.Lock()
 
-    list_headers = request_info.headers
-    if len(list_headers) >= 1 and list_headers[0][0].strip() == "Host": #first list in header_list, first item in this list
+    def on_disk(self, length):
+        """
+        Whether writing length more bytes reaches the disk.
+        """
+        return not self.dropped and (self.writer is not None or (
+            self.disk is not None and len(self.body) + length > self.memory_limit))
+
+    def write(self, data):
+        with self.lock:
+            self.write_locked(data)
+
+    def write_locked(self, data):
+        if self.dropped:
+            return
+        if self.writer is None:
+            if len(self.body) + len(data) <= self.memory_limit:
+                self.body += data
+                return
+            if self.disk is None or not self.spill():
+                self.drop()
+                return
+        self.write_decoded(data)
+        if self.writer.length > self.disk.max_entry_bytes:
+            self.drop()
+
+    def spill(self):
+        self.writer = self.disk.writer(self.key, entry_metadata(
+            self.status_line, self.status, kept_headers(self.headers), self.request_time,
+            self.response_time))
+        if self.writer is None:
+            return False
+        (body, self.body) = (self.body, bytearray())
+        self.write_decoded(body)
+        return True
+
+    def write_decoded(self, data):
+        if self.framer is None:
+            self.writer.write(data)
+            return
+        data = bytes(data)
+        spans = []
+        self.framer.feed(data, 0, len(data), spans)
+        for (start, end) in spans:
+            self.writer.write(data[start:end])
+
+    def drop(self):
+        self.dropped = True
+        self.body = bytearray()
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+
+    def finish(self):
+        """
+        The CacheEntry of the whole body, or None if it was dropped. A
+        spooled body's file is renamed into place under key.
+        """
+        with self.lock:
+            return self.finish_locked()
+
+    def finish_locked(self):
+        if self.dropped:
+            return None
+        if self.writer is None:
+            return CacheEntry.from_response(self.status_line, self.status, self.headers,
+                                            self.body, self.request_time,
+                                            self.response_time, self.method)
+        (writer, self.writer) = (self.writer, None)
+        body_file = writer.commit()
+        if body_file is None:
+            return None
+        entry = CacheEntry.from_response(self.status_line, self.status, self.headers, None,
+                                         self.request_time, self.response_time,
+                                         self.method, body_file)
+        entry.in_place = True
+        return entry
+
+    def close(self):
+        """
+        Removes the temporary file of a body that wasn't finished.
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.drop()
+
+
+def response_spool(cache, request_info: HttpRequestInfo, status_line, status,
+                   headers: list, request_time, response_time):
+    """
+    A BodySpool for the response to request_info, sized for cache.
+    """
+    if isinstance(cache, TieredCache):
+        return BodySpool(status_line, status, headers, request_time, response_time,
+                         request_info.method, cache.memory.max_entry_bytes, cache.disk,
+                         response_key(request_info, vary_names(headers)))
+    return BodySpool(status_line, status, headers, request_time, response_time,
+                     request_info.method, cache.max_entry_bytes)
+
+
+class Flight(object):
+    """
+    One in-progress fetch that other requests can wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def complete(self, result, error):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout):
+        """
+        Returns False on timeout, True once the fetch finished; if it
+        failed, its error is raised here as well.
+        """
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class AsyncFlight(Flight):
+    """
+    Flight for the asyncio engine; wait() is a coroutine.
+    """
+
+    def __init__(self):
+        Flight.__init__(self)
+        self.done = asyncio.Event()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent fetches of the same key: the first caller
+    becomes the leader and does the work, later callers get the
+    leader's Flight to wait on until finish() is called.
+    """
+
+    def __init__(self, flight_class=Flight):
+        self.flight_class = flight_class
+        self.lock = threading.Lock()
+        self.flights = dict()
+
+    def begin(self, key):
+        """
+        Returns (flight, True) for the leader, (flight, False) otherwise.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flight_class()
+            self.flights[key] = flight
+            return flight, True
+
+    def finish(self, key, flight: Flight, result=None, error=None):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.complete(result, error)
+
+
+def socket_is_idle(conn: socket.socket):
+    """
+    Health check for a pooled origin connection: an idle keep-alive
+    connection has nothing to read. Readable means the origin closed
+    it (or sent something unexpected), so it can't be reused.
+
+    poll, unlike select, takes descriptors past FD_SETSIZE (1024);
+    select is left for systems without poll, which have no such limit.
+    """
+    try:
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(conn, select.POLLIN)
+            return not poller.poll(0)
+        (readable, writable, failed) = select.select([conn], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+def close_socket(conn: socket.socket):
+    conn.close()
+
+
+def stream_is_idle(conn):
+    """
+    Health check for a pooled asyncio stream, as socket_is_idle: the
+    loop may already have moved what the origin sent, or its close,
+    from the socket into the reader's buffer, so that must be empty
+    as well.
+    """
+    (reader, writer) = conn
+    if writer.is_closing() or reader.at_eof() or len(reader._buffer) or \
+            reader.exception() is not None:
+        return False
+    sock = writer.get_extra_info("socket")
+    return sock is None or socket_is_idle(sock)
+
+
+def close_stream(conn):
+    conn[1].close()
+
+
+class UpstreamPool(object):
+    """
+    Idle keep-alive connections to origins, keyed by (host, port).
+
+    checkout() hands out the most recently used idle connection that
+    passes the health check, or None when the caller has to connect
+    itself; checkin() returns a connection after a complete response.
+    Connections idle for longer than idle_timeout, and any beyond
+    max_idle_per_host, are closed.
+    """
+
+    def __init__(self, max_idle_per_host=8, idle_timeout=30.0,
+                 is_healthy=socket_is_idle, close=close_socket):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.is_healthy = is_healthy
+        self.close = close
+        self.lock = threading.Lock()
+        self.idle = dict()  # (host, port) -> deque of (connection, idle since)
+        self.counters = {"reused": 0, "created": 0, "released": 0,
+                         "expired": 0, "unhealthy": 0, "overflow": 0}
+
+    def checkout(self, key):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                connections = self.idle.get(key)
+                if not connections:
+                    self.counters["created"] += 1
+                    return None
+                (conn, idle_since) = connections.pop()
+                if not connections:
+                    del self.idle[key]
+                if now - idle_since > self.idle_timeout:
+                    self.counters["expired"] += 1
+                elif self.is_healthy(conn):
+                    self.counters["reused"] += 1
+                    return conn
+                else:
+                    self.counters["unhealthy"] += 1
+            self.close(conn)
+
+    def checkin(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, collections.deque())
+            if len(connections) < self.max_idle_per_host:
+                connections.append((conn, time.monotonic()))
+                self.counters["released"] += 1
+                return
+            self.counters["overflow"] += 1
+        self.close(conn)
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = dict()
+        for connections in idle.values():
+            for (conn, idle_since) in connections:
+                self.close(conn)
+
+    def stats(self):
+        with self.lock:
+            totals = dict(self.counters)
+            totals["idle"] = sum(len(connections) for connections in self.idle.values())
+        return totals
 
-        return
-    host_header = ["Host", request_info.requested_host]
-    request_info.headers.insert(0, host_header)
 
-    return
+def system_lookup(host, port):
+    """
+    Default Resolver lookup; getaddrinfo gives no TTL.
+    """
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = []
+    for (family, _, _, _, sockaddr) in infos:
+        if (family, sockaddr) not in addresses:
+            addresses.append((family, sockaddr))
+    return addresses, None
+
+
+def ip_literal(host, port):
+    """
+    [(family, sockaddr)] if host is an IP address, None if it is a name.
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (OSError, ValueError):
+            continue
+        if family == socket.AF_INET6:
+            return [(family, (host, port, 0, 0))]
+        return [(family, (host, port))]
+    return None
+
+
+class Resolver(object):
+    """
+    Caches name lookups: answers are kept for their TTL (positive_ttl
+    when the lookup gives none) and failures for negative_ttl.
+    Concurrent lookups of the same name share one call to lookup.
+
+    lookup(host, port) returns ([(family, sockaddr), ...], ttl or
+    None) or raises OSError; system_lookup, the default, calls
+    getaddrinfo. Tests plug in a stub.
+    """
+
+    def __init__(self, lookup=None, positive_ttl=60.0, negative_ttl=5.0,
+                 max_entries=4096, timeout=10.0):
+        self.lookup = lookup or system_lookup
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = dict()   # (host, port) -> (addresses, error, expires)
+        self.flights = SingleFlight(Flight)
+        self.async_flights = SingleFlight(AsyncFlight)
+        self.lookups = 0
+
+    def cached(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.monotonic():
+                del self.entries[key]
+                return None
+            return entry
+
+    def answer(self, entry):
+        (addresses, error, _) = entry
+        if error is not None:
+            raise error
+        return addresses
+
+    def run_lookup(self, host, port):
+        """
+        Calls lookup and caches its outcome; returns the cache entry.
+        """
+        self.lookups += 1
+        try:
+            (addresses, ttl) = self.lookup(host, port)
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME, "no addresses for %s" % host)
+            entry = (addresses, None, self.positive_ttl if ttl is None else ttl)
+        except OSError as e:
+            entry = ([], e, self.negative_ttl)
+        entry = (entry[0], entry[1], time.monotonic() + entry[2])
+        with self.lock:
+            if len(self.entries) >= self.max_entries and (host, port) not in self.entries:
+                del self.entries[next(iter(self.entries))]
+            self.entries[(host, port)] = entry
+        return entry
+
+    def resolve(self, host, port):
+        """
+        Returns [(family, sockaddr), ...] for host, or raises OSError.
+        """
+        literal = ip_literal(host, port)
+        if literal is not None:
+            return literal
+        key = (host, port)
+        entry = self.cached(key)
+        if entry is not None:
+            return self.answer(entry)
+
+        (flight, leader) = self.flights.begin(key)
+        if leader:
+            try:
+                entry = self.run_lookup(host, port)
+            except BaseException:
+                self.flights.finish(key, flight, error=OSError("lookup of %s failed" % host))
+                raise
+            self.flights.finish(key, flight, entry)
+            return self.answer(entry)
+        if not flight.wait(self.timeout):
+            raise socket.timeout("looking up %s timed out" % host)
+        return self.answer(flight.result)
+
+    async def async_resolve(self, host, port):
+        """
+        asyncio counterpart of resolve; lookup runs in the loop's
+        default executor.
+        """
+        literal = ip_literal(host, port)
+        if literal is not None:
+            return literal
+        key = (host, port)
+        entry = self.cached(key)
+        if entry is not None:
+            return self.answer(entry)
+
+        (flight, leader) = self.async_flights.begin(key)
+        if leader:
+            try:
+                entry = await asyncio.get_running_loop().run_in_executor(
+                    None, self.run_lookup, host, port)
+            except BaseException:
+                self.async_flights.finish(key, flight,
+                                          error=OSError("lookup of %s failed" % host))
+                raise
+            self.async_flights.finish(key, flight, entry)
+            return self.answer(entry)
+        if not await flight.wait(self.timeout):
+            raise socket.timeout("looking up %s timed out" % host)
+        return self.answer(flight.result)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "lookups": self.lookups}
+
+
+class RateLimiter(object):
+    """
+    A token bucket per key: rate tokens a second, up to burst of them
+    saved up. Buckets of the least recently seen keys are dropped past
+    max_keys; they come back full.
+    """
+
+    def __init__(self, rate, burst, max_keys=65536):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()    # key -> (tokens, time.monotonic())
+
+    def reserve(self, key, max_wait=0.0):
+        """
+        Takes a token for key. Returns the seconds to wait before using
+        it, 0 when one is there now, or None, taking nothing, when none
+        comes within max_wait. Tokens promised to waiting callers are
+        owed by the bucket, so they are served in turn.
+        """
+        now = time.monotonic()
+        with self.lock:
+            (tokens, stamp) = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            if wait > max_wait:
+                self.buckets[key] = (tokens, now)
+                wait = None
+            else:
+                self.buckets[key] = (tokens - 1, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class ConcurrencyLimit(object):
+    """
+    At most limit holders per key. acquire() waits up to timeout for a
+    free slot and tells whether it got one; release() frees it.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.condition = threading.Condition()
+        self.active = collections.Counter()
+
+    def acquire(self, key, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.active[key] >= self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.active[key] += 1
+            return True
+
+    def release(self, key):
+        with self.condition:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+            self.condition.notify_all()
+
+
+class AsyncConcurrencyLimit(ConcurrencyLimit):
+    """
+    asyncio counterpart of ConcurrencyLimit, used from the loop's
+    thread only. A released slot goes straight to the longest waiting
+    caller.
+    """
+
+    def __init__(self, limit):
+        ConcurrencyLimit.__init__(self, limit)
+        self.waiters = collections.defaultdict(collections.deque)
+
+    async def async_acquire(self, key, timeout):
+        if self.active[key] < self.limit and not self.waiters.get(key):
+            self.active[key] += 1
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[key].append(waiter)
+        try:
+            await asyncio.wait([waiter], timeout=timeout)
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release(key)
+            else:
+                self.forget(key, waiter)
+            raise
+        if waiter.done():
+            return True
+        self.forget(key, waiter)
+        return False
+
+    def forget(self, key, waiter):
+        waiters = self.waiters[key]
+        waiters.remove(waiter)
+        if not waiters:
+            del self.waiters[key]
+
+    def release(self, key):
+        waiters = self.waiters.get(key)
+        if waiters:
+            # the slot passes on, so active stays as it is
+            waiter = waiters.popleft()
+            if not waiters:
+                del self.waiters[key]
+            waiter.set_result(True)
+            return
+        self.active[key] -= 1
+        if not self.active[key]:
+            del self.active[key]
+
+
+def client_wait(context, request_info: HttpRequestInfo):
+    """
+    Seconds request_info has to wait for its client's rate limit, or
+    None when it is to be turned away with 429. Clients are told apart
+    by address, not port, so opening more connections doesn't help.
+    """
+    if context.client_rates is None:
+        return 0.0
+    wait = context.client_rates.reserve(request_info.client_address_info[0],
+                                        context.config.admission_wait)
+    if wait is None:
+        context.metrics.count(("admission_rejected", (("reason", "client_rate"),)))
+    return wait
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing(object):
+    """
+    Consistent hashing: every node sits at vnodes points of a hash
+    circle and a key belongs to the node of the first point at or
+    after the key's own hash. Adding or removing a node only moves the
+    keys next to its points, spread evenly over the other nodes.
+    """
+
+    def __init__(self, nodes, vnodes=100):
+        points = sorted((ring_hash("%s#%d" % (node, i)), node)
+                        for node in nodes for i in range(vnodes))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        return self.nodes[bisect.bisect_left(self.hashes, ring_hash(key)) % len(self.hashes)]
+
+
+def parse_node(node):
+    """
+    ("host", port) of a "host:port" peer; IPv6 hosts are bracketed.
+    """
+    (host, _, port) = node.strip().rpartition(":")
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    if not host:
+        raise ValueError("peer %r has no host" % node)
+    return host, int(port)
+
+
+def format_node(address):
+    (host, port) = address
+    return "[%s]:%d" % (host, port) if ":" in host else "%s:%d" % (host, port)
+
+
+# Request header marking a fetch made by a peer on behalf of its
+# client; the node receiving it fetches from the origin itself.
+PEER_HEADER = "X-Proxy-Peer"
+
+
+class PeerGroup(object):
+    """
+    The proxies sharing their caches, this one (self_node) included,
+    and the HashRing of the healthy ones.
+
+    The ring is rebuilt whenever membership or health changes; a
+    background thread started by start() health-checks the other
+    nodes every check_interval seconds and rereads nodes_file when it
+    changed.
+    """
+
+    def __init__(self, nodes, self_node, vnodes=100, check_interval=5.0, timeout=1.0,
+                 nodes_file=None):
+        self.self_node = format_node(parse_node(self_node))
+        self.vnodes = vnodes
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.nodes_file = nodes_file
+        self.nodes_file_stamp = None
+        self.configured = [format_node(parse_node(node)) for node in nodes]
+        self.lock = threading.Lock()
+        self.nodes = []
+        self.down = set()
+        self.ring = HashRing([], vnodes)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.set_nodes(self.configured + (self.read_nodes_file() or []))
+
+    def set_nodes(self, nodes):
+        """
+        Changes the membership; nodes that left are forgotten.
+        """
+        nodes = sorted(set(format_node(parse_node(node)) for node in nodes) | {self.self_node})
+        with self.lock:
+            if nodes == self.nodes:
+                return
+            self.nodes = nodes
+            self.down &= set(nodes)
+            self.rebuild()
+        log.info("Peers: %s", ", ".join(nodes))
+
+    def rebuild(self):
+        # lookups read self.ring without the lock; it is only ever replaced
+        self.ring = HashRing([node for node in self.nodes if node not in self.down], self.vnodes)
+
+    def owner(self, key):
+        """
+        (host, port) of the peer owning key, or None when it is this
+        node.
+        """
+        node = self.ring.owner(key)
+        if node is None or node == self.self_node:
+            return None
+        return parse_node(node)
+
+    def mark(self, address, healthy):
+        node = format_node(address)
+        with self.lock:
+            if node not in self.nodes or (node not in self.down) == healthy:
+                return
+            if healthy:
+                self.down.discard(node)
+            else:
+                self.down.add(node)
+            self.rebuild()
+        log.warning("Peer %s is %s", node, "back" if healthy else "down")
+
+    def mark_down(self, address):
+        self.mark(address, False)
+
+    def read_nodes_file(self):
+        if self.nodes_file is None:
+            return []
+        try:
+            stamp = os.stat(self.nodes_file).st_mtime_ns
+            if stamp == self.nodes_file_stamp:
+                return None
+            with open(self.nodes_file) as f:
+                nodes = [line.strip() for line in f
+                         if line.strip() and not line.lstrip().startswith("#")]
+        except OSError as e:
+            log.warning("Cannot read peers from %s: %s", self.nodes_file, e)
+            return None
+        self.nodes_file_stamp = stamp
+        return nodes
+
+    def check(self):
+        """
+        Rereads nodes_file if it changed, then tries to connect to
+        every other node.
+        """
+        nodes = self.read_nodes_file()
+        if nodes is not None:
+            self.set_nodes(self.configured + nodes)
+        for node in list(self.nodes):
+            if node == self.self_node:
+                continue
+            address = parse_node(node)
+            try:
+                socket.create_connection(address, self.timeout).close()
+                healthy = True
+            except OSError:
+                healthy = False
+            self.mark(address, healthy)
+
+    def start(self):
+        def run():
+            while not self.stopped.wait(self.check_interval):
+                try:
+                    self.check()
+                except Exception:
+                    log.exception("Peer health check failed")
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+
+    def stats(self):
+        with self.lock:
+            return {"nodes": len(self.nodes), "down": len(self.down)}
+
+
+def owning_peer(context, request_info: HttpRequestInfo, stale_entry=None, body=None):
+    """
+    The (host, port) of the peer to fetch request_info through, or
+    None to go to the origin: when peering is off, this node owns the
+    URL, the request came from a peer, or it isn't a plain GET or HEAD.
+    A stale copy held here is revalidated with the origin directly.
+    """
+    if context.peers is None or request_info.method not in CACHEABLE_METHODS or \
+            body is not None or stale_entry is not None or \
+            get_header(request_info.headers, PEER_HEADER) is not None:
+        return None
+    return context.peers.owner(resource_key(request_info))
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """
+    Counts observations per bucket, as a Prometheus histogram; the
+    last count is for values above every bucket.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """
+        Returns (cumulative counts, sum); the last count is the total.
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return counts, total
+
+
+class Metrics(object):
+    """
+    Counters, gauges and per-stage latency histograms of one process;
+    render_metrics() turns them, with the cache, pool and resolver
+    statistics, into the admin endpoint's text.
+
+    Stages: header_read (first byte to end of the request head),
+    parse, dns, connect, first_byte (request sent to origin head
+    received), relay (response head to end of body) and total.
+    """
+
+    STAGES = ("header_read", "parse", "dns", "connect", "first_byte", "relay", "total")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()   # name, or (name, labels)
+        self.gauges = collections.Counter()
+        self.stages = dict((stage, Histogram()) for stage in Metrics.STAGES)
+        self.workers = 0
+        self.pending = None     # the threaded engine's connection queue
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def adjust(self, gauge, amount):
+        with self.lock:
+            self.gauges[gauge] += amount
+
+
+def render_metrics(context) -> str:
+    """
+    The process's metrics in the Prometheus text exposition format.
+    """
+    metrics = context.metrics
+    lines = []
+
+    def family(name, kind, description, samples):
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for (labels, value) in samples:
+            lines.append("%s%s %s" % (name, format_labels(labels), value))
+
+    stage_samples = []
+    for stage in Metrics.STAGES:
+        (counts, total) = metrics.stages[stage].snapshot()
+        bounds = [repr(bound) for bound in metrics.stages[stage].buckets] + ["+Inf"]
+        for (bound, count) in zip(bounds, counts):
+            stage_samples.append(((("stage", stage), ("le", bound)), count))
+    lines.append("# HELP proxy_stage_seconds Time spent in each stage of serving a request.")
+    lines.append("# TYPE proxy_stage_seconds histogram")
+    for (labels, value) in stage_samples:
+        lines.append("proxy_stage_seconds_bucket%s %s" % (format_labels(labels), value))
+    for stage in Metrics.STAGES:
+        (counts, total) = metrics.stages[stage].snapshot()
+        labels = format_labels((("stage", stage),))
+        lines.append("proxy_stage_seconds_sum%s %r" % (labels, total))
+        lines.append("proxy_stage_seconds_count%s %d" % (labels, counts[-1]))
+
+    with metrics.lock:
+        counters = dict(metrics.counters)
+        gauges = dict(metrics.gauges)
+    requests = sorted((key[1], value) for (key, value) in counters.items()
+                      if isinstance(key, tuple) and key[0] == "requests")
+    family("proxy_requests_total", "counter", "Requests answered, by status and cache result.",
+           requests)
+    rejected = sorted((key[1], value) for (key, value) in counters.items()
+                      if isinstance(key, tuple) and key[0] == "admission_rejected")
+    family("proxy_admission_rejected_total", "counter",
+           "Requests turned away by a client rate limit (429) or an origin's "
+           "concurrency cap (503).", rejected)
+    compressions = sorted((key[1], value) for (key, value) in counters.items()
+                          if isinstance(key, tuple) and key[0] == "compressions")
+    family("proxy_compressions_total", "counter",
+           "Response bodies compressed, relayed or cached, by encoding.", compressions)
+    fills = sorted((key[1], value) for (key, value) in counters.items()
+                   if isinstance(key, tuple) and key[0] == "range_fills")
+    family("proxy_range_fills_total", "counter",
+           "Whole objects fetched in the background for missed range requests, "
+           "by outcome.", fills)
+    family("proxy_connections_total", "counter", "Client connections accepted.",
+           [((), counters.get("connections", 0))])
+    family("proxy_connections_rejected_total", "counter",
+           "Client connections turned away with 503 because every worker was busy.",
+           [((), counters.get("rejected", 0))])
+    family("proxy_connections_active", "gauge",
+           "Client connections open, not counting relayed tunnels.",
+           [((), gauges.get("connections_active", 0))])
+    if metrics.pending is not None:
+        family("proxy_workers", "gauge", "Worker threads.", [((), metrics.workers)])
+        family("proxy_workers_busy", "gauge", "Worker threads serving a connection.",
+               [((), gauges.get("workers_busy", 0))])
+        family("proxy_queue_length", "gauge", "Accepted connections waiting for a worker.",
+               [((), metrics.pending.qsize())])
+        family("proxy_queue_capacity", "gauge", "Connections the queue holds.",
+               [((), metrics.pending.maxsize)])
+
+    cache = context.cache.stats()
+    for name in ("hits", "misses", "evictions", "rejected"):
+        family("proxy_cache_%s_total" % name, "counter", "Memory cache %s." % name,
+               [((), cache[name])])
+    family("proxy_cache_bytes", "gauge", "Bytes held by the memory cache.", [((), cache["bytes"])])
+    family("proxy_cache_entries", "gauge", "Entries in the memory cache.", [((), cache["entries"])])
+    if "disk_files" in cache:
+        for name in ("hits", "misses", "writes", "evictions"):
+            family("proxy_disk_cache_%s_total" % name, "counter", "Disk cache %s." % name,
+                   [((), cache["disk_" + name])])
+        family("proxy_disk_cache_bytes", "gauge", "Bytes held by the disk cache.",
+               [((), cache["disk_bytes"])])
+        family("proxy_disk_cache_files", "gauge", "Files in the disk cache.",
+               [((), cache["disk_files"])])
+
+    pool = context.upstream_pool.stats()
+    family("proxy_upstream_connections_total", "counter",
+           "Origin connection pool events.",
+           sorted(((("event", name),), value) for (name, value) in pool.items()
+                  if name != "idle"))
+    family("proxy_upstream_connections_idle", "gauge", "Idle pooled origin connections.",
+           [((), pool.get("idle", 0))])
+    resolver = context.resolver.stats()
+    family("proxy_dns_lookups_total", "counter", "Name lookups that missed the DNS cache.",
+           [((), resolver["lookups"])])
+    family("proxy_dns_cache_entries", "gauge", "Names in the DNS cache.",
+           [((), resolver["entries"])])
+    if context.tunnels is not None:
+        family("proxy_tunnels_open", "gauge", "CONNECT tunnels being relayed.",
+               [((), context.tunnels.stats()["open"])])
+    if context.peers is not None:
+        peers = context.peers.stats()
+        family("proxy_peers", "gauge", "Cache peers, this proxy included, by health.",
+               [((("state", "up"),), peers["nodes"] - peers["down"]),
+                ((("state", "down"),), peers["down"])])
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, value) for (name, value) in labels) + "}"
+
+
+def start_admin_server(context, port):
+    """
+    Serves GET /metrics on 127.0.0.1:port from a thread of its own;
+    call shutdown() and server_close() on the returned server to stop.
+    """
+
+    class AdminHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics(context).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug("admin: " + format, *args)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), AdminHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, args=(ACCEPT_POLL_INTERVAL,),
+                     daemon=True).start()
+    log.info("Serving metrics on port: %s", port)
+    return server
+
+
+class ProxyContext(object):
+    """
+    State shared by all the connections one process serves.
+    """
+
+    def __init__(self, config: ProxyConfig, engine="threads", resolver=None):
+        self.config = config
+        self.metrics = Metrics()
+        self.cache = ResponseCache(config.cache_bytes, config.cache_object_limit)
+        if config.disk_cache_dir is not None:
+            self.cache = TieredCache(self.cache, DiskCache(
+                config.disk_cache_dir, config.disk_cache_bytes, config.disk_object_limit))
+        self.resolver = resolver or Resolver(positive_ttl=config.dns_ttl,
+                                             negative_ttl=config.dns_negative_ttl,
+                                             timeout=config.connect_timeout)
+        if engine == "asyncio":
+            self.flights = SingleFlight(AsyncFlight)
+            self.upstream_pool = UpstreamPool(config.upstream_max_idle,
+                                              config.upstream_idle_timeout,
+                                              stream_is_idle, close_stream)
+        else:
+            self.flights = SingleFlight(Flight)
+            self.upstream_pool = UpstreamPool(config.upstream_max_idle,
+                                              config.upstream_idle_timeout)
+        # the asyncio engine relays tunnels on its own loop
+        self.tunnels = TunnelRelay(config.tunnel_idle_timeout) if engine != "asyncio" else None
+        self.client_rates = None
+        if config.client_rate is not None:
+            self.client_rates = RateLimiter(config.client_rate, config.client_burst)
+        self.origin_slots = None
+        if config.origin_concurrency is not None:
+            self.origin_slots = (AsyncConcurrencyLimit if engine == "asyncio" else
+                                 ConcurrencyLimit)(config.origin_concurrency)
+        self.range_filler = None
+        if config.range_fills:
+            self.range_filler = RangeFiller(config, config.range_fills)
+        self.peers = None
+        if config.peers or config.peers_file is not None:
+            self.peers = PeerGroup(config.peers, config.peer_self, config.peer_vnodes,
+                                   config.peer_check_interval, config.peer_timeout,
+                                   config.peers_file)
+
+    def close(self):
+        if self.peers is not None:
+            self.peers.close()
+        if self.range_filler is not None:
+            self.range_filler.close()
+        self.upstream_pool.close_all()
+        if self.tunnels is not None:
+            self.tunnels.close_all()
+
+
+# How often the accept loop wakes up to check for shutdown.
+ACCEPT_POLL_INTERVAL = 0.5
+
+# A worker process that dies sooner than this after starting is
+# restarted only after waiting this long, so a crash loop can't spin.
+RESTART_BACKOFF = 1.0
+
+
+# Serving engines selectable from the command line.
+ENGINES = ("threads", "asyncio")
+
+
+def entry_point(proxy_port_number, config=None, engine="threads"):
+    if config is None:
+        config = ProxyConfig()
+    if engine not in ENGINES:
+        print(f"[FATAL] Unknown engine [{engine}], expected one of {ENGINES}")
+        exit(-1)
+
+    if (config.peers or config.peers_file is not None) and config.peer_self is None:
+        config.peer_self = "127.0.0.1:%d" % int(proxy_port_number)
+
+    if config.processes > 1 and hasattr(os, "fork"):
+        supervise(int(proxy_port_number), config, engine)
+    else:
+        listener = start_logging(config)
+        try:
+            run_engine(lambda: setup_sockets(int(proxy_port_number)), config, engine,
+                       config.admin_port)
+        finally:
+            listener.stop()
+    return None
+
+
+def run_engine(bind, config: ProxyConfig, engine, admin_port=None):
+    """
+    Serves until shutdown. bind() returns the listening socket; it is
+    called once the cache is warm, so no client waits on the warm-up.
+    """
+    shutdown = threading.Event()
+    install_shutdown_handlers(shutdown)
+    context = ProxyContext(config, engine)
+    admin = None
+    if admin_port is not None:
+        admin = start_admin_server(context, admin_port)
+    if context.peers is not None:
+        context.peers.start()
+    if config.warm_file is not None:
+        with open(config.warm_file, encoding="utf-8", errors="replace") as f:
+            results = warm_cache(context, (record[2] for record in read_request_log(f)),
+                                 config.warm_parallelism, shutdown)
+        log.info("Warmed the cache from %s: %s", config.warm_file,
+                 ", ".join("%s %d" % item for item in sorted(results.items())) or "nothing")
+    socket_client = bind()
+    if engine == "asyncio":
+        # closes the context itself, while its loop still runs
+        asyncio.run(async_serve_forever(socket_client, context, shutdown))
+    else:
+        serve_forever(socket_client, context, shutdown)
+        context.close()
+    if admin is not None:
+        admin.shutdown()
+        admin.server_close()
+    socket_client.close()
+
+
+def warm_cache(context: ProxyContext, requests, parallelism=8, shutdown=None):
+    """
+    Fetches the objects of the GET and HEAD requests among requests
+    (HttpRequestInfo) into context's cache, parallelism at a time; each
+    URL is fetched once. Returns a Counter of the outcomes: stored,
+    uncacheable, failed and skipped.
+
+    The fetches use blocking sockets and a connection pool of their
+    own, whichever engine serves afterwards.
+    """
+    config = context.config
+    pool = UpstreamPool(config.upstream_max_idle, config.upstream_idle_timeout)
+    results = collections.Counter()
+    lock = threading.Lock()
+    pending = queue.Queue(parallelism * 2)
+
+    def fetcher():
+        while True:
+            request_info = pending.get()
+            if request_info is None:
+                return
+            try:
+                outcome = "stored" if prefetch(context, request_info, pool) is not None \
+                    else "uncacheable"
+            except Exception as e:
+                # this object only: the thread must keep taking requests,
+                # or a full queue would block the producer
+                log.info("Warming %s failed: %s", request_info.requested_path, e)
+                outcome = "failed"
+            with lock:
+                results[outcome] += 1
+
+    fetchers = [threading.Thread(target=fetcher, daemon=True) for i in range(parallelism)]
+    for t in fetchers:
+        t.start()
+    seen = set()
+    try:
+        for request_info in requests:
+            if shutdown is not None and shutdown.is_set():
+                break
+            key = cache_key(request_info)
+            if request_info.method not in CACHEABLE_METHODS or key in seen:
+                with lock:
+                    results["skipped"] += 1
+                continue
+            seen.add(key)
+            pending.put(request_info)
+    finally:
+        for t in fetchers:
+            pending.put(None)
+        for t in fetchers:
+            t.join()
+        pool.close_all()
+    return results
+
+
+def prefetch(context: ProxyContext, request_info: HttpRequestInfo, pool=None):
+    """
+    Fetches request_info's object into the cache with no client
+    waiting for it, on a blocking connection from pool (context's
+    upstream_pool by default). Returns the stored CacheEntry, or None
+    when the response can't be cached.
+    """
+    packet = upstream_request_bytes(request_info, context.config.upstream_keepalive)
+    origin = (request_info.requested_host, request_info.requested_port)
+    (upstream, request_time) = open_upstream(context, origin, packet, request_info.method,
+                                             pool=pool)
+    spool = None
+    entry = None
+    try:
+        response_time = time.time()
+        if is_cacheable_response(request_info, upstream.status, upstream.headers):
+            spool = response_spool(context.cache, request_info, upstream.status_line,
+                                   upstream.status, upstream.headers, request_time,
+                                   response_time)
+        upstream.relay(None, spool)
+        if spool is not None:
+            entry = spool.finish()
+    finally:
+        release_upstream(context, origin, upstream, pool)
+        if spool is not None:
+            spool.close()
+    if entry is None:
+        return None
+    store_response(context.cache, request_info, entry)
+    return entry
+
+
+# Request headers a background fill leaves out: it asks for the whole
+# object, unconditionally.
+FILL_DROPPED_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since",
+                        "if-match", "if-unmodified-since")
+
+
+class RangeFiller(object):
+    """
+    Fetches whole objects into the cache on threads of its own, for
+    range requests that missed. A key is filled once at a time, and at
+    most limit at once; fills asked for beyond that are dropped.
+
+    Under origin_concurrency a fill queues for the origin's slot the
+    way a client's fetch does, behind the fetches already waiting, and
+    is dropped if none is free within admission_wait.
+
+    Fills use blocking sockets and a connection pool of their own,
+    whichever engine serves.
+    """
+
+    def __init__(self, config: ProxyConfig, limit):
+        self.limit = limit
+        self.pool = UpstreamPool(config.upstream_max_idle, config.upstream_idle_timeout)
+        self.lock = threading.Lock()
+        self.keys = set()
+
+    def fill(self, context: ProxyContext, request_info: HttpRequestInfo):
+        """
+        Starts fetching the whole object request_info asks a range of.
+        Returns False if it is being filled already or limit fills are
+        in progress. Called from the serving engine's thread, the event
+        loop's on asyncio.
+        """
+        whole = copy.copy(request_info)
+        whole.headers = [[name, value] for (name, value) in request_info.headers
+                         if name.lower() not in FILL_DROPPED_HEADERS]
+        key = cache_key(whole)
+        with self.lock:
+            if key in self.keys or len(self.keys) >= self.limit:
+                return False
+            self.keys.add(key)
+        loop = None
+        if isinstance(context.origin_slots, AsyncConcurrencyLimit):
+            # its slots are handed out on the loop's thread only
+            loop = asyncio.get_running_loop()
+        threading.Thread(target=self.run, args=(context, whole, key, loop),
+                         daemon=True).start()
+        return True
+
+    def run(self, context: ProxyContext, request_info: HttpRequestInfo, key, loop=None):
+        origin = (request_info.requested_host, request_info.requested_port)
+        try:
+            if self.take_slot(context, origin, loop):
+                try:
+                    outcome = self.fetch(context, request_info)
+                finally:
+                    self.release_slot(context, origin, loop)
+            else:
+                outcome = "origin_busy"
+        finally:
+            with self.lock:
+                self.keys.discard(key)
+        context.metrics.count(("range_fills", (("outcome", outcome),)))
+
+    def fetch(self, context: ProxyContext, request_info: HttpRequestInfo):
+        try:
+            if prefetch(context, request_info, self.pool) is None:
+                return "uncacheable"
+            return "stored"
+        except (UpstreamError, OSError) as e:
+            log.info("Filling %s failed: %s", request_info.requested_path, e)
+            return "failed"
+
+    @staticmethod
+    def take_slot(context: ProxyContext, origin, loop):
+        slots = context.origin_slots
+        if slots is None:
+            return True
+        if loop is None:
+            return slots.acquire(origin, context.config.admission_wait)
+        try:
+            return asyncio.run_coroutine_threadsafe(
+                slots.async_acquire(origin, context.config.admission_wait), loop).result()
+        except (RuntimeError, concurrent.futures.CancelledError):
+            return False    # the loop has closed, or cancelled the wait on its way out
+
+    @staticmethod
+    def release_slot(context: ProxyContext, origin, loop):
+        slots = context.origin_slots
+        if slots is None:
+            return
+        if loop is None:
+            slots.release(origin)
+        else:
+            loop.call_soon_threadsafe(slots.release, origin)
+
+    def close(self):
+        self.pool.close_all()
+
+
+def start_range_fill(context: ProxyContext, request_info: HttpRequestInfo, status,
+                     headers: list):
+    """
+    Has the whole object filled in the background when the origin
+    answered a range request with a 206 for an object the cache could
+    store.
+    """
+    if context.range_filler is None or status != 206 or request_info.method != "GET":
+        return
+    total = content_range_length(get_header(headers, "Content-Range"))
+    if total is None or total > context.cache.max_entry_bytes or \
+            not is_cacheable_response(request_info, 200, headers):
+        return
+    context.range_filler.fill(context, request_info)
+
+
+log = logging.getLogger("proxy")
+access_log = logging.getLogger("proxy.access")
+
+
+def start_logging(config: ProxyConfig):
+    """
+    Points the proxy's loggers at a queue. Serving threads only put
+    records on it; a listener thread formats and writes them, so a
+    slow terminal or disk never holds up a request. Returns the
+    listener, whose stop() flushes what is still queued.
+
+    Called again in each forked worker, whose copy of the parent's
+    listener thread doesn't run.
+    """
+    log_queue = queue.SimpleQueue()
+    handlers = [logging.StreamHandler()]
+    handlers[0].addFilter(lambda record: not hasattr(record, "access"))
+    if config.access_log is not None:
+        if config.access_log == "-":
+            handlers.append(logging.StreamHandler())
+        else:
+            handlers.append(logging.FileHandler(config.access_log))
+        handlers[1].addFilter(lambda record: hasattr(record, "access"))
+    for handler in handlers:
+        handler.setFormatter(LogFormatter())
+
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(config.log_level)
+    log.propagate = False
+    # a disabled access log costs one cached level check per request
+    access_log.setLevel(logging.INFO if config.access_log is not None else logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+class LogFormatter(logging.Formatter):
+    """
+    Writes access records as one JSON object per line and the other
+    records as text.
+    """
+
+    def __init__(self):
+        logging.Formatter.__init__(self, "%(asctime)s %(levelname)s [%(process)d] %(message)s")
+
+    def format(self, record):
+        fields = getattr(record, "access", None)
+        if fields is None:
+            return logging.Formatter.format(self, record)
+        return json.dumps(dict(time=self.formatTime(record), **fields))
+
+
+def finish_request(context: ProxyContext, address, started,
+                   request_info: HttpRequestInfo = None, error=None):
+    """
+    Records a served request in the metrics and the access log.
+    """
+    metrics = context.metrics
+    metrics.observe("total", time.monotonic() - started)
+    if request_info is None:
+        code = error.code.value if isinstance(error.code, HttpErrorCodes) else error.code
+        metrics.count(("requests", (("status", code), ("cache", "-"))))
+    else:
+        metrics.count(("requests", (("status", request_info.status),
+                                    ("cache", request_info.cache_result))))
+    log_access(address, started, request_info, error)
+
+
+def log_access(address, started, request_info: HttpRequestInfo = None, error=None):
+    """
+    Logs one served request: request_info as answered, or the error
+    response sent for a request that didn't parse. started is the
+    time.monotonic() at which its head was read.
+    """
+    if not access_log.isEnabledFor(logging.INFO):
+        return
+    fields = {"client": "%s:%s" % (address[0], address[1]) if address else "-",
+              "duration_ms": round((time.monotonic() - started) * 1000, 3)}
+    if request_info is None:
+        code = error.code.value if isinstance(error.code, HttpErrorCodes) else error.code
+        fields.update(method="-", url="-", status=code, bytes=0, cache="-",
+                      upstream_ms=None)
+    else:
+        if request_info.method == "CONNECT":
+            url = "%s:%s" % (request_info.requested_host, request_info.requested_port)
+        else:
+            url = "http://%s:%s%s" % (request_info.requested_host,
+                                      request_info.requested_port, request_info.requested_path)
+        upstream_time = request_info.upstream_time
+        fields.update(method=request_info.method, url=url, status=request_info.status,
+                      bytes=request_info.response_bytes, cache=request_info.cache_result,
+                      upstream_ms=None if upstream_time is None else round(upstream_time * 1000, 3))
+    access_log.info("access", extra={"access": fields})
+
+
+def supervise(proxy_port_number, config: ProxyConfig, engine):
+    """
+    Forks config.processes workers and keeps that many alive.
+
+    With SO_REUSEPORT every worker binds its own listening socket
+    and the kernel spreads new connections across them; without it
+    the workers share one socket bound here and inherited on fork.
+    Caches are per worker.
+    """
+    listener = start_logging(config)
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    inherited = None if reuse_port else setup_sockets(proxy_port_number)
+
+    shutdown = threading.Event()
+    install_shutdown_handlers(shutdown)
+
+    children = dict()   # pid -> (start time, worker index)
+    for i in range(config.processes):
+        pid, started = spawn_worker(proxy_port_number, config, engine, inherited, i)
+        children[pid] = (started, i)
+
+    while not shutdown.is_set():
+        try:
+            (pid, status) = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid == 0 or pid not in children:
+            time.sleep(ACCEPT_POLL_INTERVAL)
+            continue
+        (started, index) = children.pop(pid)
+        log.warning("Worker %s exited with status %s - restarting", pid, status)
+        if time.monotonic() - started < RESTART_BACKOFF:
+            time.sleep(RESTART_BACKOFF)
+        pid, started = spawn_worker(proxy_port_number, config, engine, inherited, index)
+        children[pid] = (started, index)
+
+    stop_workers(children, config.drain_timeout)
+    if inherited is not None:
+        inherited.close()
+    listener.stop()
+
+
+def spawn_worker(proxy_port_number, config: ProxyConfig, engine, inherited, index=0):
+    pid = os.fork()
+    if pid != 0:
+        return pid, time.monotonic()
+
+    status = 0
+    listener = start_logging(config)
+    try:
+        if inherited is None:
+            bind = lambda: setup_sockets(proxy_port_number, reuse_port=True)
+        else:
+            bind = lambda: inherited
+        admin_port = None if config.admin_port is None else config.admin_port + index
+        run_engine(bind, config, engine, admin_port)
+    except BaseException:
+        log.exception("Worker %s failed", os.getpid())
+        status = 1
+    finally:
+        listener.stop()
+        os._exit(status)
+
+
+def stop_workers(children: dict, drain_timeout):
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + drain_timeout
+    while children and time.monotonic() < deadline:
+        (pid, status) = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.1)
+            continue
+        children.pop(pid, None)
+    for pid in children:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def install_shutdown_handlers(shutdown: threading.Event):
+    # signal handlers can only be installed from the main thread
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def handler(signum, frame):
+        log.info("Shutting down, draining connections")
+        shutdown.set()
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def serve_forever(socket_client: socket.socket, context: ProxyContext,
+                  shutdown: threading.Event):
+    """
+    Accepts connections until shutdown is set, handing each one
+    to a fixed pool of worker threads through a bounded queue.
+    """
+    config = context.config
+    metrics = context.metrics
+    pending = queue.Queue(config.queue_depth)
+    metrics.workers = config.workers
+    metrics.pending = pending
+    workers = []
+    for i in range(config.workers):
+        t = threading.Thread(target=worker_loop, args=(pending, context,),
+                             daemon=True)
+        t.start()
+        workers.append(t)
+
+    socket_client.settimeout(ACCEPT_POLL_INTERVAL)
+    while not shutdown.is_set():
+        try:
+            (conn, address) = socket_client.accept()
+        except socket.timeout:
+            continue
+        except OSError:
+            if shutdown.is_set():
+                break
+            continue
+        conn.settimeout(None)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        metrics.count("connections")
+        metrics.adjust("connections_active", 1)
+
+        if config.reject_when_full:
+            try:
+                pending.put_nowait((conn, address))
+            except queue.Full:
+                reject_connection(conn, metrics)
+        else:
+            while not shutdown.is_set():
+                try:
+                    pending.put((conn, address), timeout=ACCEPT_POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    continue
+            else:
+                reject_connection(conn, metrics)
+
+    drain_workers(pending, workers, config.drain_timeout)
+
+
+def worker_loop(pending: queue.Queue, context: ProxyContext):
+    metrics = context.metrics
+    while True:
+        item = pending.get()
+        if item is None:
+            return
+        (conn, address) = item
+        detached = False
+        metrics.adjust("workers_busy", 1)
+        try:
+            detached = get_request(conn, address, context)
+        except Exception as e:
+            log.warning("Error serving %s: %s", address, e)
+        finally:
+            if not detached:
+                conn.close()
+            metrics.adjust("workers_busy", -1)
+            metrics.adjust("connections_active", -1)
+
+
+def reject_connection(conn: socket.socket, metrics=None):
+    send_error_response(conn, HttpErrorCodes.SERVICE_UNAVAILABLE, "Service Unavailable")
+    conn.close()
+    if metrics is not None:
+        metrics.count("rejected")
+        metrics.adjust("connections_active", -1)
+
+
+def send_error_response(conn: socket.socket, code, message):
+    response = HttpErrorResponse(code, message)
+    try:
+        conn.sendall(response.to_byte_array(response.to_http_string()))
+    except OSError:
+        pass
+
+
+def send_request_error(conn: socket.socket, request_info: HttpRequestInfo, code, message):
+    """
+    Answers request_info with an error response. That says Connection:
+    close, so the connection isn't kept for another request.
+    """
+    request_info.status = code.value
+    request_info.keep_alive = False
+    send_error_response(conn, code, message)
+
+
+def discard_input(conn: socket.socket, timeout=1.0, limit=1024 * 1024):
+    """
+    Reads and drops what the client is still sending, so closing the
+    socket with unread data does not reset the connection before the
+    client has read our response.
+    """
+    try:
+        conn.shutdown(socket.SHUT_WR)
+        conn.settimeout(timeout)
+        while limit > 0:
+            packet = conn.recv(65536)
+            if not packet:
+                break
+            limit -= len(packet)
+    except OSError:
+        pass
+
+
+def drain_workers(pending: queue.Queue, workers: list, drain_timeout):
+    # Sentinels go behind whatever is already queued, so queued
+    # clients are still served before the workers exit.
+    deadline = time.monotonic() + drain_timeout
+    for t in workers:
+        try:
+            pending.put(None, timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            break
+    for t in workers:
+        t.join(max(0.0, deadline - time.monotonic()))
+
+
+def setup_sockets(proxy_port_number, reuse_port=False):
+    socket_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    socket_client.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        socket_client.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    proxy_address = ("127.0.0.1", proxy_port_number)
+    socket_client.bind(proxy_address)
+    socket_client.listen(30)
+    log.info("Starting HTTP proxy on port: %s", proxy_port_number)
+    return socket_client
+
+
+def get_request(conn: socket.socket, address, context: ProxyContext):
+    """
+    Serves requests from one client connection, in order, for as long
+    as the client keeps it alive and sends the next request within
+    client_idle_timeout. Pipelined requests wait in the reader.
+
+    Returns True when conn became a CONNECT tunnel and must stay open.
+    """
+    config = context.config
+    metrics = context.metrics
+    reader = ClientReader(conn, config.max_header_bytes)
+    while True:
+        try:
+            msg = reader.read_head(config.client_idle_timeout, config.header_timeout)
+        except socket.timeout:
+            if reader.buffered():   # the head was started, not just an idle connection
+                send_error_response(conn, HttpErrorCodes.REQUEST_TIMEOUT, "Request Timeout")
+            return
+        except RequestHeadTooLarge:
+            send_error_response(conn, HttpErrorCodes.HEADER_FIELDS_TOO_LARGE,
+                                "Request Header Fields Too Large")
+            discard_input(conn)
+            return
+        if msg is None:  # client went away before finishing the request
+            return
+        started = time.monotonic()
+        metrics.observe("header_read", started - reader.head_started)
+
+        response = http_request_pipeline(address, msg)
+        metrics.observe("parse", time.monotonic() - started)
+
+        if isinstance(response, HttpErrorResponse):
+            packet = response.to_byte_array(response.to_http_string())
+            conn.sendall(packet)
+            finish_request(context, address, started, error=response)
+            return
+        if config.request_timeout is not None:
+            response.deadline = started + config.request_timeout
+        wait = client_wait(context, response)
+        if wait is None:
+            response.status = HttpErrorCodes.TOO_MANY_REQUESTS.value
+            send_error_response(conn, HttpErrorCodes.TOO_MANY_REQUESTS, "Too Many Requests")
+            if not BodyFramer.for_request(response.headers).done:
+                discard_input(conn)
+            finish_request(context, address, started, response)
+            return
+        if wait:
+            time.sleep(wait)
+        if response.method == "CONNECT":
+            try:
+                return open_tunnel(conn, reader, response, context)
+            finally:
+                finish_request(context, address, started, response)
+        response.keep_alive = client_keeps_alive(response)
+        body = RequestBody.for_request(reader, response, config.client_idle_timeout)
+        conn.settimeout(config.client_idle_timeout)
+        try:
+            serve_request(conn, response, context, body)
+        finally:
+            finish_request(context, address, started, response)
+        # an unread body would be taken for the next request
+        if not response.keep_alive or (body is not None and not body.framer.done):
+            return
+
+
+class RequestHeadTooLarge(Exception):
+    """
+    The client sent more than max_header_bytes without ending the
+    request head.
+    """
+    pass
+
+
+class RequestTimeout(Exception):
+    """
+    The client stalled while sending its request body.
+    """
+    pass
+
+
+class MalformedRequestBody(Exception):
+    """
+    The client's request body doesn't keep to its framing.
+    """
+    pass
+
+
+def time_left(deadline, limit=None):
+    """
+    A timeout of limit seconds, shortened to what is left until
+    deadline (a time.monotonic() value, or None for no deadline).
+    Raises socket.timeout once the deadline has passed.
+    """
+    if deadline is None:
+        return limit
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("request deadline passed")
+    return remaining if limit is None else min(limit, remaining)
+
+
+class ClientReader(object):
+    """
+    Reads from a client connection into one fixed buffer with
+    recv_into. Request heads are cut out of the buffer; whatever
+    follows a head (its body, or the next pipelined request) stays
+    buffered for the next read.
+    """
+
+    def __init__(self, conn: socket.socket, max_head=64 * 1024):
+        self.conn = conn
+        self.buffer = bytearray(max_head)
+        self.view = memoryview(self.buffer)
+        self.start = 0      # first byte not handed out yet
+        self.end = 0        # end of the received bytes
+        self.scanned = 0    # no head ends before this offset
+        self.head_started = None
+
+    def buffered(self):
+        return self.end - self.start
+
+    def read_head(self, idle_timeout=None, head_timeout=None):
+        """
+        Returns the next request head, blank line included, or None if
+        the client closes first. Waits up to idle_timeout for the first
+        byte, then head_timeout for the rest; raises socket.timeout
+        when either runs out.
+
+        head_started is set to the time.monotonic() at which the
+        returned head's first byte was at hand.
+        """
+        deadline = None
+        head_started = None
+        while True:
+            if head_started is None and self.end > self.start:
+                head_started = time.monotonic()
+                if head_timeout is not None:
+                    deadline = head_started + head_timeout
+            # only the new bytes, plus 3 for a terminator split across reads
+            pos = self.buffer.find(b"\r\n\r\n", max(self.start, self.scanned - 3), self.end)
+            if pos >= 0:
+                head = bytes(self.view[self.start:pos + 4])
+                self.start = self.scanned = pos + 4
+                self.head_started = head_started
+                return head
+            self.scanned = self.end
+            if self.end - self.start >= len(self.buffer):
+                raise RequestHeadTooLarge()
+            self.compact()
+
+            if deadline is None:
+                self.conn.settimeout(idle_timeout)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("request head not received in time")
+                self.conn.settimeout(remaining)
+            n = self.conn.recv_into(self.view[self.end:])
+            if not n:
+                return None
+            self.end += n
+
+    def read(self, limit):
+        """
+        Returns up to limit bytes following the last head: buffered
+        bytes first, otherwise the result of one recv. The returned
+        memoryview is only valid until the next read; it is empty once
+        the client has closed.
+        """
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+            self.end = self.conn.recv_into(self.view[:min(limit, len(self.buffer))])
+        take = min(limit, self.end - self.start)
+        data = self.view[self.start:self.start + take]
+        self.start += take
+        self.scanned = max(self.scanned, self.start)
+        return data
+
+    def relay_body(self, framer, send, timeout=None, deadline=None):
+        """
+        Passes the body following the last head to send, piece by piece
+        as framer delimits it, until framer is done. Bytes past the
+        body stay buffered. Each read waits up to timeout, and none past
+        deadline; socket.timeout is raised when either runs out.
+        """
+        while not framer.done:
+            if self.start == self.end:
+                self.start = self.end = self.scanned = 0
+                self.conn.settimeout(time_left(deadline, timeout))
+                self.end = self.conn.recv_into(self.view)
+                if not self.end:
+                    raise ConnectionError("client closed in the middle of the request body")
+            used = framer.feed(self.buffer, self.start, self.end)
+            send(self.view[self.start:self.start + used])
+            self.start += used
+            self.scanned = max(self.scanned, self.start)
+
+    def compact(self):
+        """
+        Moves the unread bytes to the front of the buffer so the next
+        recv_into has room.
+        """
+        if self.start == 0:
+            return
+        unread = self.end - self.start
+        self.buffer[:unread] = self.view[self.start:self.end].tobytes()
+        self.scanned -= self.start
+        self.start = 0
+        self.end = unread
+
+
+class RequestBody(object):
+    """
+    The body of a client request, streamed to the origin while it is
+    read from the client; none of it is kept, so it can be sent only
+    once.
+    """
+
+    def __init__(self, reader: ClientReader, framer, expect_continue=False, timeout=None,
+                 deadline=None):
+        self.reader = reader
+        self.framer = framer
+        self.expect_continue = expect_continue
+        self.timeout = timeout
+        self.deadline = deadline
+        self.started = False
+
+    @staticmethod
+    def for_request(reader, request_info: HttpRequestInfo, timeout=None):
+        """
+        The body that follows request_info on the connection, or None.
+        """
+        framer = BodyFramer.for_request(request_info.headers)
+        if framer.done:
+            return None
+        return RequestBody(reader, framer, expects_continue(request_info), timeout,
+                           request_info.deadline)
+
+    def send_to(self, socket_server: socket.socket):
+        """
+        Raises RequestTimeout if the client stalls for longer than
+        timeout, or past the deadline, and MalformedRequestBody if the
+        framer rejects the body; the bad part isn't forwarded.
+        """
+        self.started = True
+        if self.expect_continue:
+            self.reader.conn.sendall(CONTINUE_RESPONSE)
+
+        def forward(data):
+            try:
+                socket_server.sendall(data)
+            except socket.timeout:
+                raise UpstreamTimeout("origin stopped taking the request body")
+            except OSError as e:
+                raise UpstreamError("sending the request body failed: %s" % e)
+        try:
+            self.reader.relay_body(self.framer, forward, self.timeout, self.deadline)
+        except socket.timeout:
+            raise RequestTimeout()
+        except ValueError as e:
+            raise MalformedRequestBody(str(e))
+
+
+# Sent to a client waiting for permission to send its body; the origin
+# gets the request without the Expect header.
+CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
+
+
+def expects_continue(request_info: HttpRequestInfo):
+    expect = get_header(request_info.headers, "Expect") or ""
+    return expect.lower() == "100-continue" and \
+        request_info.http_version.upper() == "HTTP/1.1"
+
+
+def client_keeps_alive(request_info: HttpRequestInfo):
+    connection = (get_header(request_info.headers, "Connection") or
+                  get_header(request_info.headers, "Proxy-Connection") or "").lower()
+    if "close" in connection:
+        return False
+    return request_info.http_version.upper() == "HTTP/1.1" or "keep-alive" in connection
+
+
+def serve_request(conn: socket.socket, request_info: HttpRequestInfo,
+                  context: ProxyContext, body=None):
+    now = time.time()
+    entry = None
+    if request_info.method in CACHEABLE_METHODS:
+        entry = lookup_response(context.cache, request_info)
+    if entry is not None and can_serve_cached(request_info, entry, now) and \
+            send_entry(conn, compressed_variant(context, request_info, entry),
+                       request_info, now):
+        request_info.cache_result = "HIT"
+    else:
+        request_info.display()
+        request_info.cache_result = "MISS" if entry is not None or \
+            request_info.method in CACHEABLE_METHODS else "BYPASS"
+        fetch_coalesced(conn, request_info, context, entry, body)
+
+
+# Buffers handed to one sendmsg call; far below any system's IOV_MAX.
+SENDMSG_MAX_BUFFERS = 64
+
+
+def send_entry(conn: socket.socket, entry, request_info: HttpRequestInfo, now):
+    """
+    Answers request_info from a cached entry; the body of a disk-backed
+    entry goes out with sendfile. A range request gets the 206 or 416
+    of requested_span(). Returns False, having sent nothing, if that
+    body is no longer on disk.
+    """
+    span = requested_span(request_info, entry)
+    request_info.status = entry.status_for(span)
+    if entry.body is not None or request_info.method == "HEAD":
+        buffers = entry.buffers_for(request_info, now, span)
+        send_buffers(conn, buffers)
+        request_info.response_bytes = sum(len(buffer) for buffer in buffers)
+        return True
+    f = open_cached_body(entry.body_file)
+    if f is None:
+        return False
+    (start, end) = span or (0, entry.body_length)
+    with f:
+        buffers = entry.buffers(now, request_info.keep_alive, False, span)
+        send_buffers(conn, buffers)
+        if end > start:
+            conn.sendfile(f, f.tell() + start, end - start)
+    request_info.response_bytes = sum(len(buffer) for buffer in buffers) + end - start
+    return True
+
+
+def send_buffers(conn: socket.socket, buffers: list):
+    """
+    Sends the buffers in order without joining them: one sendmsg call
+    hands them all to the kernel, and is repeated for the rest after
+    a partial write.
+    """
+    if not hasattr(conn, "sendmsg"):
+        for buffer in buffers:
+            conn.sendall(buffer)
+        return
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    first = 0
+    while first < len(views):
+        sent = conn.sendmsg(views[first:first + SENDMSG_MAX_BUFFERS])
+        while sent and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+def fetch_coalesced(conn: socket.socket, request_info: HttpRequestInfo,
+                    context: ProxyContext, entry=None, body=None):
+    """
+    Fetches a missed or stale object so that, of all the clients
+    missing on the same key at once, only one goes to the origin.
+
+    The others wait for that fetch and are then served from the
+    cache. If the response turned out not to be cacheable, or the
+    wait times out, they fetch on their own; if the origin failed,
+    they all get a 502.
+
+    A range request that missed is fetched on its own: the 206 it
+    gets can't be stored for anyone else.
+    """
+    if request_info.method not in CACHEABLE_METHODS or body is not None or \
+            get_header(request_info.headers, "Range") is not None:
+        fetch_response(conn, request_info, context,
+                       revalidation_candidate(request_info, entry), body)
+        return
+
+    key = cache_key(request_info)
+    (flight, leader) = context.flights.begin(key)
+    if leader:
+        try:
+            result = fetch_response(conn, request_info, context,
+                                    revalidation_candidate(request_info, entry))
+        except UpstreamError as e:
+            context.flights.finish(key, flight, error=e)
+            raise
+        except BaseException:
+            context.flights.finish(key, flight)
+            raise
+        context.flights.finish(key, flight, result)
+        return
+
+    try:
+        completed = flight.wait(context.config.coalesce_timeout)
+    except UpstreamError as e:
+        send_gateway_error(conn, request_info, e)
+        return
+    if completed:
+        now = time.time()
+        entry = lookup_response(context.cache, request_info)
+        # the leader's own result was validated just now
+        if entry is not None and (entry is flight.result or
+                                  can_serve_cached(request_info, entry, now)) and \
+                send_entry(conn, compressed_variant(context, request_info, entry),
+                           request_info, now):
+            request_info.cache_result = "COALESCED"
+            return
+    fetch_response(conn, request_info, context,
+                   revalidation_candidate(request_info, entry))
+
+
+def fetch_response(conn: socket.socket, request_info: HttpRequestInfo,
+                   context: ProxyContext, stale_entry=None, body=None):
+    """
+    Sends the request to the origin and streams the answer to the
+    client, storing it when it is cacheable. Returns the stored
+    CacheEntry, or None.
+
+    If stale_entry is given the request is made conditional on its
+    validators, and a 304 answer refreshes and serves the stored copy
+    instead of downloading the body again.
+
+    A request body is streamed from the client to the origin. A
+    successful unsafe method drops the cached copies of its URL.
+
+    A URL owned by a peer is fetched through that peer and not stored
+    here; if the peer fails before answering, it is marked down and
+    the fetch is made again without it.
+
+    The client gets a 503 when the origin is at its origin_concurrency
+    cap for longer than admission_wait.
+
+    A 206 answering a range request may start a background fill of
+    the whole object (see start_range_fill).
+
+    Raises UpstreamError when the origin can't be reached or breaks
+    off; the client gets a 502 if nothing was sent to it yet.
+    """
+    cache = context.cache
+    if stale_entry is not None:
+        add_conditional_headers(request_info, stale_entry)
+    peer = owning_peer(context, request_info, stale_entry, body)
+    if peer is None:
+        packet = upstream_request_bytes(request_info, context.config.upstream_keepalive, body)
+        origin = (request_info.requested_host, request_info.requested_port)
+    else:
+        packet = upstream_request_bytes(request_info, context.config.upstream_keepalive,
+                                        peer_self=context.peers.self_node)
+        origin = peer
+    slots = context.origin_slots
+    if slots is not None and not slots.acquire(origin, context.config.admission_wait):
+        context.metrics.count(("admission_rejected", (("reason", "origin_busy"),)))
+        send_request_error(conn, request_info, HttpErrorCodes.SERVICE_UNAVAILABLE,
+                           "Service Unavailable")
+        if body is not None and not body.framer.done:
+            discard_input(conn)
+        return None
+    upstream = None
+    spool = None
+    entry = None
+    peer_failed = False
+    try:
+        (upstream, request_time) = open_upstream(context, origin, packet,
+                                                 request_info.method, body,
+                                                 request_info.deadline)
+        response_time = time.time()
+        request_info.upstream_time = response_time - request_time
+        context.metrics.observe("first_byte", request_info.upstream_time)
+        if request_info.method not in SAFE_METHODS and upstream.status < 400:
+            invalidate_responses(cache, request_info)
+
+        if stale_entry is not None and upstream.status == 304:
+            upstream.relay(None)
+            entry = stale_entry.revalidated(upstream.headers, request_time, response_time)
+            store_response(cache, request_info, entry)
+            request_info.cache_result = "REVALIDATED"
+            if not send_entry(conn, compressed_variant(context, request_info, entry),
+                              request_info, response_time):
+                send_request_error(conn, request_info, HttpErrorCodes.BAD_GATEWAY,
+                                   "Bad Gateway")
+            return entry
+
+        if peer is None and \
+                is_cacheable_response(request_info, upstream.status, upstream.headers):
+            spool = response_spool(cache, request_info, upstream.status_line,
+                                   upstream.status, upstream.headers, request_time,
+                                   response_time)
+        if peer is None:
+            start_range_fill(context, request_info, upstream.status, upstream.headers)
+        encoder = stream_encoder(context, request_info, upstream.status, upstream.headers)
+        relay_started = time.monotonic()
+        upstream.relay(conn, spool, request_info, encoder,
+                       relayed_headers(context, request_info, upstream.status,
+                                       upstream.headers))
+        context.metrics.observe("relay", time.monotonic() - relay_started)
+        if spool is not None:
+            entry = spool.finish()
+        if peer is not None:
+            request_info.cache_result = "PEER"
+    except UpstreamError as e:
+        if upstream is not None and upstream.started:
+            raise
+        if peer is None:
+            send_gateway_error(conn, request_info, e)
+            raise
+        log.warning("Fetch through peer %s failed: %s", format_node(peer), e)
+        context.peers.mark_down(peer)
+        peer_failed = True
+    except RequestTimeout:
+        # nothing was received from the origin yet
+        send_request_error(conn, request_info, HttpErrorCodes.REQUEST_TIMEOUT,
+                           "Request Timeout")
+        return None
+    except MalformedRequestBody:
+        # as above; the unread rest of the body closes the connection
+        send_request_error(conn, request_info, HttpErrorCodes.BAD_REQUEST, "Bad Request")
+        return None
+    finally:
+        if upstream is not None:
+            release_upstream(context, origin, upstream)
+        if spool is not None:
+            spool.close()
+        if slots is not None:
+            slots.release(origin)
+
+    if peer_failed:
+        return fetch_response(conn, request_info, context, stale_entry, body)
+    if entry is None:
+        return None
+    store_response(cache, request_info, entry)
+    return entry
+
+
+def gateway_error(e: Exception):
+    """
+    The (code, message) answering a failed fetch: 504 when the origin
+    was too slow, 502 otherwise.
+    """
+    if isinstance(e, UpstreamTimeout):
+        return HttpErrorCodes.GATEWAY_TIMEOUT, "Gateway Timeout"
+    return HttpErrorCodes.BAD_GATEWAY, "Bad Gateway"
+
+
+def send_gateway_error(conn: socket.socket, request_info: HttpRequestInfo, e: Exception):
+    (code, message) = gateway_error(e)
+    send_request_error(conn, request_info, code, message)
+
+
+# Methods that may be sent again when a reused connection turns out
+# to have been closed by the origin.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+# Methods that don't change the resource (RFC 9110 section 9.2.1); the
+# others invalidate what the cache holds for their URL.
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+
+def upstream_request_bytes(request_info: HttpRequestInfo, keep_alive, body=None,
+                           peer_self=None):
+    """
+    The request as sent to the origin: the client's hop-by-hop
+    headers are dropped, and with keep_alive it is sent as HTTP/1.1
+    asking to keep the connection open. A chunked body is forwarded
+    with its chunks as they are, so it keeps Transfer-Encoding.
+
+    With peer_self the request is meant for a peer proxy instead: its
+    target is the absolute URL and it names peer_self in PEER_HEADER.
+    """
+    chunked = body is not None and body.framer.mode == BodyFramer.CHUNKED
+    headers = [header for header in request_info.headers
+               if header[0].lower() not in HOP_BY_HOP_HEADERS
+               and header[0].lower() not in ("expect", "x-proxy-peer")
+               and not (chunked and header[0].lower() == "content-length")]
+    if chunked:
+        headers.append(["Transfer-Encoding", "chunked"])
+    path = request_info.requested_path
+    if peer_self is not None:
+        headers.append([PEER_HEADER, peer_self])
+        path = "http://%s%s" % (format_node((request_info.requested_host,
+                                             request_info.requested_port)), path)
+    if keep_alive:
+        http_version = "HTTP/1.1"
+        headers.append(["Connection", "keep-alive"])
+    else:
+        http_version = "HTTP/1.0"
+    upstream = HttpRequestInfo(request_info.client_address_info, request_info.method,
+                               request_info.requested_host, request_info.requested_port,
+                               path, headers)
+    return upstream.to_http_string(http_version).encode("iso-8859-1")
+
+
+def connect_upstream(context: ProxyContext, origin, deadline=None):
+    """
+    Raises UpstreamTimeout if resolving and connecting take longer than
+    connect_timeout or go past deadline.
+    """
+    config = context.config
+    try:
+        started = time.monotonic()
+        addresses = context.resolver.resolve(origin[0], origin[1])
+        resolved = time.monotonic()
+        context.metrics.observe("dns", resolved - started)
+        conn = connect_racing(addresses, config.happy_eyeballs_delay,
+                              time_left(deadline, config.connect_timeout))
+        context.metrics.observe("connect", time.monotonic() - resolved)
+        return conn
+    except (socket.timeout, TimeoutError) as e:
+        raise UpstreamTimeout("timed out reaching %s:%s: %s" % (origin[0], origin[1], e))
+    except OSError as e:
+        raise UpstreamError("cannot reach %s:%s: %s" % (origin[0], origin[1], e))
+
+
+async def async_connect_upstream(context: ProxyContext, origin, deadline=None):
+    """
+    asyncio counterpart of connect_upstream; returns (reader, writer).
+    """
+    config = context.config
+    try:
+        started = time.monotonic()
+        addresses = await context.resolver.async_resolve(origin[0], origin[1])
+        resolved = time.monotonic()
+        context.metrics.observe("dns", resolved - started)
+        sock = await asyncio.wait_for(
+            async_connect_racing(addresses, config.happy_eyeballs_delay),
+            time_left(deadline, config.connect_timeout))
+        context.metrics.observe("connect", time.monotonic() - resolved)
+        return await asyncio.open_connection(sock=sock)
+    except (socket.timeout, asyncio.TimeoutError, TimeoutError) as e:
+        raise UpstreamTimeout("timed out reaching %s:%s: %s" % (origin[0], origin[1], e))
+    except OSError as e:
+        raise UpstreamError("cannot reach %s:%s: %s" % (origin[0], origin[1], e))
+
+
+def interleave_families(addresses: list):
+    """
+    Orders addresses so the families alternate, starting with the
+    first one the resolver returned (RFC 8305 section 4).
+    """
+    if not addresses:
+        return []
+    first = [address for address in addresses if address[0] == addresses[0][0]]
+    other = [address for address in addresses if address[0] != addresses[0][0]]
+    ordered = []
+    for i in range(max(len(first), len(other))):
+        ordered.extend(first[i:i + 1] + other[i:i + 1])
+    return ordered
+
+
+def connect_racing(addresses: list, delay, timeout):
+    """
+    Happy-eyeballs connect: tries the addresses in turn, starting the
+    next attempt when the previous one fails or has not connected
+    within delay, and returns the first socket that connects (in
+    blocking mode). The losing attempts are closed.
+    """
+    addresses = interleave_families(addresses)
+    selector = selectors.DefaultSelector()
+    attempts = []
+    deadline = time.monotonic() + timeout
+    next_start = 0
+    last_error = None
+    try:
+        while True:
+            now = time.monotonic()
+            if addresses and (now >= next_start or not attempts):
+                (family, sockaddr) = addresses.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setblocking(False)
+                error = sock.connect_ex(sockaddr)
+                if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    last_error = OSError(error, os.strerror(error))
+                    sock.close()
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE)
+                attempts.append(sock)
+                next_start = now + delay
+                continue
+            if not attempts:
+                raise last_error or OSError("no address to connect to")
+            if now >= deadline:
+                raise socket.timeout("connect timed out")
+            wait = deadline - now
+            if addresses:
+                wait = min(wait, next_start - now)
+            for (key, _) in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                attempts.remove(sock)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0:
+                    sock.setblocking(True)
+                    return sock
+                last_error = OSError(error, os.strerror(error))
+                sock.close()
+                next_start = 0  # a failure starts the next attempt right away
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
+
+
+async def async_connect_racing(addresses: list, delay):
+    """
+    asyncio counterpart of connect_racing; returns a non-blocking
+    socket.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def attempt(family, sockaddr):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, sockaddr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    addresses = interleave_families(addresses)
+    attempts = set()
+    last_error = None
+    try:
+        while True:
+            timeout = None
+            if addresses:
+                attempts.add(asyncio.ensure_future(attempt(*addresses.pop(0))))
+                timeout = delay
+            elif not attempts:
+                raise last_error or OSError("no address to connect to")
+            (done, attempts) = await asyncio.wait(attempts, timeout=timeout,
+                                                  return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in done:
+                        if other is not task and other.exception() is None:
+                            other.result().close()
+                    return task.result()
+                last_error = task.exception()
+    finally:
+        for task in attempts:
+            task.cancel()
+        for result in await asyncio.gather(*attempts, return_exceptions=True):
+            if isinstance(result, socket.socket):
+                result.close()
+
+
+def open_upstream(context: ProxyContext, origin, packet: bytes, method, body=None,
+                  deadline=None, pool=None):
+    """
+    Sends packet, then body if given, on an idle pooled connection to
+    the origin, or a new one, and reads the response head. Returns
+    (OriginResponse, time the request was sent). The connection comes
+    from pool, context's upstream_pool by default.
+
+    A pooled connection can be closed by the origin at any moment, so
+    an idempotent request that fails on one is retried once on a
+    fresh connection, unless part of its body was already consumed.
+    An origin that doesn't answer within first_byte_timeout, or by
+    deadline, raises UpstreamTimeout and is not retried.
+    """
+    timeout = context.config.first_byte_timeout
+    if pool is None:
+        pool = context.upstream_pool
+    socket_server = pool.checkout(origin)
+    while True:
+        reused = socket_server is not None
+        if not reused:
+            socket_server = connect_upstream(context, origin, deadline)
+        upstream = OriginResponse(socket_server, method, timeout, deadline)
+        try:
+            request_time = time.time()
+            try:
+                socket_server.settimeout(time_left(deadline, timeout))
+                socket_server.sendall(packet)
+            except socket.timeout:
+                raise UpstreamTimeout("origin stopped taking the request")
+            except OSError as e:
+                raise UpstreamError("sending to origin failed: %s" % e)
+            if body is not None:
+                body.send_to(socket_server)
+            upstream.read_head()
+            return upstream, request_time
+        except UpstreamError as e:
+            upstream.close()
+            socket_server.close()
+            if not reused or method not in IDEMPOTENT_METHODS or \
+                    isinstance(e, UpstreamTimeout) or (body is not None and body.started):
+                raise
+        except BaseException:
+            upstream.close()
+            socket_server.close()
+            raise
+        socket_server = None
+
+
+def release_upstream(context: ProxyContext, origin, upstream, pool=None):
+    upstream.close()
+    if pool is None:
+        pool = context.upstream_pool
+    if upstream.reusable():
+        pool.checkin(origin, upstream.socket_server)
+    else:
+        upstream.socket_server.close()
+
+
+# Answer to a CONNECT request once the origin connection is open.
+CONNECT_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+
+
+def connect_allowed(config: ProxyConfig, request_info: HttpRequestInfo):
+    return config.connect_ports is None or request_info.requested_port in config.connect_ports
+
+
+def open_tunnel(conn: socket.socket, reader: ClientReader,
+                request_info: HttpRequestInfo, context: ProxyContext):
+    """
+    Answers a CONNECT request: opens the origin connection and hands
+    both sockets to the tunnel relay, along with anything the client
+    sent early. Returns True once conn belongs to the relay.
+    """
+    if not connect_allowed(context.config, request_info):
+        request_info.status = HttpErrorCodes.FORBIDDEN.value
+        send_error_response(conn, HttpErrorCodes.FORBIDDEN, "Forbidden")
+        return False
+    try:
+        socket_server = connect_upstream(context, (request_info.requested_host,
+                                                   request_info.requested_port),
+                                         request_info.deadline)
+    except UpstreamError as e:
+        log.info("%s", e)
+        send_gateway_error(conn, request_info, e)
+        return False
+    request_info.status = 200
+    try:
+        conn.sendall(CONNECT_ESTABLISHED)
+        if reader.buffered():
+            socket_server.sendall(reader.read(reader.buffered()))
+    except OSError:
+        socket_server.close()
+        return False
+    context.tunnels.add(conn, socket_server)
+    return True
+
+
+# How often the tunnel relay wakes up to close idle tunnels.
+TUNNEL_POLL_INTERVAL = 1.0
+
+
+class TunnelRelay(object):
+    """
+    Relays the bytes of CONNECT tunnels for the threaded engine. All
+    tunnels share one selector thread, so an open tunnel costs its two
+    sockets and a buffer instead of a worker. Where os.splice exists
+    (Linux) the bytes go through a pipe and never reach user space.
+
+    Each direction is half-closed on its own when its sender finishes;
+    a tunnel is closed once both are, on an error, or after
+    idle_timeout seconds without data.
+    """
+
+    def __init__(self, idle_timeout=300.0, use_splice=None):
+        if use_splice is None:
+            use_splice = hasattr(os, "splice")
+        self.idle_timeout = idle_timeout
+        self.use_splice = use_splice
+        self.selector = selectors.DefaultSelector()
+        self.tunnels = set()
+        self.added = queue.Queue()
+        (self.wakeup_r, self.wakeup_w) = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def add(self, client: socket.socket, server: socket.socket):
+        with self.lock:
+            if self.closed:
+                client.close()
+                server.close()
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.added.put((client, server))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wakeup_w.send(b"x")
+        except OSError:     # already has a wakeup pending
+            pass
+
+    def run(self):
+        next_expiry = time.monotonic() + TUNNEL_POLL_INTERVAL
+        while not self.closed:
+            for (key, mask) in self.selector.select(TUNNEL_POLL_INTERVAL):
+                tunnel = key.data
+                if tunnel is None:
+                    self.drain_wakeups()
+                    continue
+                tunnel.handle(key.fileobj, mask)
+                if tunnel.closed:
+                    self.tunnels.discard(tunnel)
+            self.start_added()
+            now = time.monotonic()
+            if now >= next_expiry:
+                self.expire_idle(now)
+                next_expiry = now + TUNNEL_POLL_INTERVAL
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def start_added(self):
+        while True:
+            try:
+                (client, server) = self.added.get_nowait()
+            except queue.Empty:
+                return
+            self.tunnels.add(Tunnel(self.selector, client, server, self.use_splice))
+
+    def expire_idle(self, now):
+        for tunnel in list(self.tunnels):
+            if now - tunnel.last_active > self.idle_timeout:
+                tunnel.close()
+                self.tunnels.discard(tunnel)
+
+    def close_all(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            thread = self.thread
+        self.wake()
+        if thread is not None:
+            thread.join()
+        self.start_added()
+        for tunnel in self.tunnels:
+            tunnel.close()
+        self.tunnels.clear()
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def stats(self):
+        return {"open": len(self.tunnels)}
+
+
+class TunnelDirection(object):
+    """
+    One direction of a tunnel: bytes read from src wait in a buffer,
+    or a pipe when splicing, until dst takes them. Nothing more is
+    read while any are pending.
+    """
+
+    def __init__(self, src: socket.socket, dst: socket.socket, use_splice):
+        self.src = src
+        self.dst = dst
+        self.use_splice = use_splice
+        self.pending = 0
+        self.eof = False    # src has finished sending
+        self.done = False   # ... and dst was told so
+        if use_splice:
+            (self.pipe_r, self.pipe_w) = os.pipe()
+        else:
+            self.buffer = bytearray(RELAY_BUFFER_SIZE)
+            self.view = memoryview(self.buffer)
+            self.start = 0
+
+    def wants_read(self):
+        return not self.eof and self.pending == 0
+
+    def wants_write(self):
+        return self.pending > 0
+
+    def pump(self):
+        try:
+            if self.use_splice:
+                n = os.splice(self.src.fileno(), self.pipe_w, RELAY_BUFFER_SIZE,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                n = self.src.recv_into(self.view)
+                self.start = 0
+        except (BlockingIOError, InterruptedError):
+            return
+        if n == 0:
+            self.eof = True
+        self.pending = n
+        self.flush()
+
+    def flush(self):
+        while self.pending:
+            try:
+                if self.use_splice:
+                    n = os.splice(self.pipe_r, self.dst.fileno(), self.pending,
+                                  flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                else:
+                    n = self.dst.send(self.view[self.start:self.start + self.pending])
+                    self.start += n
+            except (BlockingIOError, InterruptedError):
+                break
+            self.pending -= n
+        if self.eof and not self.pending and not self.done:
+            self.done = True
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.use_splice:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+
+
+class Tunnel(object):
+    """
+    A CONNECT tunnel registered with the relay's selector; each socket
+    is watched for reading while its direction can take more bytes and
+    for writing while the other direction has bytes pending.
+    """
+
+    def __init__(self, selector, client: socket.socket, server: socket.socket, use_splice):
+        client.setblocking(False)
+        server.setblocking(False)
+        self.selector = selector
+        self.client = client
+        self.server = server
+        self.to_server = TunnelDirection(client, server, use_splice)
+        self.to_client = TunnelDirection(server, client, use_splice)
+        self.events = {client: 0, server: 0}
+        self.closed = False
+        self.last_active = time.monotonic()
+        self.update()
+
+    def handle(self, sock, mask):
+        if self.closed:
+            return
+        (reading, writing) = (self.to_server, self.to_client) if sock is self.client \
+            else (self.to_client, self.to_server)
+        try:
+            if mask & selectors.EVENT_WRITE:
+                writing.flush()
+            if mask & selectors.EVENT_READ:
+                reading.pump()
+        except OSError:
+            self.close()
+            return
+        self.last_active = time.monotonic()
+        if self.to_server.done and self.to_client.done:
+            self.close()
+        else:
+            self.update()
+
+    def update(self):
+        for (sock, reading, writing) in ((self.client, self.to_server, self.to_client),
+                                         (self.server, self.to_client, self.to_server)):
+            events = (selectors.EVENT_READ if reading.wants_read() else 0) | \
+                (selectors.EVENT_WRITE if writing.wants_write() else 0)
+            if events == self.events[sock]:
+                continue
+            if not events:
+                self.selector.unregister(sock)
+            elif not self.events[sock]:
+                self.selector.register(sock, events, self)
+            else:
+                self.selector.modify(sock, events, self)
+            self.events[sock] = events
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for sock in (self.client, self.server):
+            if self.events[sock]:
+                self.selector.unregister(sock)
+            sock.close()
+        self.to_server.close()
+        self.to_client.close()
+
+
+class UpstreamError(Exception):
+    """
+    The origin could not be reached or sent a broken response.
+    """
+    pass
+
+
+class UpstreamTimeout(UpstreamError):
+    """
+    The origin could not be reached, or didn't answer, in time.
+    """
+    pass
+
+
+# Size of the buffer each relay reuses for every read from the origin.
+RELAY_BUFFER_SIZE = 64 * 1024
+
+
+class OriginResponse(object):
+    """
+    A response being read from the origin through one reusable buffer.
+
+    read_head() reads and parses the status line and headers; relay()
+    then streams the head and body to the client. Nothing is sent to
+    the client before relay(), so the caller can look at the status
+    first (e.g. to handle a 304 itself).
+    """
+
+    def __init__(self, socket_server: socket.socket, method="GET", timeout=None,
+                 deadline=None):
+        self.socket_server = socket_server
+        self.method = method
+        self.timeout = timeout      # for each read
+        self.deadline = deadline
+        self.buffer = bytearray(RELAY_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.filled = 0
+        self.head_end = 0
+        self.status_line = None
+        self.status = None
+        self.headers = None
+        self.started = False    # whether anything was sent to the client
+        self.complete = False   # whole message read, nothing left over
+
+    def receive(self, view):
+        try:
+            self.socket_server.settimeout(time_left(self.deadline, self.timeout))
+            return self.socket_server.recv_into(view)
+        except socket.timeout:
+            raise UpstreamTimeout("origin did not answer in time")
+        except OSError as e:
+            raise UpstreamError("reading from origin failed: %s" % e)
+
+    def read_head(self):
+        """
+        Reads the final response head; interim 1xx responses (other than
+        101) are skipped.
+        """
+        while True:
+            self.read_one_head()
+            if not 100 <= self.status < 200 or self.status == 101:
+                return
+            rest = self.filled - self.head_end
+            self.buffer[:rest] = self.view[self.head_end:self.filled].tobytes()
+            self.filled = rest
+            self.head_end = 0
+
+    def read_one_head(self):
+        search_from = 0
+        while True:
+            head_end = self.buffer.find(b"\r\n\r\n", search_from, self.filled)
+            if head_end >= 0:
+                self.head_end = head_end + 4
+                break
+            search_from = max(0, self.filled - 3)
+            if self.filled == len(self.buffer):
+                raise UpstreamError("response head larger than the relay buffer")
+            n = self.receive(self.view[self.filled:])
+            if n == 0:
+                raise UpstreamError("origin closed before sending a response")
+            self.filled += n
+
+        head = bytes(self.view[:self.head_end])
+        try:
+            (self.status, self.headers) = parse_response_head(head)
+        except (IndexError, ValueError):
+            raise UpstreamError("malformed response head from origin")
+        self.status_line = head[:head.index(b"\r\n")].decode("iso-8859-1")
+
+    def relay(self, conn: socket.socket, spool=None, client_request=None, encoder=None,
+              client_headers=None):
+        """
+        Forwards the head and body to conn as they arrive; with conn
+        None the message is read and dropped.
+
+        The head is rewritten for client_request's connection. A body
+        that can only end with the connection, or a chunked body sent
+        to an HTTP/1.0 client (forwarded decoded), clears its
+        keep_alive. With an encoder the body is sent compressed, and
+        what spool gets is still the origin's. Otherwise the head
+        carries client_headers if given, the origin's headers if not.
+
+        The body is also written to spool (a BodySpool) if one is
+        given. client_request's status and response_bytes are kept up
+        to date as the response is sent.
+        """
+        buffer = self.buffer
+        view = self.view
+
+        framer = BodyFramer.for_response(self.status, self.headers, self.method)
+        dechunk = framer.mode == BodyFramer.CHUNKED and (encoder is not None or (
+            client_request is not None and client_request.http_version.upper() != "HTTP/1.1"))
+        spans = [] if dechunk else None
+        try:
+            used = framer.feed(buffer, self.head_end, self.filled, spans)
+        except ValueError:
+            raise UpstreamError("malformed chunked body from origin")
+        leftover = self.head_end + used < self.filled
+
+        if encoder is not None:
+            keep_alive = client_request.keep_alive and encoder.chunked
+        else:
+            keep_alive = client_request is not None and client_request.keep_alive and \
+                framer.mode != BodyFramer.UNTIL_EOF and not dechunk
+        if client_request is not None:
+            client_request.keep_alive = keep_alive
+        if conn is not None:
+            self.started = True
+            if encoder is None:
+                head = client_response_head(self.status_line, client_headers or self.headers,
+                                            keep_alive, dechunk)
+            else:
+                head = client_response_head(self.status_line, encoder.headers(self.headers),
+                                            keep_alive)
+            conn.sendall(head)
+            sent = len(head) + send_spans(conn, view, self.head_end, self.head_end + used,
+                                          spans, encoder)
+            if client_request is not None:
+                client_request.status = self.status
+                client_request.response_bytes = sent
+        if spool is not None:
+            spool.write(view[self.head_end:self.head_end + used])
+
+        while not framer.done:
+            n = self.receive(view)
+            if n == 0:
+                if framer.mode == BodyFramer.UNTIL_EOF:
+                    break
+                raise UpstreamError("origin closed in the middle of a response")
+            try:
+                used = framer.feed(buffer, 0, n, spans)
+            except ValueError:
+                raise UpstreamError("malformed chunked body from origin")
+            leftover = used < n
+            if conn is not None:
+                sent = send_spans(conn, view, 0, used, spans, encoder)
+                if client_request is not None:
+                    client_request.response_bytes += sent
+            if spool is not None:
+                spool.write(view[:used])
+        if encoder is not None and conn is not None:
+            tail = encoder.finish()
+            conn.sendall(tail)
+            if client_request is not None:
+                client_request.response_bytes += len(tail)
+
+        self.complete = framer.mode != BodyFramer.UNTIL_EOF and not leftover
+
+    def reusable(self):
+        """
+        Whether the connection can carry another request.
+        """
+        return self.complete and origin_keeps_alive(self.status_line, self.headers)
+
+    def close(self):
+        self.view.release()
+
+
+def client_response_head(status_line, headers: list, keep_alive, dechunk=False):
+    """
+    The origin's response head as sent to the client: the origin's
+    hop-by-hop headers are replaced by our own Connection header.
+    Transfer-Encoding stays unless the body is forwarded decoded.
+    """
+    lines = [status_line]
+    for (name, value) in headers:
+        lower = name.lower()
+        if lower in HOP_BY_HOP_HEADERS and (lower != "transfer-encoding" or dechunk):
+            continue
+        lines.append(name + ": " + value)
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+
+def send_spans(conn: socket.socket, view: memoryview, start, end, spans, encoder=None):
+    """
+    Sends view[start:end], or only the listed (start, end) spans of it
+    when spans is given; spans is emptied for the next read. With an
+    encoder, what is sent is their compressed form. Returns the number
+    of bytes sent.
+    """
+    if encoder is not None:
+        data = encoder.encode(encoded_pieces(view, start, end, spans))
+        if data:
+            conn.sendall(data)
+        return len(data)
+    if spans is None:
+        if end > start:
+            conn.sendall(view[start:end])
+        return max(0, end - start)
+    sent = 0
+    for (span_start, span_end) in spans:
+        conn.sendall(view[span_start:span_end])
+        sent += span_end - span_start
+    del spans[:]
+    return sent
+
+
+def origin_keeps_alive(status_line, headers: list):
+    connection = (get_header(headers, "Connection") or "").lower()
+    if "close" in connection:
+        return False
+    return status_line.upper().startswith("HTTP/1.1") or "keep-alive" in connection
+
+
+class BodyFramer(object):
+    """
+    Finds where an HTTP message body ends while its bytes are relayed,
+    without buffering the body.
+
+    The body is delimited by Content-Length, by the chunked
+    transfer-coding, or (for responses without either) by the origin
+    closing the connection. feed() returns how many of the given
+    bytes belong to this message; anything past that is not ours.
+    """
+
+    NO_BODY = 0
+    LENGTH = 1
+    CHUNKED = 2
+    UNTIL_EOF = 3
+
+    # states of the chunked parser
+    CHUNK_SIZE = 0
+    CHUNK_DATA = 1
+    CHUNK_DATA_END = 2
+    CHUNK_TRAILER = 3
+
+    def __init__(self, mode, length=0):
+        self.mode = mode
+        self.remaining = length
+        self.done = mode == BodyFramer.NO_BODY or \
+            (mode == BodyFramer.LENGTH and length == 0)
+        self.chunk_state = BodyFramer.CHUNK_SIZE
+        self.line = bytearray()
+
+    @staticmethod
+    def for_response(status, headers, method):
+        if method == "HEAD" or 100 <= status < 200 or status in (204, 304):
+            return BodyFramer(BodyFramer.NO_BODY)
+        return BodyFramer.for_headers(headers, BodyFramer.UNTIL_EOF)
+
+    @staticmethod
+    def for_request(headers):
+        return BodyFramer.for_headers(headers, BodyFramer.NO_BODY)
+
+    @staticmethod
+    def for_headers(headers, default_mode):
+        codings = transfer_codings(headers)
+        if codings:
+            # codings that don't end in chunked run until the connection
+            # closes; requests like that are refused by scan_http_request
+            return BodyFramer(BodyFramer.CHUNKED if codings[-1] == "chunked"
+                              else BodyFramer.UNTIL_EOF)
+        length = content_length(headers)
+        if length is not None:
+            return BodyFramer(BodyFramer.LENGTH, length)
+        return BodyFramer(default_mode)
+
+    def feed(self, data, start, end, spans=None):
+        """
+        For chunked bodies, the (start, end) offsets of the chunk data
+        (without the framing) are appended to spans if it is given.
+        """
+        if self.done:
+            return 0
+        if self.mode == BodyFramer.UNTIL_EOF:
+            return end - start
+        if self.mode == BodyFramer.LENGTH:
+            take = min(self.remaining, end - start)
+            self.remaining -= take
+            self.done = self.remaining == 0
+            return take
+        return self.feed_chunked(data, start, end, spans)
+
+    def feed_chunked(self, data, start, end, spans=None):
+        pos = start
+        while pos < end and not self.done:
+            if self.chunk_state == BodyFramer.CHUNK_DATA:
+                take = min(self.remaining, end - pos)
+                if spans is not None:
+                    spans.append((pos, pos + take))
+                pos += take
+                self.remaining -= take
+                if self.remaining == 0:
+                    self.chunk_state = BodyFramer.CHUNK_DATA_END
+                continue
+
+            newline = data.find(b"\n", pos, end)
+            if newline < 0:
+                self.line += data[pos:end]
+                if len(self.line) > MAX_CHUNK_LINE:
+                    raise ValueError("chunk header line too long")
+                return end - start
+            self.line += data[pos:newline]
+            pos = newline + 1
+            line = bytes(self.line).strip()
+            self.line = bytearray()
+
+            if self.chunk_state == BodyFramer.CHUNK_SIZE:
+                digits = line.split(b";")[0].rstrip(b" \t")
+                if not CHUNK_SIZE_DIGITS.fullmatch(digits):
+                    raise ValueError("bad chunk size %r" % digits[:20])
+                size = int(digits, 16)
+                if size == 0:
+                    self.chunk_state = BodyFramer.CHUNK_TRAILER
+                else:
+                    self.remaining = size
+                    self.chunk_state = BodyFramer.CHUNK_DATA
+            elif self.chunk_state == BodyFramer.CHUNK_DATA_END:
+                if line:
+                    raise ValueError("chunk longer than its size")
+                self.chunk_state = BodyFramer.CHUNK_SIZE
+            elif not line:  # empty line closes the trailer section
+                self.done = True
+        return pos - start
+
+
+# Longest chunk-size or trailer line we accept.
+MAX_CHUNK_LINE = 8 * 1024
+# A chunk size is 1*HEXDIG (RFC 9112 section 7.1); int() would also take
+# a sign, a 0x prefix or underscores. 16 digits is all 64 bits.
+CHUNK_SIZE_DIGITS = re.compile(rb"[0-9A-Fa-f]{1,16}")
+
+
+def parse_response_head(head: bytes):
+    """
+    Splits a response head into its status code and header list
+    (same [name, value] layout as HttpRequestInfo.headers). Raises
+    ValueError if its Content-Length can't frame the body.
+    """
+    lines = head.decode("iso-8859-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        (name, sep, value) = line.partition(":")
+        headers.append([name.strip(), value.strip()])
+    content_length(headers)
+    return status, headers
+
+
+def get_header(headers: list, name):
+    name = name.lower()
+    for (key, value) in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def content_length(headers: list):
+    """
+    The body length the Content-Length headers give, or None without
+    one. Raises ValueError when they aren't numbers or disagree.
+    """
+    values = set(part.strip() for (name, value) in headers
+                 if name.lower() == "content-length" for part in value.split(","))
+    if not values:
+        return None
+    if len(values) > 1 or not all(value.isascii() and value.isdigit() for value in values):
+        raise ValueError("malformed Content-Length: %s" % ", ".join(sorted(values)))
+    return int(values.pop())
+
+
+def transfer_codings(headers: list):
+    """
+    The lowercase codings of all the Transfer-Encoding headers, in the
+    order they were applied.
+    """
+    return [coding.strip().lower() for (name, value) in headers
+            if name.lower() == "transfer-encoding" for coding in value.split(",")]
+
+
+def is_chunked(headers: list):
+    codings = transfer_codings(headers)
+    return bool(codings) and codings[-1] == "chunked"
+
+
+# Statuses a shared cache may store (RFC 9111 section 3 and RFC 9110
+# section 15.1). Only the first group may use heuristic freshness.
+HEURISTIC_STATUSES = (200, 203, 204, 300, 301, 308)
+CACHEABLE_STATUSES = HEURISTIC_STATUSES + (404, 405, 410, 414, 501)
+CACHEABLE_METHODS = ("GET", "HEAD")
+
+# Headers that describe one connection or one transfer; they are not
+# stored with a cached response.
+HOP_BY_HOP_HEADERS = ("connection", "keep-alive", "proxy-connection", "te",
+                      "trailer", "transfer-encoding", "upgrade")
+
+# Upper bound for heuristic freshness (10% of the time since the
+# resource was last modified).
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+
+
+def parse_cache_control(value):
+    """
+    Turns a Cache-Control header value into a dict of lowercase
+    directive -> argument (None for directives without one).
+    """
+    directives = dict()
+    if not value:
+        return directives
+    for part in value.split(","):
+        (name, sep, argument) = part.partition("=")
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"') if sep else None
+    return directives
+
+
+def directive_seconds(directives: dict, name):
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def freshness_lifetime(status, headers: list, response_time):
+    """
+    Seconds a response stays fresh (RFC 9111 section 4.2.1).
+    """
+    directives = parse_cache_control(get_header(headers, "Cache-Control"))
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        seconds = directive_seconds(directives, name)
+        if seconds is not None:
+            return seconds
+
+    date = parse_http_date(get_header(headers, "Date")) or response_time
+    expires = get_header(headers, "Expires")
+    if expires is not None:
+        expires = parse_http_date(expires)
+        return max(0, expires - date) if expires is not None else 0
+
+    last_modified = parse_http_date(get_header(headers, "Last-Modified"))
+    if last_modified is not None and status in HEURISTIC_STATUSES:
+        return min(MAX_HEURISTIC_FRESHNESS, max(0, (date - last_modified) // 10))
+    return 0
+
+
+def is_cacheable_response(request_info: HttpRequestInfo, status, headers: list):
+    """
+    Whether a shared cache may store this response to this request.
+    """
+    if request_info.method not in CACHEABLE_METHODS or status not in CACHEABLE_STATUSES:
+        return False
+    request_directives = parse_cache_control(
+        get_header(request_info.headers, "Cache-Control"))
+    directives = parse_cache_control(get_header(headers, "Cache-Control"))
+    if "no-store" in request_directives or "no-store" in directives \
+            or "private" in directives:
+        return False
+    if (get_header(headers, "Vary") or "").strip() == "*":
+        return False
+    if get_header(request_info.headers, "Authorization") is not None and \
+            not ("public" in directives or "s-maxage" in directives
+                 or "must-revalidate" in directives):
+        return False
+    # worth keeping only if it can be fresh or can be revalidated
+    return freshness_lifetime(status, headers, time.time()) > 0 or \
+        get_header(headers, "ETag") is not None or \
+        get_header(headers, "Last-Modified") is not None
+
+
+def decode_chunked(data: bytes):
+    body = bytearray()
+    pos = 0
+    while True:
+        line_end = data.index(b"\r\n", pos)
+        size = int(data[pos:line_end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(body)
+        body += data[line_end + 2:line_end + 2 + size]
+        pos = line_end + 2 + size + 2
+
+
+class CacheEntry(object):
+    """
+    A stored response and the bookkeeping needed to tell whether it
+    is still fresh. Framing and hop-by-hop headers are dropped and the
+    body is kept decoded.
+
+    The head is serialized once, with Content-Length and without Age;
+    serving a hit only formats the Age and Connection lines and sends
+    them between the stored head and body.
+
+    An answer to HEAD is stored head_only: it has no body and keeps
+    the origin's Content-Length.
+
+    A disk-backed entry has body None and body_file set to (path, file
+    id, length) of the DiskCache file holding the body. in_place is set
+    when that file holds this very entry, metadata included, as for one
+    loaded from disk or spooled there while it was relayed.
+    """
+
+    def __init__(self, status_line, status, headers: list, body: bytes,
+                 request_time, response_time, head_only=False, body_file=None):
+        self.status_line = status_line
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.body_file = body_file
+        self.in_place = False
+        self.body_length = len(body) if body is not None else body_file[2]
+        self.request_time = request_time
+        self.response_time = response_time
+        self.head_only = head_only
+
+        self.freshness_lifetime = freshness_lifetime(status, headers, response_time)
+        self.date_value = parse_http_date(get_header(headers, "Date")) or response_time
+        try:
+            self.age_value = max(0, int(get_header(headers, "Age") or 0))
+        except ValueError:
+            self.age_value = 0
+        self.etag = get_header(headers, "ETag")
+        self.last_modified = get_header(headers, "Last-Modified")
+        self.vary = vary_names(headers)
+        self.head = self.serialize_head()
+        self.body_view = memoryview(body) if body is not None else None
+        self.size = self.resident_size()
+        self.varied_copy = None
+
+    def serialize_head(self):
+        lines = [self.status_line]
+        for (name, value) in self.headers:
+            if name.lower() != "age":
+                lines.append(name + ": " + value)
+        if not self.head_only:
+            lines.append("Content-Length: " + str(self.body_length))
+        return ("\r\n".join(lines) + "\r\n").encode("iso-8859-1")
+
+    def range_head(self, span):
+        """
+        The head of a 206 answer carrying the (start, end) span of the
+        body, or of a 416 answer when span is empty.
+        """
+        (start, end) = span
+        version = self.status_line.split(" ", 1)[0]
+        if start == end:
+            return ("%s 416 Range Not Satisfiable\r\nContent-Range: bytes */%d\r\n"
+                    "Content-Length: 0\r\n" % (version, self.body_length)).encode("ascii")
+        lines = [version + " 206 Partial Content"]
+        for (name, value) in self.headers:
+            if name.lower() != "age":
+                lines.append(name + ": " + value)
+        lines.append("Content-Range: bytes %d-%d/%d" % (start, end - 1, self.body_length))
+        lines.append("Content-Length: " + str(end - start))
+        return ("\r\n".join(lines) + "\r\n").encode("iso-8859-1")
+
+    def status_for(self, span):
+        if span is None:
+            return self.status
+        return 206 if span[0] < span[1] else 416
+
+    def resident_size(self):
+        return (len(self.body) if self.body is not None else 0) + len(self.head) + 256
+
+    def move_body_to(self, body_file):
+        self.body = None
+        self.body_view = None
+        self.body_file = body_file
+        self.size = self.resident_size()
+        self.varied_copy = None
+
+    def varied_on_encoding(self):
+        """
+        This response with Accept-Encoding added to its Vary header,
+        sharing its body. Made on first use and kept with the entry.
+        """
+        copy = self.varied_copy
+        if copy is None:
+            copy = CacheEntry(self.status_line, self.status, vary_on_encoding(self.headers),
+                              self.body, self.request_time, self.response_time,
+                              self.head_only, self.body_file)
+            self.varied_copy = copy
+        return copy
+
+    def with_body_loaded(self):
+        """
+        A copy of a disk-backed entry with its body read into memory;
+        None if the file is gone.
+        """
+        f = open_cached_body(self.body_file)
+        if f is None:
+            return None
+        with f:
+            body = f.read(self.body_length)
+        return CacheEntry(self.status_line, self.status, self.headers, body,
+                          self.request_time, self.response_time, self.head_only)
+
+    def write_body(self, f):
+        if self.body is not None:
+            f.write(self.body)
+            return
+        source = open_cached_body(self.body_file)
+        if source is None:
+            raise ValueError("cached body is gone")
+        with source:
+            shutil.copyfileobj(source, f)
+
+    @staticmethod
+    def from_response(status_line, status, headers: list, body: bytes,
+                      request_time, response_time, method="GET", body_file=None):
+        """
+        body is as relayed, chunked framing included; a body_file body
+        was stored decoded.
+        """
+        head_only = method == "HEAD"
+        if body is not None and is_chunked(headers) and not head_only:
+            body = decode_chunked(body)
+        return CacheEntry(status_line, status, kept_headers(headers, head_only), body,
+                          request_time, response_time, head_only, body_file)
+
+    def current_age(self, now):
+        """
+        RFC 9111 section 4.2.3.
+        """
+        apparent_age = max(0, self.response_time - self.date_value)
+        response_delay = self.response_time - self.request_time
+        corrected_initial_age = max(apparent_age, self.age_value + response_delay)
+        return corrected_initial_age + (now - self.response_time)
+
+    def is_fresh(self, now):
+        return self.current_age(now) < self.freshness_lifetime
+
+    def has_validators(self):
+        return self.etag is not None or self.last_modified is not None
+
+    def revalidated(self, headers: list, request_time, response_time):
+        """
+        Returns a copy refreshed by a 304 answer: headers the 304 sent
+        replace the stored ones of the same name.
+        """
+        updates = dict((name.lower(), [name, value]) for (name, value) in headers
+                       if name.lower() not in HOP_BY_HOP_HEADERS
+                       and name.lower() != "content-length")
+        merged = [updates.pop(name.lower(), [name, value])
+                  for (name, value) in self.headers]
+        merged.extend(updates.values())
+        return CacheEntry(self.status_line, self.status, merged, self.body,
+                          request_time, response_time, self.head_only, self.body_file)
+
+    def buffers(self, now, keep_alive=False, with_body=True, span=None):
+        """
+        The response as a list of buffers for send_buffers: the stored
+        head, this answer's Age and Connection lines and, if asked for
+        and held in memory, the body. With a (start, end) span it is
+        the 206 (or 416) answer carrying that slice of the body, which
+        is a view of the stored one rather than a copy.
+        """
+        tail = ("Age: %d\r\nConnection: %s\r\n\r\n" % (
+            self.current_age(now), "keep-alive" if keep_alive else "close"))
+        if span is None:
+            buffers = [self.head, tail.encode("ascii")]
+            body = self.body_view
+        else:
+            buffers = [self.range_head(span), tail.encode("ascii")]
+            body = self.body_view[span[0]:span[1]] if self.body_view is not None else None
+        if with_body and body is not None and len(body):
+            buffers.append(body)
+        return buffers
+
+    def buffers_for(self, request_info: HttpRequestInfo, now, span=None):
+        return self.buffers(now, request_info.keep_alive, request_info.method != "HEAD", span)
+
+
+def kept_headers(headers: list, head_only=False):
+    """
+    The headers of a response as a CacheEntry keeps them.
+    """
+    return [[name, value] for (name, value) in headers
+            if name.lower() not in HOP_BY_HOP_HEADERS
+            and (head_only or name.lower() != "content-length")]
+
+
+def vary_names(headers: list):
+    vary = get_header(headers, "Vary") or ""
+    return sorted(set(name.strip().lower() for name in vary.split(",") if name.strip()))
+
+
+class VaryIndex(object):
+    """
+    Stored under a URL's key when its response varies on request
+    headers; the responses themselves live under variant_key().
+    """
+
+    def __init__(self, names: list):
+        self.names = names
+        self.size = 64 + sum(len(name) for name in names)
+
+
+def resource_key(request_info: HttpRequestInfo):
+    return "%s:%s%s" % (request_info.requested_host.lower(),
+                        request_info.requested_port, request_info.requested_path)
+
+
+def cache_key(request_info: HttpRequestInfo):
+    """
+    Answers to HEAD are kept apart from the GET responses of the
+    same URL.
+    """
+    if request_info.method == "HEAD":
+        return "HEAD " + resource_key(request_info)
+    return resource_key(request_info)
+
+
+def variant_key(key, names: list, request_headers: list):
+    values = [name + "=" + (get_header(request_headers, name) or "") for name in names]
+    return key + "\n" + "\n".join(values)
+
+
+def lookup_response(cache: ResponseCache, request_info: HttpRequestInfo):
+    entry = lookup_key(cache, cache_key(request_info), request_info.headers)
+    if entry is None and request_info.method == "HEAD":
+        # a stored GET response answers HEAD as well
+        entry = lookup_key(cache, resource_key(request_info), request_info.headers)
+    return entry
+
+
+def lookup_key(cache: ResponseCache, key, request_headers: list):
+    entry = cache.get(key)
+    if isinstance(entry, VaryIndex):
+        entry = cache.get(variant_key(key, entry.names, request_headers))
+    return entry
+
+
+def invalidate_responses(cache: ResponseCache, request_info: HttpRequestInfo):
+    """
+    Drops the GET and HEAD responses stored for request_info's URL
+    (RFC 9111 section 4.4); variants go with their VaryIndex.
+    """
+    key = resource_key(request_info)
+    cache.remove(key)
+    cache.remove("HEAD " + key)
+
+
+def response_key(request_info: HttpRequestInfo, vary: list):
+    """
+    Where a response to request_info that varies on the vary header
+    names is stored.
+    """
+    key = cache_key(request_info)
+    if vary:
+        key = variant_key(key, vary, request_info.headers)
+    return key
+
+
+def store_response(cache: ResponseCache, request_info: HttpRequestInfo,
+                   entry: CacheEntry):
+    if entry.vary:
+        cache.put(cache_key(request_info), VaryIndex(entry.vary), VaryIndex(entry.vary).size)
+    cache.put(response_key(request_info, entry.vary), entry, entry.size)
+
+
+def can_serve_cached(request_info: HttpRequestInfo, entry: CacheEntry, now):
+    """
+    Whether entry may answer this request without contacting the
+    origin, honouring the client's own Cache-Control.
+    """
+    directives = parse_cache_control(get_header(request_info.headers, "Cache-Control"))
+    pragma = get_header(request_info.headers, "Pragma") or ""
+    if "no-cache" in directives or pragma.lower() == "no-cache":
+        return False
+    max_age = directive_seconds(directives, "max-age")
+    if max_age is not None and entry.current_age(now) > max_age:
+        return False
+    return entry.is_fresh(now)
+
+
+def parse_range(value, length):
+    """
+    The (start, end) span, end exclusive, of a length-byte body that a
+    Range header value asks for (RFC 9110 section 14.1.2); an empty
+    span when none of it lies within the body. None when the header is
+    ignored and the whole body sent: another unit, a malformed value,
+    or several ranges, which aren't answered with multipart/byteranges.
+    """
+    (unit, sep, ranges) = value.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+    (first, dash, last) = ranges.strip().partition("-")
+    (first, last) = (first.strip(), last.strip())
+    if not dash or not (first or last) or \
+            any(part and not (part.isascii() and part.isdigit()) for part in (first, last)):
+        return None
+    if not first:
+        # the last N bytes
+        return (max(0, length - int(last)), length) if int(last) else (length, length)
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= length:
+        return (length, length)
+    return (start, min(length, int(last) + 1) if last else length)
+
+
+def if_range_matches(request_info: HttpRequestInfo, entry: CacheEntry):
+    """
+    Whether entry is the representation an If-Range header, if any,
+    names: by strong comparison of its ETag, or its Last-Modified date.
+    """
+    value = get_header(request_info.headers, "If-Range")
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith("W/"):
+        return False
+    if value.startswith('"'):
+        return entry.etag == value
+    date = parse_http_date(value)
+    return date is not None and date == parse_http_date(entry.last_modified)
+
+
+def requested_span(request_info: HttpRequestInfo, entry: CacheEntry):
+    """
+    The span of entry's body a range request gets, as parse_range()
+    gives it, or None when it gets the whole response: the request
+    isn't a GET, the response isn't a 200, or If-Range doesn't match.
+    """
+    value = get_header(request_info.headers, "Range")
+    if value is None or request_info.method != "GET" or entry.status != 200 or \
+            entry.head_only or not if_range_matches(request_info, entry):
+        return None
+    return parse_range(value, entry.body_length)
+
+
+def content_range_length(value):
+    """
+    The complete length of the object a Content-Range header value
+    of a 206 gives, or None when it is unknown.
+    """
+    (unit, _, rest) = (value or "").strip().partition(" ")
+    total = rest.rpartition("/")[2].strip()
+    if unit.lower() != "bytes" or not (total.isascii() and total.isdigit()):
+        return None
+    return int(total)
+
+
+def revalidation_candidate(request_info: HttpRequestInfo, entry):
+    """
+    The stale entry to revalidate with a conditional request, or None
+    when the request has to go to the origin unconditionally.
+    """
+    if entry is None or not entry.has_validators():
+        return None
+    # the client's own conditional request is passed through as is
+    if get_header(request_info.headers, "If-None-Match") is not None or \
+            get_header(request_info.headers, "If-Modified-Since") is not None:
+        return None
+    return entry
+
+
+def add_conditional_headers(request_info: HttpRequestInfo, entry: CacheEntry):
+    if entry.etag is not None:
+        request_info.headers.append(["If-None-Match", entry.etag])
+    if entry.last_modified is not None:
+        request_info.headers.append(["If-Modified-Since", entry.last_modified])
+
+
+# Content codings the proxy compresses with, most preferred first.
+ENCODINGS = ("br", "gzip", "deflate") if brotli is not None else ("gzip", "deflate")
+
+
+def parse_accept_encoding(value):
+    """
+    The q-value of each coding an Accept-Encoding header lists, by
+    lowercase name.
+    """
+    accepted = {}
+    for item in value.split(","):
+        parts = item.split(";")
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            (name, _, number) = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(request_headers: list):
+    """
+    The coding of ENCODINGS the client accepts with the highest
+    q-value, or None for identity.
+    """
+    value = get_header(request_headers, "Accept-Encoding")
+    if not value:
+        return None
+    accepted = parse_accept_encoding(value)
+    (best, best_q) = (None, 0.0)
+    for coding in ENCODINGS:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            (best, best_q) = (coding, q)
+    return best
+
+
+def compressible(config: ProxyConfig, status, headers: list, length=None):
+    """
+    Whether a response may be compressed by the proxy: a 200 of one of
+    compress_types that isn't encoded already or marked no-transform,
+    and not known to be smaller than compress_min_bytes.
+    """
+    if status != 200:
+        return False
+    if (get_header(headers, "Content-Encoding") or "identity").strip().lower() != "identity":
+        return False
+    if "no-transform" in parse_cache_control(get_header(headers, "Cache-Control")):
+        return False
+    media_type = (get_header(headers, "Content-Type") or "").split(";")[0].strip().lower()
+    if not media_type or not any(
+            media_type == kind or (kind.endswith("/") and media_type.startswith(kind)) or
+            (kind.startswith("+") and media_type.endswith(kind))
+            for kind in config.compress_types):
+        return False
+    return length is None or length >= config.compress_min_bytes
+
+
+def response_encoding(config: ProxyConfig, request_info: HttpRequestInfo, status,
+                      headers: list, length=None):
+    """
+    The coding to send this response to request_info's client with,
+    or None to send it as it is. A range request gets the identity
+    bytes its offsets count.
+    """
+    if not config.compression or request_info.method != "GET" or \
+            get_header(request_info.headers, "Range") is not None or \
+            not compressible(config, status, headers, length):
+        return None
+    return choose_encoding(request_info.headers)
+
+
+def encoding_varies(config: ProxyConfig, request_info: HttpRequestInfo, status,
+                    headers: list, length=None):
+    """
+    Whether this response may reach some clients compressed, so that
+    every copy of it, the identity one included, has to vary on
+    Accept-Encoding.
+    """
+    return config.compression and request_info.method in ("GET", "HEAD") and \
+        compressible(config, status, headers, length)
+
+
+def vary_on_encoding(headers: list):
+    """
+    headers with Accept-Encoding added to their Vary header.
+    """
+    varied = []
+    varies = False
+    for (name, value) in headers:
+        if name.lower() == "vary":
+            varies = True
+            names = [item.strip().lower() for item in value.split(",")]
+            if "accept-encoding" not in names and "*" not in names:
+                value = value + ", Accept-Encoding"
+        varied.append([name, value])
+    if not varies:
+        varied.append(["Vary", "Accept-Encoding"])
+    return varied
+
+
+def encoded_headers(headers: list, encoding):
+    """
+    The headers of a response once compressed with encoding: its
+    length is no longer known, its ETag becomes weak and it varies on
+    Accept-Encoding.
+    """
+    encoded = []
+    for (name, value) in vary_on_encoding(headers):
+        lower = name.lower()
+        if lower in ("content-length", "content-md5", "transfer-encoding"):
+            continue
+        if lower == "etag" and not value.startswith("W/"):
+            value = "W/" + value
+        encoded.append([name, value])
+    encoded.append(["Content-Encoding", encoding])
+    return encoded
+
+
+class Compressor(object):
+    """
+    Incremental compression with one interface for all ENCODINGS.
+    """
+
+    def __init__(self, encoding, level=6):
+        self.encoding = encoding
+        if encoding == "br":
+            self.engine = brotli.Compressor(quality=level)
+        else:
+            # gzip framing for gzip, zlib framing for deflate (RFC 9110 8.4.1)
+            self.engine = zlib.compressobj(level, zlib.DEFLATED,
+                                           31 if encoding == "gzip" else 15)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self.engine.process(bytes(data))
+        return self.engine.compress(data)
+
+    def flush(self):
+        """
+        Everything fed so far, in a form the client can decode now.
+        """
+        if self.encoding == "br":
+            return self.engine.flush()
+        return self.engine.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self.engine.finish()
+        return self.engine.flush()
+
+
+def compress_bytes(encoding, level, data):
+    compressor = Compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+
+class StreamEncoder(object):
+    """
+    Compresses a relayed body for one client. Each origin read is
+    flushed through, so a slow origin's response still streams. The
+    output is sent chunked to an HTTP/1.1 client and ended by closing
+    the connection otherwise.
+    """
+
+    def __init__(self, encoding, level=6, chunked=True):
+        self.encoding = encoding
+        self.compressor = Compressor(encoding, level)
+        self.chunked = chunked
+
+    def headers(self, headers: list):
+        encoded = encoded_headers(headers, self.encoding)
+        if self.chunked:
+            encoded.append(["Transfer-Encoding", "chunked"])
+        return encoded
+
+    def frame(self, data):
+        if not self.chunked or not data:
+            return data
+        return b"%x\r\n%s\r\n" % (len(data), data)
+
+    def encode(self, pieces: list):
+        """
+        The bytes to send for the next pieces of the body.
+        """
+        data = b"".join(self.compressor.compress(piece) for piece in pieces if len(piece))
+        if not data and not any(len(piece) for piece in pieces):
+            return b""
+        return self.frame(data + self.compressor.flush())
+
+    def finish(self):
+        data = self.frame(self.compressor.finish())
+        return data + b"0\r\n\r\n" if self.chunked else data
+
+
+def encoded_pieces(view: memoryview, start, end, spans):
+    """
+    The body bytes in view[start:end]: all of them, or the listed
+    spans of a chunked body, which is emptied for the next read.
+    """
+    if spans is None:
+        return [view[start:end]]
+    pieces = [view[span_start:span_end] for (span_start, span_end) in spans]
+    del spans[:]
+    return pieces
+
+
+def declared_length(headers: list):
+    try:
+        return int(get_header(headers, "Content-Length"))
+    except (TypeError, ValueError):
+        return None
+
+
+def relayed_headers(context: ProxyContext, request_info: HttpRequestInfo, status,
+                    headers: list):
+    """
+    The headers to relay this response to request_info's client with
+    when it is sent as it is.
+    """
+    if encoding_varies(context.config, request_info, status, headers,
+                       declared_length(headers)):
+        return vary_on_encoding(headers)
+    return headers
+
+
+def stream_encoder(context: ProxyContext, request_info: HttpRequestInfo, status,
+                   headers: list):
+    """
+    A StreamEncoder for relaying this response to request_info's
+    client, or None when it is sent as it is.
+    """
+    encoding = response_encoding(context.config, request_info, status, headers,
+                                 declared_length(headers))
+    if encoding is None:
+        return None
+    context.metrics.count(("compressions", (("encoding", encoding),)))
+    return StreamEncoder(encoding, context.config.compress_level,
+                         request_info.http_version.upper() == "HTTP/1.1")
+
+
+def encoded_key(request_info: HttpRequestInfo, entry: CacheEntry, encoding):
+    """
+    Where the copy of entry compressed with encoding is cached: next to
+    entry, under the key of the variant request_info selected.
+    """
+    key = cache_key(request_info)
+    if entry.vary:
+        key = variant_key(key, entry.vary, request_info.headers)
+    return key + "\ncontent-encoding=" + encoding
+
+
+def compressed_variant(context: ProxyContext, request_info: HttpRequestInfo,
+                       entry: CacheEntry):
+    """
+    The cached response to answer request_info with: entry itself, or
+    a compressed copy of it when the client accepts one.
+
+    The copy is made the first time it is asked for and cached under
+    encoded_key(), so a hot object is compressed once. It has entry's
+    request and response times, which tell whether it was made from
+    the entry now cached or from one since refetched.
+
+    Bodies over cache_object_limit are sent as they are: compressing
+    one would first read it from disk into memory whole.
+    """
+    encoding = variant_encoding(context, request_info, entry)
+    if encoding is None:
+        return identity_variant(context, request_info, entry)
+    return stored_variant(context, request_info, entry, encoding) or \
+        make_variant(context, request_info, entry, encoding)
+
+
+async def async_compressed_variant(context: ProxyContext, request_info: HttpRequestInfo,
+                                   entry: CacheEntry):
+    """
+    asyncio counterpart of compressed_variant. A copy still to be made
+    is read and compressed in the loop's default executor.
+    """
+    encoding = variant_encoding(context, request_info, entry)
+    if encoding is None:
+        return identity_variant(context, request_info, entry)
+    variant = await async_cache_call(context, stored_variant, context, request_info, entry,
+                                     encoding)
+    if variant is None:
+        variant = await asyncio.get_running_loop().run_in_executor(
+            None, make_variant, context, request_info, entry, encoding)
+    return variant
+
+
+def variant_encoding(context: ProxyContext, request_info: HttpRequestInfo,
+                     entry: CacheEntry):
+    if entry.head_only or entry.body_length > context.config.cache_object_limit:
+        return None
+    return response_encoding(context.config, request_info, entry.status, entry.headers,
+                             entry.body_length)
+
+
+def identity_variant(context: ProxyContext, request_info: HttpRequestInfo,
+                     entry: CacheEntry):
+    """
+    entry as it is, with Vary: Accept-Encoding when other clients may
+    be sent a compressed copy of it.
+    """
+    if not encoding_varies(context.config, request_info, entry.status, entry.headers,
+                           None if entry.head_only else entry.body_length):
+        return entry
+    return entry.varied_on_encoding()
+
+
+def stored_variant(context: ProxyContext, request_info: HttpRequestInfo, entry: CacheEntry,
+                   encoding):
+    variant = context.cache.get(encoded_key(request_info, entry, encoding))
+    if isinstance(variant, CacheEntry) and variant.response_time == entry.response_time \
+            and variant.request_time == entry.request_time:
+        return variant
+    return None
+
+
+def make_variant(context: ProxyContext, request_info: HttpRequestInfo, entry: CacheEntry,
+                 encoding):
+    key = encoded_key(request_info, entry, encoding)
+    source = entry if entry.body is not None else entry.with_body_loaded()
+    if source is None:
+        return entry
+    body = compress_bytes(encoding, context.config.compress_level, source.body)
+    variant = CacheEntry(entry.status_line, entry.status,
+                         encoded_headers(entry.headers, encoding), body,
+                         entry.request_time, entry.response_time)
+    context.cache.put(key, variant, variant.size)
+    context.metrics.count(("compressions", (("encoding", encoding),)))
+    return variant
+
+
+async def async_serve_forever(socket_client: socket.socket, context: ProxyContext,
+                              shutdown: threading.Event):
+    """
+    Event-loop engine: every client is a task on one loop instead
+    of a thread, so idle and slow clients cost a few KB each.
+    """
+    active = set()
+
+    metrics = context.metrics
+
+    async def on_client(reader, writer):
+        task = asyncio.current_task()
+        active.add(task)
+        metrics.count("connections")
+        metrics.adjust("connections_active", 1)
+        # asyncio only sets this itself on sockets created with
+        # proto=IPPROTO_TCP, which setup_sockets' are not
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            await async_get_request(reader, writer, context)
+        except asyncio.CancelledError:
+            pass    # cut off by shutdown
+        except Exception as e:
+            log.warning("Error serving %s: %s", writer.get_extra_info("peername"), e)
+        finally:
+            active.discard(task)
+            writer.close()
+            metrics.adjust("connections_active", -1)
+
+    socket_client.setblocking(False)
+    server = await asyncio.start_server(on_client, sock=socket_client,
+                                        limit=context.config.max_header_bytes)
+    while not shutdown.is_set():
+        await asyncio.sleep(ACCEPT_POLL_INTERVAL)
+
+    server.close()
+    # from Python 3.12 wait_closed also waits for the clients, so they
+    # get drain_timeout to finish first and are then cut off
+    if active:
+        (done, pending) = await asyncio.wait(set(active),
+                                             timeout=context.config.drain_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    await server.wait_closed()
+    # pooled streams belong to this loop, close them while it runs
+    context.close()
+
+
+async def async_get_request(reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter, context: ProxyContext):
+    """
+    asyncio counterpart of get_request; the reader's own buffer holds
+    pipelined requests.
+    """
+    address = writer.get_extra_info("peername")
+    config = context.config
+    while True:
+        # the first byte separately, so the head's own timeout starts
+        # only once it arrived, as in ClientReader.read_head
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), config.client_idle_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return
+        head_started = time.monotonic()
+        try:
+            msg = first + await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                                 config.header_timeout)
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.TimeoutError:
+            response = HttpErrorResponse(HttpErrorCodes.REQUEST_TIMEOUT, "Request Timeout")
+            writer.write(response.to_byte_array(response.to_http_string()))
+            await writer.drain()
+            return
+        except asyncio.LimitOverrunError:
+            response = HttpErrorResponse(HttpErrorCodes.HEADER_FIELDS_TOO_LARGE,
+                                         "Request Header Fields Too Large")
+            writer.write(response.to_byte_array(response.to_http_string()))
+            await writer.drain()
+            return
+        started = time.monotonic()
+        context.metrics.observe("header_read", started - head_started)
+
+        response = http_request_pipeline(address, msg)
+        context.metrics.observe("parse", time.monotonic() - started)
+
+        if isinstance(response, HttpErrorResponse):
+            writer.write(response.to_byte_array(response.to_http_string()))
+            await writer.drain()
+            finish_request(context, address, started, error=response)
+            return
+        if config.request_timeout is not None:
+            response.deadline = started + config.request_timeout
+        wait = client_wait(context, response)
+        if wait is None:
+            response.status = HttpErrorCodes.TOO_MANY_REQUESTS.value
+            error = HttpErrorResponse(HttpErrorCodes.TOO_MANY_REQUESTS, "Too Many Requests")
+            writer.write(error.to_byte_array(error.to_http_string()))
+            await writer.drain()
+            if not BodyFramer.for_request(response.headers).done:
+                await async_discard_input(reader, writer)
+            finish_request(context, address, started, response)
+            return
+        if wait:
+            await asyncio.sleep(wait)
+        if response.method == "CONNECT":
+            try:
+                await async_open_tunnel(reader, writer, response, context)
+            finally:
+                finish_request(context, address, started, response)
+            return
+        response.keep_alive = client_keeps_alive(response)
+        body = AsyncRequestBody.for_request(reader, writer, response,
+                                            config.client_idle_timeout)
+        try:
+            await async_serve_request(writer, response, context, body)
+            await asyncio.wait_for(writer.drain(), config.client_idle_timeout)
+        finally:
+            finish_request(context, address, started, response)
+        if not response.keep_alive or (body is not None and not body.framer.done):
+            return
+
+
+async def async_open_tunnel(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                            request_info: HttpRequestInfo, context: ProxyContext):
+    """
+    asyncio counterpart of open_tunnel; the tunnel is relayed by two
+    tasks on the loop, one per direction.
+    """
+    if not connect_allowed(context.config, request_info):
+        request_info.status = HttpErrorCodes.FORBIDDEN.value
+        response = HttpErrorResponse(HttpErrorCodes.FORBIDDEN, "Forbidden")
+        writer.write(response.to_byte_array(response.to_http_string()))
+        return
+    try:
+        (server_reader, server_writer) = await async_connect_upstream(
+            context, (request_info.requested_host, request_info.requested_port),
+            request_info.deadline)
+    except UpstreamError as e:
+        log.info("%s", e)
+        (code, message) = gateway_error(e)
+        request_info.status = code.value
+        response = HttpErrorResponse(code, message)
+        writer.write(response.to_byte_array(response.to_http_string()))
+        return
+    request_info.status = 200
+    writer.write(CONNECT_ESTABLISHED)
+
+    activity = [time.monotonic()]
+    timeout = context.config.tunnel_idle_timeout
+    pumps = [asyncio.ensure_future(async_pump(reader, server_writer, activity, timeout)),
+             asyncio.ensure_future(async_pump(server_reader, writer, activity, timeout))]
+    try:
+        await asyncio.wait(pumps, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for pump in pumps:
+            pump.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+        server_writer.close()
+
+
+async def async_pump(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                     activity: list, timeout):
+    """
+    Copies one direction of a tunnel until its sender finishes, then
+    half-closes the receiving side. activity[0] is shared by both
+    directions, so a tunnel is idle only when neither moves data.
+    """
+    while True:
+        try:
+            data = await asyncio.wait_for(reader.read(RELAY_BUFFER_SIZE), timeout)
+        except asyncio.TimeoutError:
+            if time.monotonic() - activity[0] < timeout:
+                continue
+            raise
+        if not data:
+            if writer.can_write_eof():
+                writer.write_eof()
+            return
+        activity[0] = time.monotonic()
+        writer.write(data)
+        await writer.drain()
+
+
+def write_request_error(writer: asyncio.StreamWriter, request_info: HttpRequestInfo, code,
+                        message):
+    """
+    asyncio counterpart of send_request_error.
+    """
+    request_info.status = code.value
+    request_info.keep_alive = False
+    response = HttpErrorResponse(code, message)
+    writer.write(response.to_byte_array(response.to_http_string()))
+
+
+async def async_discard_input(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              timeout=1.0, limit=1024 * 1024):
+    """
+    asyncio counterpart of discard_input.
+    """
+    try:
+        await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+        while limit > 0:
+            data = await asyncio.wait_for(reader.read(65536), timeout)
+            if not data:
+                break
+            limit -= len(data)
+    except (OSError, asyncio.TimeoutError):
+        pass
+
+
+async def async_spool_call(spool: BodySpool, length, function, *args):
+    """
+    Calls a method of spool that handles length more bytes of the body,
+    for the asyncio engine: in the loop's default executor if it
+    writes to disk, directly otherwise.
+    """
+    if spool.on_disk(length):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+    return function(*args)
+
+
+async def async_cache_call(context: ProxyContext, function, *args):
+    """
+    Calls a function that reads or writes context's cache, for the
+    asyncio engine. With a disk tier, which reads and writes whole
+    bodies of up to disk_object_limit, it runs in the loop's default
+    executor; a memory-only cache is called directly.
+    """
+    if isinstance(context.cache, TieredCache):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+    return function(*args)
+
+
+async def async_serve_request(writer: asyncio.StreamWriter,
+                              request_info: HttpRequestInfo, context: ProxyContext,
+                              body=None):
+    now = time.time()
+    entry = None
+    if request_info.method in CACHEABLE_METHODS:
+        entry = await async_cache_call(context, lookup_response, context.cache, request_info)
+    if entry is not None and can_serve_cached(request_info, entry, now) and \
+            await async_send_entry(
+                writer, await async_compressed_variant(context, request_info, entry),
+                request_info, now):
+        request_info.cache_result = "HIT"
+    else:
+        request_info.display()
+        request_info.cache_result = "MISS" if entry is not None or \
+            request_info.method in CACHEABLE_METHODS else "BYPASS"
+        await async_fetch_coalesced(writer, request_info, context, entry, body)
+
+
+async def async_send_entry(writer: asyncio.StreamWriter, entry,
+                           request_info: HttpRequestInfo, now):
+    """
+    asyncio counterpart of send_entry.
+    """
+    span = requested_span(request_info, entry)
+    request_info.status = entry.status_for(span)
+    if entry.body is not None or request_info.method == "HEAD":
+        buffers = entry.buffers_for(request_info, now, span)
+        writer.writelines(buffers)
+        request_info.response_bytes = sum(len(buffer) for buffer in buffers)
+        return True
+    f = await asyncio.get_running_loop().run_in_executor(None, open_cached_body,
+                                                         entry.body_file)
+    if f is None:
+        return False
+    (start, end) = span or (0, entry.body_length)
+    with f:
+        buffers = entry.buffers(now, request_info.keep_alive, False, span)
+        writer.writelines(buffers)
+        if end > start:
+            await asyncio.get_running_loop().sendfile(writer.transport, f, f.tell() + start,
+                                                      end - start)
+    request_info.response_bytes = sum(len(buffer) for buffer in buffers) + end - start
+    return True
+
+
+class AsyncRequestBody(RequestBody):
+    """
+    asyncio counterpart of RequestBody. A StreamReader can't take
+    bytes back, so each read stops where the framer's current piece
+    ends and nothing of the next request is consumed.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 framer, expect_continue=False, timeout=None, deadline=None):
+        RequestBody.__init__(self, reader, framer, expect_continue, timeout, deadline)
+        self.writer = writer
+
+    @staticmethod
+    def for_request(reader, writer, request_info: HttpRequestInfo, timeout=None):
+        framer = BodyFramer.for_request(request_info.headers)
+        if framer.done:
+            return None
+        return AsyncRequestBody(reader, writer, framer, expects_continue(request_info),
+                                timeout, request_info.deadline)
+
+    async def send_to(self, server_writer: asyncio.StreamWriter):
+        self.started = True
+        if self.expect_continue:
+            self.writer.write(CONTINUE_RESPONSE)
+        framer = self.framer
+        while not framer.done:
+            if framer.mode == BodyFramer.LENGTH or framer.chunk_state == BodyFramer.CHUNK_DATA:
+                read = self.reader.read(min(framer.remaining, RELAY_BUFFER_SIZE))
+            else:
+                read = self.reader.readuntil(b"\n")
+            try:
+                data = await asyncio.wait_for(read, time_left(self.deadline, self.timeout))
+            except (asyncio.TimeoutError, socket.timeout):
+                read.close()
+                raise RequestTimeout()
+            if not data:
+                raise ConnectionError("client closed in the middle of the request body")
+            try:
+                framer.feed(data, 0, len(data))
+            except ValueError as e:
+                raise MalformedRequestBody(str(e))
+            server_writer.write(data)
+            try:
+                await server_writer.drain()
+            except OSError as e:
+                raise UpstreamError("sending the request body failed: %s" % e)
+
+
+async def async_fetch_coalesced(writer: asyncio.StreamWriter,
+                                request_info: HttpRequestInfo,
+                                context: ProxyContext, entry=None, body=None):
+    """
+    asyncio counterpart of fetch_coalesced.
+    """
+    if request_info.method not in CACHEABLE_METHODS or body is not None or \
+            get_header(request_info.headers, "Range") is not None:
+        await async_fetch_response(writer, request_info, context,
+                                   revalidation_candidate(request_info, entry), body)
+        return
+
+    key = cache_key(request_info)
+    (flight, leader) = context.flights.begin(key)
+    if leader:
+        try:
+            result = await async_fetch_response(
+                writer, request_info, context,
+                revalidation_candidate(request_info, entry))
+        except UpstreamError as e:
+            context.flights.finish(key, flight, error=e)
+            raise
+        except BaseException:
+            context.flights.finish(key, flight)
+            raise
+        context.flights.finish(key, flight, result)
+        return
+
+    try:
+        completed = await flight.wait(context.config.coalesce_timeout)
+    except UpstreamError as e:
+        (code, message) = gateway_error(e)
+        write_request_error(writer, request_info, code, message)
+        return
+    if completed:
+        now = time.time()
+        entry = await async_cache_call(context, lookup_response, context.cache, request_info)
+        if entry is not None and (entry is flight.result or
+                                  can_serve_cached(request_info, entry, now)) and \
+                await async_send_entry(
+                    writer, await async_compressed_variant(context, request_info, entry),
+                    request_info, now):
+            request_info.cache_result = "COALESCED"
+            return
+    await async_fetch_response(writer, request_info, context,
+                               revalidation_candidate(request_info, entry))
+
+
+async def async_fetch_response(writer: asyncio.StreamWriter,
+                               request_info: HttpRequestInfo,
+                               context: ProxyContext, stale_entry=None, body=None):
+    """
+    asyncio counterpart of fetch_response.
+    """
+    cache = context.cache
+    if stale_entry is not None:
+        add_conditional_headers(request_info, stale_entry)
+    peer = owning_peer(context, request_info, stale_entry, body)
+    if peer is None:
+        packet = upstream_request_bytes(request_info, context.config.upstream_keepalive, body)
+        origin = (request_info.requested_host, request_info.requested_port)
+    else:
+        packet = upstream_request_bytes(request_info, context.config.upstream_keepalive,
+                                        peer_self=context.peers.self_node)
+        origin = peer
+    slots = context.origin_slots
+    if slots is not None and not await slots.async_acquire(origin,
+                                                           context.config.admission_wait):
+        context.metrics.count(("admission_rejected", (("reason", "origin_busy"),)))
+        write_request_error(writer, request_info, HttpErrorCodes.SERVICE_UNAVAILABLE,
+                            "Service Unavailable")
+        if body is not None and not body.framer.done:
+            await async_discard_input(body.reader, writer)
+        return None
+    started = False
+    complete = False
+    stream = None
+    spool = None
+    entry = None
+    peer_failed = False
+    try:
+        (stream, head, request_time) = await async_open_upstream(
+            context, origin, packet, request_info.method, body, request_info.deadline)
+        response_time = time.time()
+        request_info.upstream_time = response_time - request_time
+        context.metrics.observe("first_byte", request_info.upstream_time)
+        (status, headers) = parse_origin_head(head)
+        status_line = head[:head.index(b"\r\n")].decode("iso-8859-1")
+        if request_info.method not in SAFE_METHODS and status < 400:
+            await async_cache_call(context, invalidate_responses, cache, request_info)
+
+        if stale_entry is not None and status == 304:
+            complete = True
+            entry = stale_entry.revalidated(headers, request_time, response_time)
+            await async_cache_call(context, store_response, cache, request_info, entry)
+            request_info.cache_result = "REVALIDATED"
+            variant = await async_compressed_variant(context, request_info, entry)
+            if not await async_send_entry(writer, variant, request_info, response_time):
+                write_request_error(writer, request_info, HttpErrorCodes.BAD_GATEWAY,
+                                    "Bad Gateway")
+            return entry
+
+        if peer is None and is_cacheable_response(request_info, status, headers):
+            spool = response_spool(cache, request_info, status_line, status, headers,
+                                   request_time, response_time)
+        if peer is None:
+            start_range_fill(context, request_info, status, headers)
+        encoder = stream_encoder(context, request_info, status, headers)
+        started = True
+        relay_started = time.monotonic()
+        complete = await async_relay_response(
+            stream[0], writer, status_line, status, headers, request_info,
+            spool, context.config.first_byte_timeout,
+            context.config.client_idle_timeout, encoder,
+            relayed_headers(context, request_info, status, headers))
+        context.metrics.observe("relay", time.monotonic() - relay_started)
+        if spool is not None:
+            entry = await async_spool_call(spool, 0, spool.finish)
+        if peer is not None:
+            request_info.cache_result = "PEER"
+    except UpstreamError as e:
+        if started:
+            raise
+        if peer is None:
+            (code, message) = gateway_error(e)
+            write_request_error(writer, request_info, code, message)
+            raise
+        log.warning("Fetch through peer %s failed: %s", format_node(peer), e)
+        context.peers.mark_down(peer)
+        peer_failed = True
+    except RequestTimeout:
+        write_request_error(writer, request_info, HttpErrorCodes.REQUEST_TIMEOUT,
+                            "Request Timeout")
+        return None
+    except MalformedRequestBody:
+        write_request_error(writer, request_info, HttpErrorCodes.BAD_REQUEST, "Bad Request")
+        return None
+    finally:
+        if stream is not None:
+            if complete and origin_keeps_alive(status_line, headers):
+                context.upstream_pool.checkin(origin, stream)
+            else:
+                stream[1].close()
+        if spool is not None:
+            await async_spool_call(spool, 0, spool.close)
+        if slots is not None:
+            slots.release(origin)
+
+    if peer_failed:
+        return await async_fetch_response(writer, request_info, context, stale_entry, body)
+    if entry is None:
+        return None
+    await async_cache_call(context, store_response, cache, request_info, entry)
+    return entry
+
+
+def parse_origin_head(head: bytes):
+    try:
+        return parse_response_head(head)
+    except (IndexError, ValueError):
+        raise UpstreamError("malformed response head from origin")
+
+
+async def async_open_upstream(context: ProxyContext, origin, packet: bytes, method,
+                              body=None, deadline=None):
+    """
+    asyncio counterpart of open_upstream; returns ((reader, writer),
+    response head, time the request was sent).
+    """
+    timeout = context.config.first_byte_timeout
+    stream = context.upstream_pool.checkout(origin)
+    while True:
+        reused = stream is not None
+        if not reused:
+            stream = await async_connect_upstream(context, origin, deadline)
+        (server_reader, server_writer) = stream
+        try:
+            request_time = time.time()
+            server_writer.write(packet)
+            await asyncio.wait_for(server_writer.drain(), time_left(deadline, timeout))
+            if body is not None:
+                await body.send_to(server_writer)
+            while True:
+                head = await asyncio.wait_for(server_reader.readuntil(b"\r\n\r\n"),
+                                              time_left(deadline, timeout))
+                status = parse_origin_head(head)[0]
+                # interim 1xx responses are dropped, as in OriginResponse
+                if not 100 <= status < 200 or status == 101:
+                    return stream, head, request_time
+        except (asyncio.TimeoutError, socket.timeout):
+            server_writer.close()
+            raise UpstreamTimeout("%s:%s did not answer in time" % origin)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            server_writer.close()
+            if not reused or method not in IDEMPOTENT_METHODS or \
+                    (body is not None and body.started):
+                raise UpstreamError("fetching from %s:%s failed: %s" % (
+                    origin[0], origin[1], e))
+        except BaseException:
+            server_writer.close()
+            raise
+        stream = None
+
+
+async def async_relay_response(server_reader: asyncio.StreamReader,
+                               writer: asyncio.StreamWriter, status_line,
+                               status, headers: list, client_request: HttpRequestInfo,
+                               spool=None, read_timeout=None, send_timeout=None,
+                               encoder=None, client_headers=None):
+    """
+    asyncio counterpart of OriginResponse.relay. Returns whether the
+    connection can be reused. What spool writes to disk is written in
+    the loop's default executor.
+
+    Each read from the origin waits up to read_timeout and each wait
+    for the client to take the data up to send_timeout, neither past
+    client_request's deadline.
+    """
+    deadline = client_request.deadline
+    leftover = False
+
+    framer = BodyFramer.for_response(status, headers, client_request.method)
+    dechunk = framer.mode == BodyFramer.CHUNKED and (
+        encoder is not None or client_request.http_version.upper() != "HTTP/1.1")
+    if encoder is not None:
+        client_request.keep_alive = client_request.keep_alive and encoder.chunked
+        head = client_response_head(status_line, encoder.headers(headers),
+                                    client_request.keep_alive)
+    else:
+        client_request.keep_alive = client_request.keep_alive and \
+            framer.mode != BodyFramer.UNTIL_EOF and not dechunk
+        head = client_response_head(status_line, client_headers or headers,
+                                    client_request.keep_alive, dechunk)
+    spans = [] if dechunk else None
+    writer.write(head)
+    client_request.status = status
+    client_request.response_bytes = len(head)
+    while not framer.done:
+        try:
+            chunk = await asyncio.wait_for(server_reader.read(RELAY_BUFFER_SIZE),
+                                           time_left(deadline, read_timeout))
+        except (asyncio.TimeoutError, socket.timeout):
+            raise UpstreamTimeout("origin did not answer in time")
+        except OSError as e:
+            raise UpstreamError("reading from origin failed: %s" % e)
+        if not chunk:
+            if framer.mode == BodyFramer.UNTIL_EOF:
+                break
+            raise UpstreamError("origin closed in the middle of a response")
+        try:
+            used = framer.feed(chunk, 0, len(chunk), spans)
+        except ValueError:
+            raise UpstreamError("malformed chunked body from origin")
+        leftover = used < len(chunk)
+        if encoder is not None:
+            data = encoder.encode(encoded_pieces(memoryview(chunk), 0, used, spans))
+            writer.write(data)
+            client_request.response_bytes += len(data)
+        elif spans is None:
+            writer.write(memoryview(chunk)[:used])
+            client_request.response_bytes += used
+        else:
+            for (span_start, span_end) in spans:
+                writer.write(memoryview(chunk)[span_start:span_end])
+                client_request.response_bytes += span_end - span_start
+            del spans[:]
+        try:
+            await asyncio.wait_for(writer.drain(), send_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError("client stopped reading the response")
+        if spool is not None:
+            await async_spool_call(spool, used, spool.write, memoryview(chunk)[:used])
+    if encoder is not None:
+        tail = encoder.finish()
+        writer.write(tail)
+        client_request.response_bytes += len(tail)
+    return framer.mode != BodyFramer.UNTIL_EOF and not leftover
+
+
+# Methods the request line may carry, and the ones the proxy serves;
+# the others are answered with 501.
+KNOWN_METHODS = (b"GET", b"POST", b"HEAD", b"PUT", b"DELETE", b"PATCH",
+                 b"OPTIONS", b"TRACE", b"CONNECT")
+SERVED_METHODS = (b"GET", b"POST", b"HEAD", b"PUT", b"DELETE", b"PATCH", b"OPTIONS",
+                  b"CONNECT")
+HTTP_VERSIONS = (b"HTTP/1.0", b"HTTP/1.1")
+
+# A header name is a token, and no line may hold a CTL other than HTAB
+# (RFC 9110 sections 5.1 and 5.5): a bare LF or CR in a forwarded head
+# would be framed differently by the origin than here.
+HEADER_NAME = re.compile(rb"[!#$%&'*+.^_`|~0-9A-Za-z-]+")
+HEADER_CTL = re.compile(rb"[\x00-\x08\x0a-\x1f\x7f]")
+
+
+def http_request_pipeline(source_addr, http_raw_data):
+    # Parse HTTP request
+    (validity, request_info) = scan_http_request(source_addr, http_raw_data)
+
+    if validity == HttpRequestState.GOOD:
+        return request_info
+
+    elif validity == HttpRequestState.NOT_SUPPORTED:
+        error_response = HttpErrorResponse(HttpErrorCodes.NOT_IMPLEMENTED, "Not Implemented")
+        return error_response
+
+    elif validity == HttpRequestState.INVALID_INPUT:
+        error_response = HttpErrorResponse(HttpErrorCodes.BAD_REQUEST, "Bad Request")
+        return error_response
+
+    return None
+
+
+# Address the requests of a request log are parsed as coming from.
+REPLAY_ADDRESS = ("replay", 0)
+
+
+def parse_request_record(line):
+    """
+    Parses one line of a JSONL request log. A line holds either the
+    raw request head as "request", or is an access log record with
+    "method" and "url". Its time is an "offset" in seconds, or the
+    access log's "time".
+
+    Returns (time or None, request head bytes, HttpRequestInfo), or
+    None for a line holding no request, a CONNECT or one that doesn't
+    parse.
+    """
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict):
+        return None
+    raw = record.get("request")
+    method = record.get("method")
+    url = record.get("url")
+    try:
+        if isinstance(raw, str):
+            raw = raw.encode("iso-8859-1")
+        elif isinstance(method, str) and isinstance(url, str):
+            raw = ("%s %s HTTP/1.1\r\n\r\n" % (method, url)).encode("iso-8859-1")
+        else:
+            return None
+    except UnicodeEncodeError:
+        return None
+    if not raw.endswith(b"\r\n\r\n"):
+        raw = raw.rstrip(b"\r\n") + b"\r\n\r\n"
+    request_info = http_request_pipeline(REPLAY_ADDRESS, raw)
+    if not isinstance(request_info, HttpRequestInfo) or request_info.method == "CONNECT":
+        return None
+    return record_time(record), raw, request_info
+
+
+def record_time(record: dict):
+    offset = record.get("offset")
+    if isinstance(offset, (int, float)) and not isinstance(offset, bool):
+        return float(offset)
+    value = record.get("time")
+    if not isinstance(value, str):
+        return None
+    # logging's default asctime: "2024-01-01 12:00:00,123", local time
+    try:
+        (stamp, _, millis) = value.partition(",")
+        seconds = time.mktime(time.strptime(stamp, "%Y-%m-%d %H:%M:%S"))
+        return seconds + (int(millis) / 1000.0 if millis else 0.0)
+    except (ValueError, OverflowError):
+        return None
+
+
+def read_request_log(lines):
+    """
+    The requests of a JSONL request log, as parse_request_record
+    returns them; lines without a request are skipped.
+    """
+    for line in lines:
+        record = parse_request_record(line)
+        if record is not None:
+            yield record
+
+
+def scan_http_request(source_addr, http_raw_data):
+    """
+    Validates and parses a request head in one pass over its bytes
+    (a str is encoded first). Returns (HttpRequestState,
+    HttpRequestInfo); the request is None for INVALID_INPUT.
+
+    The parsed request is already sanitized: its path is relative and
+    a Host header naming the requested host comes first.
+    """
+    data = http_raw_data
+    if isinstance(data, str):
+        data = data.encode("iso-8859-1", "replace")
+    size = len(data)
+
+    line_end = data.find(b"\r\n")
+    if line_end < 0:
+        line_end = size
+    parts = data[:line_end].split()
+    if len(parts) != 3 or HEADER_CTL.search(data, 0, line_end):
+        return HttpRequestState.INVALID_INPUT, None
+    (method, target, http_version) = parts
+    if method not in KNOWN_METHODS or http_version.upper() not in HTTP_VERSIONS:
+        return HttpRequestState.INVALID_INPUT, None
+
+    headers = []
+    host_value = None
+    content_length = None
+    codings = []
+    pos = line_end + 2
+    while pos < size:
+        line_end = data.find(b"\r\n", pos)
+        if line_end < 0:
+            line_end = size
+        if line_end == pos:     # blank line ends the head
+            break
+        colon = data.find(b":", pos, line_end)
+        if colon < 0:
+            return HttpRequestState.INVALID_INPUT, None
+        if not HEADER_NAME.fullmatch(data, pos, colon) or \
+                HEADER_CTL.search(data, colon + 1, line_end):
+            return HttpRequestState.INVALID_INPUT, None
+        name = data[pos:colon]
+        value = data[colon + 1:line_end].strip()
+        lower = name.lower()
+        if lower == b"host":
+            if host_value is not None:
+                return HttpRequestState.INVALID_INPUT, None
+            host_value = value
+        elif lower == b"content-length" and content_length is not None:
+            # a repeated length is dropped if it agrees, never forwarded
+            if value != content_length:
+                return HttpRequestState.INVALID_INPUT, None
+        else:
+            if lower == b"content-length":
+                if not value.isdigit():
+                    return HttpRequestState.INVALID_INPUT, None
+                content_length = value
+            elif lower == b"transfer-encoding":
+                codings.extend(coding.strip().lower() for coding in value.split(b","))
+            headers.append([name.decode("iso-8859-1"), value.decode("iso-8859-1")])
+        pos = line_end + 2
+
+    # a body framed two ways, or by codings that don't end in chunked,
+    # has no length both we and the origin agree on (RFC 9112 section 6.3)
+    if codings and (codings[-1] != b"chunked" or content_length is not None):
+        return HttpRequestState.INVALID_INPUT, None
+
+    if method == b"CONNECT":
+        # authority-form, the port is required (RFC 9110 section 9.3.6)
+        if not target.rpartition(b":")[2].isdigit():
+            return HttpRequestState.INVALID_INPUT, None
+        (authority, path) = (target, b"")
+    elif target.startswith(b"/") or target == b"*":
+        if not host_value:
+            return HttpRequestState.INVALID_INPUT, None
+        (authority, path) = (host_value, target)
+    else:
+        (authority, path) = split_absolute_target(target)
+    address = split_authority(authority)
+    if address is None:
+        return HttpRequestState.INVALID_INPUT, None
+    (host, port) = address
+
+    # the port goes into requested_port, not the Host header
+    headers.insert(0, ["Host", "[" + host + "]" if ":" in host else host])
+    request_info = HttpRequestInfo(source_addr, method.decode("ascii"), host, port,
+                                   path.decode("iso-8859-1"), headers,
+                                   http_version.decode("ascii"))
+    if method not in SERVED_METHODS:
+        return HttpRequestState.NOT_SUPPORTED, request_info
+    return HttpRequestState.GOOD, request_info
+
+
+def split_absolute_target(target: bytes):
+    """
+    Splits an absolute-form target (http://host[:port]/path) or a bare
+    host[:port][/path] into (authority, path); the path keeps its
+    query and defaults to "/". Other schemes give an empty authority.
+    """
+    scheme_end = target.find(b"://")
+    if scheme_end >= 0:
+        if target[:scheme_end].lower() != b"http":
+            return b"", target
+        target = target[scheme_end + 3:]
+    path_start = len(target)
+    for separator in (b"/", b"?"):
+        found = target.find(separator)
+        if 0 <= found < path_start:
+            path_start = found
+    path = target[path_start:]
+    if not path.startswith(b"/"):
+        path = b"/" + path
+    return target[:path_start], path
+
+
+def split_authority(authority: bytes):
+    """
+    Returns (host, port) from host[:port] or [v6 address][:port], with
+    port 80 by default, or None if it is malformed.
+    """
+    if authority.startswith(b"["):
+        close = authority.find(b"]")
+        if close < 0 or (len(authority) > close + 1 and authority[close + 1:close + 2] != b":"):
+            return None
+        (host, port_text) = (authority[1:close], authority[close + 2:])
+    else:
+        (host, _, port_text) = authority.partition(b":")
+    if not host:
+        return None
+    port = 80
+    if port_text:
+        if not port_text.isdigit() or not 0 < int(port_text) < 65536:
+            return None
+        port = int(port_text)
+    return host.decode("iso-8859-1").lower(), port
+
+
+def parse_http_request(source_addr, http_raw_data):
+    return scan_http_request(source_addr, http_raw_data)[1]
+
+
+def check_http_request_validity(http_raw_data) -> HttpRequestState:
+    return scan_http_request(None, http_raw_data)[0]
 
 
 
@@ -395,7 +5742,23 @@ def main():
 
     # This argument is optional, defaults to 18888
     proxy_port_number = get_arg(1, 18888)
-    entry_point(proxy_port_number)
+    # Optional, "threads" (default) or "asyncio"
+    engine = get_arg(2, "threads")
+    # Optional, number of worker processes
+    processes = int(get_arg(3, 1))
+    # Optional, access log file ("-" for stderr, "none" or "" for no log)
+    access_log_file = get_arg(4, "none")
+    if access_log_file in ("", "none"):
+        access_log_file = None
+    # Optional, admin port serving /metrics ("none" or "" for no admin port)
+    admin_port = get_arg(5, "none")
+    admin_port = int(admin_port) if admin_port not in ("", "none") else None
+    # Optional, "compress" to compress responses for clients that accept it
+    compression = get_arg(6, "identity") == "compress"
+    entry_point(proxy_port_number, ProxyConfig(processes=processes,
+                                               access_log=access_log_file,
+                                               admin_port=admin_port,
+                                               compression=compression), engine)
     #parse_absolute_url("http://www.google.com:58/")
     #string = "http://www.google.com/"
     #o = urlparse(string)
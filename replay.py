@@ -0,0 +1,219 @@
+"""
+Cache warm-up and traffic replay from a JSONL request log.
+
+Each line of the log holds a raw request head as "request", or is a
+record of the proxy's access log ("method" and "url"); lines holding
+neither are skipped (see parse_request_record in proxy.py).
+
+    python replay.py warm LOG [--port P] [--engine threads|asyncio]
+                              [--processes N] [--parallelism N]
+    python replay.py replay LOG [--proxy HOST:PORT] [--speed S]
+                                [--concurrency C] [--limit N] [--output FILE]
+
+warm starts the proxy with its cache filled from the log's GET and
+HEAD objects before it opens its listening socket. replay sends the
+logged requests to a running proxy: with their recorded timing, S
+times faster (--speed S), or back to back (--speed 0), and prints a
+JSON summary of the answers.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import time
+
+from proxy import ProxyConfig, entry_point, read_request_log
+from proxy import BodyFramer, parse_response_head
+
+
+class StaleConnection(ConnectionError):
+    """
+    A kept-alive connection failed before any of the response arrived;
+    the proxy most likely closed it while it sat idle.
+    """
+
+
+async def exchange(idle, stream, raw: bytes, method):
+    """
+    Sends raw on stream and reads the whole response; the connection
+    goes back to idle if it stays open. Returns (status, bytes received).
+    """
+    (reader, writer) = stream
+    try:
+        try:
+            writer.write(raw)
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            raise StaleConnection("proxy closed the connection before answering")
+        except ConnectionError as e:
+            raise StaleConnection(str(e))
+        (status, headers) = parse_response_head(head)
+        framer = BodyFramer.for_response(status, headers, method)
+        received = len(head)
+        while not framer.done:
+            data = await reader.read(65536)
+            if not data:
+                if framer.mode == BodyFramer.UNTIL_EOF:
+                    break
+                raise ConnectionError("proxy closed in the middle of a response")
+            received += len(data)
+            if framer.feed(data, 0, len(data)) < len(data):
+                raise ConnectionError("proxy sent more than the response")
+    except BaseException:
+        writer.close()
+        raise
+    connection = ""
+    for (name, value) in headers:
+        if name.lower() == "connection":
+            connection = value.lower()
+    if framer.mode == BodyFramer.UNTIL_EOF or "close" in connection:
+        writer.close()
+    else:
+        idle.append(stream)
+    return status, received
+
+
+async def send(idle, proxy, raw: bytes, method):
+    """
+    Sends raw on an idle connection from idle, or a new one, and reads
+    the whole response. An idle connection the proxy has closed in the
+    meantime (client_idle_timeout) is given up for one new connection.
+    Returns (status, bytes received).
+    """
+    if idle:
+        try:
+            return await exchange(idle, idle.pop(), raw, method)
+        except StaleConnection:
+            pass
+    return await exchange(idle, await asyncio.open_connection(*proxy), raw, method)
+
+
+async def replay(records, proxy, speed, concurrency):
+    """
+    Sends the (time, raw, request_info) records at their offsets from
+    the first one divided by speed, or at once with speed 0, keeping
+    at most concurrency in flight. Returns the summary.
+    """
+    idle = []
+    slots = asyncio.Semaphore(concurrency)
+    statuses = collections.Counter()
+    latencies = []
+    lags = []
+    totals = {"errors": 0, "bytes": 0}
+    tasks = []
+
+    async def one(raw, request_info):
+        started = time.perf_counter()
+        try:
+            (status, received) = await send(idle, proxy, raw, request_info.method)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError, IndexError):
+            totals["errors"] += 1
+            return
+        finally:
+            slots.release()
+        latencies.append(time.perf_counter() - started)
+        statuses[status] += 1
+        totals["bytes"] += received
+
+    started = time.perf_counter()
+    first = None
+    last = 0.0
+    for (when, raw, request_info) in records:
+        if when is not None and first is None:
+            first = when
+        # a record without a time goes out right after the one before
+        offset = last if when is None else max(0.0, when - first)
+        last = offset
+        if speed:
+            delay = started + offset / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lags.append(-delay)
+        await slots.acquire()
+        tasks.append(asyncio.ensure_future(one(raw, request_info)))
+    await asyncio.gather(*tasks)
+    seconds = time.perf_counter() - started
+    for (reader, writer) in idle:
+        writer.close()
+
+    latencies.sort()
+    lags.sort()
+
+    def milliseconds(ordered, fraction):
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        "requests": len(tasks),
+        "errors": totals["errors"],
+        "statuses": dict((str(status), count) for (status, count) in sorted(statuses.items())),
+        "bytes": totals["bytes"],
+        "seconds": round(seconds, 3),
+        "rate_rps": round(len(latencies) / seconds, 1) if seconds else None,
+        "latency_ms": {"p50": milliseconds(latencies, 0.5),
+                       "p99": milliseconds(latencies, 0.99),
+                       "max": milliseconds(latencies, 1.0)},
+        # how far behind the recorded timing requests went out
+        "lag_ms": {"p99": milliseconds(lags, 0.99), "max": milliseconds(lags, 1.0)},
+    }
+
+
+def parse_address(value):
+    (host, _, port) = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    warm = commands.add_parser("warm", help="start the proxy with a warm cache")
+    warm.add_argument("log")
+    warm.add_argument("--port", type=int, default=18888)
+    warm.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    warm.add_argument("--processes", type=int, default=1)
+    warm.add_argument("--parallelism", type=int, default=8,
+                      help="objects fetched at once")
+
+    send_traffic = commands.add_parser("replay", help="send the logged requests to a proxy")
+    send_traffic.add_argument("log")
+    send_traffic.add_argument("--proxy", type=parse_address, default=("127.0.0.1", 18888),
+                              help="HOST:PORT of the proxy")
+    send_traffic.add_argument("--speed", type=float, default=1.0,
+                              help="timing scale; 0 sends back to back")
+    send_traffic.add_argument("--concurrency", type=int, default=64,
+                              help="requests in flight at most")
+    send_traffic.add_argument("--limit", type=int, help="replay only the first N requests")
+    send_traffic.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    if args.command == "warm":
+        entry_point(args.port, ProxyConfig(processes=args.processes, warm_file=args.log,
+                                           warm_parallelism=args.parallelism), args.engine)
+        return
+
+    with open(args.log, encoding="utf-8", errors="replace") as f:
+        records = list(read_request_log(f))
+    if args.limit is not None:
+        records = records[:args.limit]
+    if not records:
+        print("[FATAL] No requests in %s" % args.log, file=sys.stderr)
+        exit(-1)
+    report = asyncio.run(replay(records, args.proxy, args.speed, args.concurrency))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,37 @@
 import sys
+import os
+import gzip
+import json
+import logging
+import multiprocessing
+import resource
+import signal
+import tempfile
+import asyncio
+import socket
+import threading
+import time
+import tracemalloc
 from proxy import check_http_request_validity, parse_http_request, HttpRequestState, HttpRequestInfo
+from proxy import ProxyConfig, ProxyContext, serve_forever, async_serve_forever
+from proxy import entry_point
+from proxy import BodyFramer, parse_response_head, ResponseCache
+from proxy import CacheEntry, is_cacheable_response, lookup_response, store_response
+from proxy import SingleFlight, UpstreamError, UpstreamPool, client_keeps_alive
+from proxy import socket_is_idle
+from proxy import ClientReader, RequestHeadTooLarge, RequestBody, TunnelRelay
+from proxy import Resolver, connect_racing
+from proxy import DiskCache, TieredCache, send_entry, send_buffers
+from proxy import BodySpool, prefetch
+from proxy import start_logging, access_log
+from proxy import Histogram, start_admin_server
+from proxy import choose_encoding, StreamEncoder, OriginResponse, decode_chunked
+from proxy import compressed_variant, async_compressed_variant, get_header
+from proxy import parse_request_record, warm_cache, cache_key
+from proxy import HashRing, resource_key
+from proxy import RateLimiter, ConcurrencyLimit, AsyncConcurrencyLimit
+from proxy import parse_range
+from replay import send as replay_send
 
 #######################################
 # Leave the code below as is. (Tests)
@@ -165,7 +197,7 @@ def simple_http_validation_test_cases():
     #######################################
 
     case = "Parse an invalid HTTP request (not-supported method)"
-    req_str = "HEAD / HTTP/1.0\r\nHost: www.google.edu\r\n\r\n"
+    req_str = "TRACE / HTTP/1.0\r\nHost: www.google.edu\r\n\r\n"
 
     actual_value = check_http_request_validity(req_str)
     correct_value = HttpRequestState.NOT_SUPPORTED
@@ -250,6 +282,2253 @@ def simple_http_validation_test_cases():
     print(f"[success] {case}")
 
 
+def request_parsing_test_cases():
+    """
+    The single-pass parser keeps header values, ports and queries
+    intact.
+    """
+    client_addr = ("127.0.0.1", 9877)
+
+    case = "Header values may contain colons"
+    req_str = "GET / HTTP/1.1\r\nHost: www.google.com\r\nReferer: http://www.google.com:80/\r\n\r\n"
+    parsed = parse_http_request(client_addr, req_str)
+
+    actual_value = parsed.headers[1]
+    correct_value = ["Referer", "http://www.google.com:80/"]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Host header port and query string are parsed"
+    parsed = parse_http_request(client_addr, b"GET /search?q=1 HTTP/1.1\r\nHost: www.google.com:8080\r\n\r\n")
+
+    actual_value = (parsed.requested_host, parsed.requested_port,
+                    parsed.requested_path, parsed.headers[0])
+    correct_value = ("www.google.com", 8080, "/search?q=1", ["Host", "www.google.com"])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Full URL wins over a stale Host header"
+    parsed = parse_http_request(client_addr, "GET http://www.google.com:81/a HTTP/1.0\r\nHost: other\r\n\r\n")
+
+    actual_value = (parsed.requested_host, parsed.requested_port,
+                    parsed.requested_path, parsed.headers)
+    correct_value = ("www.google.com", 81, "/a", [["Host", "www.google.com"]])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Malformed port is an invalid request"
+    req_str = "GET / HTTP/1.0\r\nHost: www.google.com:http\r\n\r\n"
+
+    actual_value = check_http_request_validity(req_str)
+    correct_value = HttpRequestState.INVALID_INPUT
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value.name, actual_value.name)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    # each of these could make the origin frame the forwarded head
+    # differently than the proxy did
+    smuggled = [("a bare LF in a header value", b"X-A: x\nContent-Length: 5\r\n"),
+                ("a bare CR in a header value", b"X-A: x\rContent-Length: 5\r\n"),
+                ("a NUL in a header value", b"X-A: x\x00y\r\n"),
+                ("a control character in a header value", b"X-A: x\x1by\r\n"),
+                ("a control character in a header name", b"X\x01A: x\r\n"),
+                ("whitespace before the colon", b"Content-Length : 5\r\n"),
+                ("a folded header line", b"X-A: x\r\n X-B: y\r\n"),
+                ("a bare LF in the request line", None)]
+    for (what, line) in smuggled:
+        case = "A request with %s is invalid" % what
+        if line is None:
+            req = b"GET\n/ HTTP/1.1\r\nHost: www.google.com\r\n\r\n"
+        else:
+            req = b"GET / HTTP/1.1\r\nHost: www.google.com\r\n" + line + b"\r\n"
+
+        actual_value = check_http_request_validity(req)
+        correct_value = HttpRequestState.INVALID_INPUT
+        assert correct_value == actual_value,\
+            f"[Line {lineno()}] [failed] {case}"\
+            " Expected ( %s ) got ( %s )" % (correct_value.name, actual_value.name)
+        print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A tab inside a header value is kept"
+    parsed = parse_http_request(client_addr, b"GET / HTTP/1.1\r\nHost: www.google.com\r\nX-A: a\tb\r\n\r\n")
+
+    actual_value = parsed.headers[1]
+    correct_value = ["X-A", "a\tb"]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def open_listener():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(30)
+    return listener, listener.getsockname()[1]
+
+
+def worker_pool_test_cases():
+    """
+    The accept loop hands connections to a bounded pool and
+    answers 503 once both the workers and the queue are busy.
+    """
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    config = ProxyConfig(workers=1, queue_depth=1, drain_timeout=5)
+    server = threading.Thread(target=serve_forever,
+                              args=(listener, ProxyContext(config), shutdown))
+    server.start()
+
+    case = "Saturated worker pool rejects new clients with 503"
+    busy = socket.create_connection(("127.0.0.1", port))
+    time.sleep(0.2)     # let the only worker pick up the first client
+    queued = socket.create_connection(("127.0.0.1", port))
+    time.sleep(0.2)
+    rejected = socket.create_connection(("127.0.0.1", port))
+    rejected.settimeout(5)
+
+    actual_value = rejected.recv(100).split(b"\r\n")[0]
+    correct_value = b"HTTP/1.0 503 Service Unavailable"
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Shutdown drains queued clients and stops the workers"
+    for conn in (busy, queued, rejected):
+        conn.close()
+    shutdown.set()
+    server.join(10)
+    listener.close()
+
+    actual_value = server.is_alive()
+    correct_value = False
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def worker_pids(parent):
+    """
+    The live child processes of parent, from /proc.
+    """
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as f:
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent and fields[0] != "Z":
+            pids.append(int(name))
+    return sorted(pids)
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def multi_process_test_cases():
+    """
+    The supervisor keeps config.processes workers serving, restarts
+    one that dies and drains them all on SIGTERM.
+    """
+    listener, port = open_listener()
+    listener.close()
+    config = ProxyConfig(processes=2, workers=2, drain_timeout=5, log_level="ERROR")
+    supervisor = multiprocessing.get_context("fork").Process(
+        target=entry_point, args=(port, config, "threads"))
+    supervisor.start()
+
+    def status_line():
+        try:
+            return send_raw_request(port, b"GOAT / HTTP/1.0\r\n\r\n").split(b"\r\n")[0]
+        except OSError:
+            return None
+
+    case = "Supervisor starts the configured number of workers"
+    started = wait_until(lambda: len(worker_pids(supervisor.pid)) == 2)
+    workers = worker_pids(supervisor.pid)
+    wait_until(status_line)
+
+    actual_value = (started, status_line())
+    correct_value = (True, b"HTTP/1.0 400 Bad Request")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A killed worker is replaced"
+    os.kill(workers[0], signal.SIGKILL)
+    restarted = wait_until(lambda: len(worker_pids(supervisor.pid)) == 2 and
+                           workers[0] not in worker_pids(supervisor.pid))
+
+    actual_value = (restarted, workers[1] in worker_pids(supervisor.pid), status_line())
+    correct_value = (True, True, b"HTTP/1.0 400 Bad Request")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "SIGTERM drains the workers and stops the supervisor"
+    workers = worker_pids(supervisor.pid)
+    os.kill(supervisor.pid, signal.SIGTERM)
+    supervisor.join(15)
+
+    actual_value = (supervisor.exitcode,
+                    [pid for pid in workers if os.path.exists("/proc/%d" % pid)])
+    correct_value = (0, [])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def send_raw_request(port, raw):
+    conn = socket.create_connection(("127.0.0.1", port), timeout=5)
+    conn.sendall(raw)
+    response = b""
+    while True:
+        packet = conn.recv(65536)
+        if not packet:
+            break
+        response = response + packet
+    conn.close()
+    return response
+
+
+def asyncio_engine_test_cases():
+    """
+    The asyncio engine runs the same pipeline over streams.
+    """
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    config = ProxyConfig(drain_timeout=1, client_idle_timeout=60)
+    server = threading.Thread(target=asyncio.run, args=(
+        async_serve_forever(listener, ProxyContext(config, "asyncio"), shutdown),))
+    server.start()
+
+    case = "asyncio engine answers an invalid request with 400"
+    response = send_raw_request(port, b"GOAT / HTTP/1.0\r\n\r\n")
+
+    actual_value = response.split(b"\r\n")[0]
+    correct_value = b"HTTP/1.0 400 Bad Request"
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "asyncio engine shutdown cuts off an idle kept-alive client after drain_timeout"
+    idle = socket.create_connection(("127.0.0.1", port), timeout=10)
+    time.sleep(0.2)
+    started = time.monotonic()
+    shutdown.set()
+    server.join(10)
+    listener.close()
+
+    actual_value = (server.is_alive(), time.monotonic() - started < 5, idle.recv(100))
+    correct_value = (False, True, b"")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    idle.close()
+
+
+def body_framing_test_cases():
+    """
+    The relay uses BodyFramer to find where a response ends.
+    """
+    case = "Content-Length body stops at the declared length"
+    (status, headers) = parse_response_head(
+        b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n")
+    framer = BodyFramer.for_response(status, headers, "GET")
+    data = b"helloEXTRA"
+
+    actual_value = (framer.feed(data, 0, len(data)), framer.done)
+    correct_value = (5, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Chunked body split across reads ends after the last chunk"
+    (status, headers) = parse_response_head(
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+    framer = BodyFramer.for_response(status, headers, "GET")
+    data = b"5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\n\r\nNEXT"
+    used = 0
+    for i in range(0, len(data), 3):
+        used += framer.feed(data, i, min(i + 3, len(data)))
+        if framer.done:
+            break
+
+    actual_value = (used, framer.done)
+    correct_value = (len(data) - len(b"NEXT"), True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    for size in (b"-5", b"0x10", b"1_0", b" +a", b"", b"g", b"1" * 17):
+        case = "Chunk size %r is rejected" % size
+        framer = BodyFramer(BodyFramer.CHUNKED)
+        data = size + b"\r\nhello\r\n0\r\n\r\n"
+        try:
+            framer.feed(data, 0, len(data))
+            actual_value = "accepted"
+        except ValueError:
+            actual_value = "rejected"
+
+        correct_value = "rejected"
+        assert correct_value == actual_value,\
+            f"[Line {lineno()}] [failed] {case}"\
+            " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+        print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Responses to HEAD have no body"
+    (status, headers) = parse_response_head(
+        b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n")
+    framer = BodyFramer.for_response(status, headers, "HEAD")
+
+    actual_value = framer.done
+    correct_value = True
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Badly framed origin response gets the client a 502"
+    responses = [b"HTTP/1.1 200 OK\r\nContent-Length: abc\r\n\r\nhello",
+                 b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\nContent-Length: 7\r\n\r\nhello",
+                 b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\nhello\r\n"]
+    results = []
+    # the asyncio engine sends the head before reading any of the body
+    cases = [("threads", response) for response in responses] + \
+        [("asyncio", response) for response in responses[:2]]
+    for (engine, response) in cases:
+        origin, origin_port = open_listener()
+        origin_thread = threading.Thread(target=serve_canned_responses,
+                                         args=(origin, response, 1))
+        origin_thread.start()
+        listener, port = open_listener()
+        shutdown = threading.Event()
+        context = ProxyContext(ProxyConfig(workers=2), engine)
+        if engine == "asyncio":
+            server = threading.Thread(target=asyncio.run, args=(
+                async_serve_forever(listener, context, shutdown),))
+        else:
+            server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+        server.start()
+        answer = send_raw_request(port, b"GET http://127.0.0.1:%d/ HTTP/1.1\r\n"
+                                        b"Host: 127.0.0.1\r\n\r\n" % origin_port)
+        results.append(answer.split(b"\r\n")[0])
+        shutdown.set()
+        server.join(10)
+        origin_thread.join(10)
+        listener.close()
+        origin.close()
+        context.close()
+
+    actual_value = results
+    correct_value = [b"HTTP/1.0 502 Bad Gateway"] * 5
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def response_cache_test_cases():
+    """
+    ResponseCache keeps to its byte budget by evicting the least
+    recently used entries.
+    """
+    cache = ResponseCache(max_bytes=30, max_entry_bytes=20, stripes=1)
+
+    case = "Least recently used entry is evicted when over budget"
+    cache.put("a", b"x" * 10)
+    cache.put("b", b"x" * 10)
+    cache.get("a")
+    cache.put("c", b"x" * 15)
+
+    actual_value = (cache.get("a") is not None, cache.get("b") is not None)
+    correct_value = (True, False)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Entries over the per-entry cap are not stored"
+
+    actual_value = cache.put("d", b"x" * 21)
+    correct_value = False
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Cache counters track hits, misses, evictions and bytes"
+    stats = cache.stats()
+
+    actual_value = (stats["hits"], stats["misses"], stats["evictions"],
+                    stats["rejected"], stats["bytes"])
+    correct_value = (2, 1, 1, 1, 25)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def http_caching_test_cases():
+    """
+    The cache follows Cache-Control, Expires and Vary.
+    """
+    client_addr = ("127.0.0.1", 9877)
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/",
+                              [["Host", "www.google.com"]])
+
+    case = "Responses marked no-store are not cacheable"
+    headers = [["Cache-Control", "no-store"], ["ETag", '"a"']]
+
+    actual_value = is_cacheable_response(request, 200, headers)
+    correct_value = False
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "max-age wins over Expires and sets the freshness lifetime"
+    headers = [["Date", "Mon, 01 Jan 2024 00:00:00 GMT"],
+               ["Expires", "Mon, 01 Jan 2024 01:00:00 GMT"],
+               ["Cache-Control", "public, max-age=60"]]
+    entry = CacheEntry.from_response("HTTP/1.1 200 OK", 200, headers, b"x",
+                                     1000.0, 1000.0)
+
+    actual_value = (entry.freshness_lifetime, entry.is_fresh(1030.0),
+                    entry.is_fresh(1061.0))
+    correct_value = (60, True, False)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A 304 refreshes a stale entry and keeps its body"
+    headers = [["Cache-Control", "max-age=0"], ["ETag", '"a"']]
+    entry = CacheEntry.from_response("HTTP/1.1 200 OK", 200, headers, b"body",
+                                     1000.0, 1000.0)
+    refreshed = entry.revalidated([["Cache-Control", "max-age=60"]], 2000.0, 2000.0)
+
+    actual_value = (entry.is_fresh(1000.5), refreshed.is_fresh(2000.5),
+                    refreshed.body, refreshed.etag)
+    correct_value = (False, True, b"body", '"a"')
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Responses with Vary are looked up per request-header value"
+    cache = ResponseCache()
+    english = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/",
+                              [["Host", "www.google.com"], ["Accept-Language", "en"]])
+    french = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/",
+                             [["Host", "www.google.com"], ["Accept-Language", "fr"]])
+    headers = [["Cache-Control", "max-age=60"], ["Vary", "Accept-Language"]]
+    store_response(cache, english, CacheEntry.from_response(
+        "HTTP/1.1 200 OK", 200, headers, b"hello", 1000.0, 1000.0))
+
+    actual_value = (lookup_response(cache, english).body,
+                    lookup_response(cache, french))
+    correct_value = (b"hello", None)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def single_flight_test_cases():
+    """
+    Concurrent misses on one key share a single fetch.
+    """
+    flights = SingleFlight()
+
+    case = "Only the first caller for a key leads the fetch"
+    (flight, leader) = flights.begin("key")
+    (same_flight, second_leader) = flights.begin("key")
+
+    actual_value = (leader, second_leader, same_flight is flight)
+    correct_value = (True, False, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Waiters see the leader's error"
+    outcome = []
+
+    def waiter():
+        try:
+            outcome.append(same_flight.wait(5))
+        except UpstreamError as e:
+            outcome.append(str(e))
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    flights.finish("key", flight, error=UpstreamError("origin down"))
+    t.join()
+
+    actual_value = outcome
+    correct_value = ["origin down"]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A finished key starts a new flight"
+    (flight, leader) = flights.begin("key")
+
+    actual_value = leader
+    correct_value = True
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Waiters on a failed fetch get a 502 and their connection closed"
+    results = []
+    for engine in ("threads", "asyncio"):
+        origin, origin_port = open_listener()
+
+        def fail_slowly():
+            (conn, address) = origin.accept()
+            conn.recv(65536)
+            time.sleep(0.5)
+            conn.close()
+        origin_thread = threading.Thread(target=fail_slowly)
+        origin_thread.start()
+        listener, port = open_listener()
+        shutdown = threading.Event()
+        context = ProxyContext(ProxyConfig(workers=4), engine)
+        if engine == "asyncio":
+            server = threading.Thread(target=asyncio.run, args=(
+                async_serve_forever(listener, context, shutdown),))
+        else:
+            server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+        server.start()
+        raw = b"GET http://127.0.0.1:%d/ HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n" % origin_port
+        responses = []
+        clients = [threading.Thread(target=lambda: responses.append(send_raw_request(port, raw)))
+                   for i in range(2)]
+        for client in clients:
+            client.start()
+            time.sleep(0.1)
+        for client in clients:
+            client.join(10)
+        results.append(sorted(response.split(b"\r\n")[0] for response in responses))
+        shutdown.set()
+        server.join(10)
+        origin_thread.join(10)
+        listener.close()
+        origin.close()
+
+    actual_value = results
+    correct_value = [[b"HTTP/1.0 502 Bad Gateway"] * 2] * 2
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def upstream_pool_test_cases():
+    """
+    Idle origin connections are reused while they are healthy.
+    """
+    closed = []
+    healthy = {"a": True, "b": False}
+    pool = UpstreamPool(max_idle_per_host=1, idle_timeout=60,
+                        is_healthy=lambda conn: healthy[conn],
+                        close=closed.append)
+    origin = ("www.google.com", 80)
+
+    case = "A returned connection is handed out again"
+    first = pool.checkout(origin)
+    pool.checkin(origin, "a")
+
+    actual_value = (first, pool.checkout(origin))
+    correct_value = (None, "a")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Unhealthy and surplus connections are closed"
+    pool.checkin(origin, "b")
+    pool.checkin(origin, "a")       # over max_idle_per_host
+
+    actual_value = (pool.checkout(origin), closed)
+    correct_value = (None, ["a", "b"])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Pool counters record reuse and discards"
+    stats = pool.stats()
+
+    actual_value = (stats["reused"], stats["created"], stats["unhealthy"],
+                    stats["overflow"], stats["idle"])
+    correct_value = (1, 2, 1, 1, 0)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Health check works on descriptors past select's limit of 1024"
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 1200:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(1200, hard), hard))
+    (conn, origin_side) = socket.socketpair()
+    high = socket.socket(fileno=os.dup2(conn.fileno(), 1100))
+    idle = socket_is_idle(high)
+    origin_side.close()
+
+    actual_value = (high.fileno(), idle, socket_is_idle(high))
+    correct_value = (1100, True, False)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    high.close()
+    conn.close()
+
+    #######################################
+    #######################################
+    case = "asyncio engine drops a pooled connection the origin sent more on"
+    origin, origin_port = open_listener()
+
+    def misbehave():
+        # answers, then times the idle connection out with an unasked 408
+        (conn, address) = origin.accept()
+        conn.recv(65536)
+        conn.sendall(b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\n"
+                     b"Content-Length: 5\r\n\r\nfirst")
+        time.sleep(0.2)
+        conn.sendall(b"HTTP/1.1 408 Request Timeout\r\nContent-Length: 0\r\n"
+                     b"Connection: close\r\n\r\n")
+        conn.close()
+        (conn, address) = origin.accept()
+        conn.recv(65536)
+        conn.sendall(b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\n"
+                     b"Content-Length: 6\r\n\r\nsecond")
+        conn.close()
+    origin_thread = threading.Thread(target=misbehave, daemon=True)
+    origin_thread.start()
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(), "asyncio")
+    server = threading.Thread(target=asyncio.run, args=(
+        async_serve_forever(listener, context, shutdown),))
+    server.start()
+    raw = (b"GET http://127.0.0.1:%d/ HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+           b"Connection: close\r\n\r\n" % origin_port)
+    first = send_raw_request(port, raw)
+    time.sleep(0.5)
+    second = send_raw_request(port, raw)
+    shutdown.set()
+    server.join(10)
+    origin_thread.join(10)
+    listener.close()
+    origin.close()
+
+    actual_value = (first.split(b"\r\n")[0], first.endswith(b"first"),
+                    second.split(b"\r\n")[0], second.endswith(b"second"))
+    correct_value = (b"HTTP/1.1 200 OK", True, b"HTTP/1.1 200 OK", True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def keep_alive_test_cases():
+    """
+    Client connections stay open between requests and pipelined
+    requests are answered in order.
+    """
+    client_addr = ("127.0.0.1", 9877)
+
+    case = "HTTP/1.1 keeps the connection unless the client asks to close"
+    requests = ["GET / HTTP/1.1\r\nHost: www.google.com\r\n\r\n",
+                "GET / HTTP/1.1\r\nHost: www.google.com\r\nConnection: close\r\n\r\n",
+                "GET / HTTP/1.0\r\nHost: www.google.com\r\n\r\n",
+                "GET / HTTP/1.0\r\nHost: www.google.com\r\nConnection: keep-alive\r\n\r\n"]
+
+    actual_value = [client_keeps_alive(parse_http_request(client_addr, raw))
+                    for raw in requests]
+    correct_value = [True, False, False, True]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Pipelined requests are answered in order on one connection"
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=1))
+    now = time.time()
+    for path in ("/a", "/b"):
+        request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, path,
+                                  [["Host", "www.google.com"]])
+        store_response(context.cache, request, CacheEntry.from_response(
+            "HTTP/1.1 200 OK", 200, [["Cache-Control", "max-age=600"]],
+            path.encode(), now, now))
+    server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+    server.start()
+    response = send_raw_request(port, b"GET /a HTTP/1.1\r\nHost: www.google.com\r\n\r\n"
+                                      b"GET /b HTTP/1.1\r\nHost: www.google.com\r\n"
+                                      b"Connection: close\r\n\r\n")
+
+    actual_value = [message.split(b"\r\n\r\n")[1]
+                    for message in response.split(b"HTTP/1.1 200 OK")[1:]]
+    correct_value = [b"/a", b"/b"]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    shutdown.set()
+    server.join(10)
+    listener.close()
+
+
+def client_reader_test_cases():
+    """
+    ClientReader cuts request heads out of its buffer and keeps
+    the bytes that follow them.
+    """
+    (client, proxy_side) = socket.socketpair()
+    reader = ClientReader(proxy_side, 64)
+
+    case = "Head split across reads is found and its body is kept"
+    raw = b"POST / HTTP/1.0\r\nHost: a\r\n\r\nbody"
+    for i in range(0, len(raw), 5):
+        client.sendall(raw[i:i + 5])
+    client.shutdown(socket.SHUT_WR)
+
+    actual_value = (reader.read_head(5, 5), bytes(reader.read(100)), bytes(reader.read(100)))
+    correct_value = (raw[:-4], b"body", b"")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    client.close()
+    proxy_side.close()
+
+    #######################################
+    #######################################
+    case = "A head bigger than the buffer is refused"
+    (client, proxy_side) = socket.socketpair()
+    reader = ClientReader(proxy_side, 64)
+    client.sendall(b"GET / HTTP/1.0\r\nX-Long: " + b"a" * 100)
+
+    try:
+        reader.read_head(5, 5)
+        actual_value = False
+    except RequestHeadTooLarge:
+        actual_value = True
+    correct_value = True
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    client.close()
+    proxy_side.close()
+
+    #######################################
+    #######################################
+    case = "A client that stops in the middle of a head times out"
+    (client, proxy_side) = socket.socketpair()
+    reader = ClientReader(proxy_side, 64)
+    client.sendall(b"GET / HTTP/1.0\r\n")
+
+    try:
+        reader.read_head(5, 0.2)
+        actual_value = False
+    except socket.timeout:
+        actual_value = True
+    correct_value = True
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    client.close()
+    proxy_side.close()
+
+
+def request_body_test_cases():
+    """
+    Request bodies are streamed to the origin; HEAD is answered
+    from the cache like GET.
+    """
+    client_addr = ("127.0.0.1", 9877)
+
+    case = "Chunked request body is forwarded and the next request kept"
+    (client, proxy_side) = socket.socketpair()
+    (origin_side, origin) = socket.socketpair()
+    reader = ClientReader(proxy_side, 256)
+    client.sendall(b"POST / HTTP/1.1\r\nHost: www.google.com\r\n"
+                   b"Transfer-Encoding: chunked\r\n\r\n"
+                   b"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n"
+                   b"GET / HTTP/1.1\r\nHost: www.google.com\r\n\r\n")
+    request = parse_http_request(client_addr, reader.read_head(5, 5))
+    RequestBody.for_request(reader, request, 5).send_to(origin_side)
+    origin_side.close()
+
+    actual_value = (read_until_closed(origin), reader.read_head(5, 5)[:6])
+    correct_value = (b"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n", b"GET / ")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    for conn in (client, proxy_side, origin):
+        conn.close()
+
+    #######################################
+    #######################################
+    case = "Ambiguously framed request bodies are refused"
+    head = "POST / HTTP/1.1\r\nHost: www.google.com\r\n"
+    framings = ["Content-Length: 5\r\nContent-Length: 40\r\n",
+                "Content-Length: 5\r\nContent-Length: 5\r\n",
+                "Transfer-Encoding: gzip\r\n",
+                "Transfer-Encoding: xchunked\r\n",
+                "Transfer-Encoding: chunked\r\nContent-Length: 5\r\n",
+                "Transfer-Encoding: gzip\r\nTransfer-Encoding: chunked\r\n"]
+    requests = [parse_http_request(client_addr, head + framing + "\r\n")
+                for framing in framings]
+
+    actual_value = [None if request is None else
+                    [name for (name, value) in request.headers] for request in requests]
+    correct_value = [None, ["Host", "Content-Length"], None, None, None,
+                     ["Host", "Transfer-Encoding", "Transfer-Encoding"]]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Requests without a body have no RequestBody"
+    request = parse_http_request(client_addr, "DELETE / HTTP/1.1\r\nHost: www.google.com\r\n\r\n")
+
+    actual_value = RequestBody.for_request(None, request)
+    correct_value = None
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "HEAD is answered from a stored GET response without its body"
+    cache = ResponseCache()
+    now = time.time()
+    get = parse_http_request(client_addr, "GET / HTTP/1.1\r\nHost: www.google.com\r\n\r\n")
+    head = parse_http_request(client_addr, "HEAD / HTTP/1.1\r\nHost: www.google.com\r\n\r\n")
+    store_response(cache, get, CacheEntry.from_response(
+        "HTTP/1.1 200 OK", 200, [["Cache-Control", "max-age=60"]], b"hello", now, now))
+    answer = b"".join(lookup_response(cache, head).buffers_for(head, now))
+
+    actual_value = (b"Content-Length: 5" in answer, answer.endswith(b"\r\n\r\n"))
+    correct_value = (True, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A stored HEAD response keeps the origin's Content-Length"
+    cache = ResponseCache()
+    store_response(cache, head, CacheEntry.from_response(
+        "HTTP/1.1 200 OK", 200, [["Content-Length", "42"], ["Cache-Control", "max-age=60"]],
+        b"", now, now, "HEAD"))
+    answer = b"".join(lookup_response(cache, head).buffers_for(head, now))
+
+    actual_value = (answer.count(b"Content-Length"), b"Content-Length: 42" in answer,
+                    lookup_response(cache, get))
+    correct_value = (1, True, None)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A bad chunk size in a request body gets 400 and is not forwarded, both engines"
+    results = []
+    for engine in ("threads", "asyncio"):
+        origin, origin_port = open_listener()
+        received = []
+
+        def read_request():
+            (conn, address) = origin.accept()
+            received.append(read_until_closed(conn))
+            conn.close()
+        origin_thread = threading.Thread(target=read_request, daemon=True)
+        origin_thread.start()
+        listener, port = open_listener()
+        shutdown = threading.Event()
+        context = ProxyContext(ProxyConfig(workers=2), engine)
+        if engine == "asyncio":
+            server = threading.Thread(target=asyncio.run, args=(
+                async_serve_forever(listener, context, shutdown),))
+        else:
+            server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+        server.start()
+        response = send_raw_request(port, b"POST http://127.0.0.1:%d/ HTTP/1.1\r\n"
+                                          b"Host: 127.0.0.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                          b"3\r\nabc\r\n-5\r\nhello\r\n0\r\n\r\n" % origin_port)
+        origin_thread.join(5)
+        shutdown.set()
+        server.join(10)
+        listener.close()
+        origin.close()
+        results.append((response.split(b"\r\n")[0], b"-5" in b"".join(received)))
+
+    actual_value = results
+    correct_value = [(b"HTTP/1.0 400 Bad Request", False)] * 2
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def read_until_closed(conn):
+    data = b""
+    while True:
+        packet = conn.recv(65536)
+        if not packet:
+            return data
+        data = data + packet
+
+
+def tunnel_test_cases():
+    """
+    CONNECT tunnels relay both directions and pass on half-closes.
+    """
+    case = "CONNECT needs a port in its target"
+    actual_value = (check_http_request_validity("CONNECT www.google.com:443 HTTP/1.1\r\n\r\n"),
+                    check_http_request_validity("CONNECT www.google.com HTTP/1.1\r\n\r\n"))
+    correct_value = (HttpRequestState.GOOD, HttpRequestState.INVALID_INPUT)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    for use_splice in sorted(set([False, hasattr(os, "splice")])):
+        #######################################
+        #######################################
+        case = "Tunnel relays both ways and half-closes (splice=%s)" % use_splice
+        relay = TunnelRelay(idle_timeout=5, use_splice=use_splice)
+        (client, client_side) = socket.socketpair()
+        (server_side, origin) = socket.socketpair()
+        relay.add(client_side, server_side)
+        request = b"x" * 300000
+        writer = threading.Thread(target=client.sendall, args=(request,))
+        writer.start()
+        origin.settimeout(5)
+        received = b""
+        while len(received) < len(request):
+            received = received + origin.recv(65536)
+        writer.join()
+        client.shutdown(socket.SHUT_WR)
+        origin_eof = origin.recv(10)
+        origin.sendall(b"reply")
+        origin.close()
+        client.settimeout(5)
+
+        actual_value = (received == request, origin_eof, read_until_closed(client))
+        correct_value = (True, b"", b"reply")
+        assert correct_value == actual_value,\
+            f"[Line {lineno()}] [failed] {case}"\
+            " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+        print(f"[success] {case}")
+        client.close()
+        relay.close_all()
+
+
+def resolver_test_cases():
+    """
+    Name lookups are cached, shared between concurrent callers, and
+    connections race the resolved addresses.
+    """
+    calls = []
+
+    def stub_lookup(host, port):
+        calls.append(host)
+        time.sleep(0.2)
+        if host == "missing.test":
+            raise socket.gaierror(socket.EAI_NONAME, "not found")
+        return [(socket.AF_INET, ("127.0.0.1", port))], None
+
+    resolver = Resolver(stub_lookup, positive_ttl=60, negative_ttl=60)
+
+    case = "Concurrent lookups of one name call the resolver once"
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve("www.google.com", 80)))
+               for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.append(resolver.resolve("www.google.com", 80))
+
+    actual_value = (calls, results.count([(socket.AF_INET, ("127.0.0.1", 80))]))
+    correct_value = (["www.google.com"], 6)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Failed lookups are cached too, IP addresses are not looked up"
+    failures = 0
+    for i in range(2):
+        try:
+            resolver.resolve("missing.test", 80)
+        except socket.gaierror:
+            failures += 1
+    resolver.resolve("127.0.0.1", 80)
+
+    actual_value = (failures, calls)
+    correct_value = (2, ["www.google.com", "missing.test"])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Connect moves past an address that refuses"
+    listener, port = open_listener()
+    refused, refused_port = open_listener()
+    refused.close()
+    conn = connect_racing([(socket.AF_INET, ("127.0.0.1", refused_port)),
+                           (socket.AF_INET, ("127.0.0.1", port))], 0.25, 5)
+
+    actual_value = conn.getpeername()
+    correct_value = ("127.0.0.1", port)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    conn.close()
+    listener.close()
+
+
+def disk_cache_test_cases():
+    """
+    The disk cache level survives restarts, serves big bodies straight
+    from its files and keeps to its byte budget.
+    """
+    directory = tempfile.TemporaryDirectory()
+    body = b"x" * 1000
+    entry = CacheEntry("HTTP/1.1 200 OK", 200, [("Cache-Control", "max-age=60")],
+                       body, time.time(), time.time())
+    cache = TieredCache(ResponseCache(max_bytes=4096, max_entry_bytes=500, stripes=1),
+                        DiskCache(directory.name, max_bytes=4096))
+
+    case = "Bodies too big for memory are kept on disk only"
+    cache.put("www.google.com:80/big", entry)
+
+    actual_value = (entry.body, entry.body_length, cache.get("www.google.com:80/big") is entry)
+    correct_value = (None, 1000, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Disk entries are found again after a restart"
+    cache = TieredCache(ResponseCache(max_bytes=4096, max_entry_bytes=500, stripes=1),
+                        DiskCache(directory.name, max_bytes=4096))
+    found = cache.get("www.google.com:80/big")
+
+    actual_value = (found.status, found.headers, found.with_body_loaded().body == body)
+    correct_value = (200, [("Cache-Control", "max-age=60")], True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Disk-backed entries are sent from the file"
+    request_info = parse_http_request(("127.0.0.1", 9877),
+                                      "GET /big HTTP/1.1\r\nHost: www.google.com\r\n\r\n")
+    (server, client) = socket.socketpair()
+    sent = send_entry(server, found, request_info, time.time())
+    server.close()
+    response = read_until_closed(client)
+    client.close()
+
+    actual_value = (sent, response.startswith(b"HTTP/1.1 200 OK\r\n"),
+                    b"Content-Length: 1000\r\n" in response, response.endswith(b"\r\n\r\n" + body))
+    correct_value = (True, True, True, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Least recently used files are deleted when over budget"
+    disk = DiskCache(directory.name, max_bytes=2600)
+    entry = CacheEntry("HTTP/1.1 200 OK", 200, [], body, time.time(), time.time())
+    for name in ("a", "b", "c"):
+        disk.store(name, entry)
+
+    actual_value = (disk.load("www.google.com:80/big"), disk.load("a"), disk.load("c") is not None,
+                    disk.stats()["evictions"], disk.stats()["bytes"] <= 2600)
+    correct_value = (None, None, True, 2, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "asyncio engine reads and writes the disk tier off its event loop"
+    origin, origin_port = open_listener()
+    origin_thread = threading.Thread(target=serve_canned_responses, args=(
+        origin, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nContent-Length: 1000\r\n"
+                b"Connection: close\r\n\r\n" + body, 1))
+    origin_thread.start()
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(disk_cache_dir=os.path.join(directory.name, "async"),
+                                       cache_object_limit=500), "asyncio")
+    disk_threads = []
+    for name in ("store", "load", "remove"):
+        def record(*args, call=getattr(context.cache.disk, name)):
+            disk_threads.append(threading.current_thread())
+            return call(*args)
+        setattr(context.cache.disk, name, record)
+    server = threading.Thread(target=asyncio.run, args=(
+        async_serve_forever(listener, context, shutdown),))
+    server.start()
+    raw = (b"GET http://127.0.0.1:%d/big HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+           b"Connection: close\r\n\r\n" % origin_port)
+    responses = [send_raw_request(port, raw) for i in range(2)]
+    shutdown.set()
+    server.join(10)
+    origin_thread.join(10)
+    listener.close()
+    origin.close()
+
+    actual_value = ([response.endswith(b"\r\n\r\n" + body) for response in responses],
+                    len(disk_threads) > 0, server in disk_threads)
+    correct_value = ([True, True], True, False)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Recovery removes only the temporary files whose writer is gone"
+    shared = os.path.join(directory.name, "shared")
+    os.makedirs(os.path.join(shared, "ab"))
+    finished = multiprocessing.Process(target=int)
+    finished.start()
+    finished.join()
+    names = ["%d.live.tmp" % os.getppid(), "%d.stalled.tmp" % os.getppid(),
+             "%d.dead.tmp" % finished.pid, "unnamed.tmp"]
+    for name in names:
+        open(os.path.join(shared, "ab", name), "wb").close()
+    stalled = time.time() - DiskCache.TEMP_FILE_GRACE - 60
+    os.utime(os.path.join(shared, "ab", names[1]), (stalled, stalled))
+    DiskCache(shared)
+
+    actual_value = sorted(os.listdir(os.path.join(shared, "ab")))
+    correct_value = sorted([names[0], names[3]])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Missed bodies too big for memory go straight to disk as they are relayed"
+    context = ProxyContext(ProxyConfig(disk_cache_dir=os.path.join(directory.name, "spool"),
+                                       cache_object_limit=64 * 1024))
+    large = bytes(range(256)) * 16 * 1024
+    chunked = b"".join(b"%x\r\n%s\r\n" % (65536, large[i:i + 65536])
+                       for i in range(0, len(large), 65536)) + b"0\r\n\r\n"
+    responses = [b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nContent-Length: %d\r\n"
+                 b"Connection: close\r\n\r\n%s" % (len(large), large),
+                 b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nTransfer-Encoding: chunked\r\n"
+                 b"Connection: close\r\n\r\n" + chunked]
+    origin, origin_port = open_listener()
+    (entries, peaks, found) = ([], [], [])
+    for (path, response) in zip(("plain", "chunked"), responses):
+        origin_thread = threading.Thread(target=serve_canned_responses,
+                                         args=(origin, response, 1))
+        origin_thread.start()
+        request_info = parse_http_request(("127.0.0.1", 9877),
+                                          "GET http://127.0.0.1:%d/%s HTTP/1.1\r\n"
+                                          "Host: 127.0.0.1\r\n\r\n" % (origin_port, path))
+        tracemalloc.start()
+        entries.append(prefetch(context, request_info))
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        origin_thread.join(10)
+        found.append(lookup_response(context.cache, request_info))
+    origin.close()
+    context.close()
+    leftovers = [name for (root, dirs, files) in os.walk(os.path.join(directory.name, "spool"))
+                 for name in files if name.endswith(".tmp")]
+
+    actual_value = ([entry.body for entry in entries],
+                    [entry.with_body_loaded().body == large for entry in entries],
+                    [entry.body_file for entry in found] == [entry.body_file for entry in entries],
+                    [peak < len(large) // 4 for peak in peaks], leftovers)
+    correct_value = ([None, None], [True, True], True, [True, True], [])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    directory.cleanup()
+
+
+def send_buffers_test_cases():
+    """
+    Cache hits go out as a list of buffers, the stored head and body
+    untouched, surviving partial writes.
+    """
+    body = bytes(range(256)) * 16 * 1024
+    entry = CacheEntry("HTTP/1.1 200 OK", 200, [("Cache-Control", "max-age=60")],
+                       body, time.time(), time.time())
+
+    case = "Partial writes resume at the right byte"
+    (server, client) = socket.socketpair()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    buffers = entry.buffers(time.time(), keep_alive=False)
+    sender = threading.Thread(target=lambda: (send_buffers(server, buffers), server.close()))
+    sender.start()
+    response = read_until_closed(client)
+    sender.join()
+    client.close()
+
+    actual_value = (response == b"".join(bytes(buffer) for buffer in buffers),
+                    response.endswith(b"Connection: close\r\n\r\n" + body))
+    correct_value = (True, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "The stored head and body are shared by every hit"
+    (first, second) = (entry.buffers(time.time()), entry.buffers(time.time()))
+
+    actual_value = (first[0] is second[0], first[2] is second[2], first[2].readonly)
+    correct_value = (True, True, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def access_log_test_cases():
+    """
+    Served requests are written to the access log, one JSON object
+    per line, by the log listener thread.
+    """
+    client_addr = ("127.0.0.1", 9877)
+    directory = tempfile.TemporaryDirectory()
+    log_file = os.path.join(directory.name, "access.log")
+    listener = start_logging(ProxyConfig(log_level="WARNING", access_log=log_file))
+
+    proxy_listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=1))
+    now = time.time()
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/a",
+                              [["Host", "www.google.com"]])
+    store_response(context.cache, request, CacheEntry.from_response(
+        "HTTP/1.1 200 OK", 200, [["Cache-Control", "max-age=600"]], b"hello", now, now))
+    server = threading.Thread(target=serve_forever, args=(proxy_listener, context, shutdown))
+    server.start()
+    hit = send_raw_request(port, b"GET /a HTTP/1.1\r\nHost: www.google.com\r\n"
+                                 b"Connection: close\r\n\r\n")
+    send_raw_request(port, b"GOAT / HTTP/1.0\r\n\r\n")
+    shutdown.set()
+    server.join(10)
+    proxy_listener.close()
+    listener.stop()
+    with open(log_file) as f:
+        records = [json.loads(line) for line in f]
+
+    case = "A cache hit is logged with its status, size and cache result"
+    actual_value = (records[0]["method"], records[0]["url"], records[0]["status"],
+                    records[0]["bytes"], records[0]["cache"])
+    correct_value = ("GET", "http://www.google.com:80/a", 200, len(hit), "HIT")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A request that doesn't parse is logged with the error sent"
+    actual_value = (len(records), records[1]["method"], records[1]["status"])
+    correct_value = (2, "-", 400)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Nothing is logged while the access log is off"
+    listener = start_logging(ProxyConfig(log_level="WARNING"))
+    listener.stop()
+
+    actual_value = access_log.isEnabledFor(logging.INFO)
+    correct_value = False
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    directory.cleanup()
+
+
+def metrics_test_cases():
+    """
+    Stage timings and counters are served on the admin endpoint in
+    the Prometheus text format.
+    """
+    case = "Histogram buckets are cumulative and count values at their bound"
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    actual_value = histogram.snapshot()
+    correct_value = ([2, 3, 4], 2.65)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Served requests show up in /metrics"
+    client_addr = ("127.0.0.1", 9877)
+    proxy_listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=2))
+    now = time.time()
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/a",
+                              [["Host", "www.google.com"]])
+    store_response(context.cache, request, CacheEntry.from_response(
+        "HTTP/1.1 200 OK", 200, [["Cache-Control", "max-age=600"]], b"hello", now, now))
+    server = threading.Thread(target=serve_forever, args=(proxy_listener, context, shutdown))
+    server.start()
+    admin = start_admin_server(context, 0)
+    send_raw_request(port, b"GET /a HTTP/1.1\r\nHost: www.google.com\r\nConnection: close\r\n\r\n")
+    send_raw_request(port, b"GOAT / HTTP/1.0\r\n\r\n")
+    response = send_raw_request(admin.server_address[1], b"GET /metrics HTTP/1.0\r\n\r\n")
+    admin.shutdown()
+    admin.server_close()
+    shutdown.set()
+    server.join(10)
+    proxy_listener.close()
+    lines = response.decode().split("\r\n\r\n", 1)[1].splitlines()
+
+    actual_value = ['proxy_requests_total{status="200",cache="HIT"} 1' in lines,
+                    'proxy_requests_total{status="400",cache="-"} 1' in lines,
+                    'proxy_stage_seconds_count{stage="parse"} 2' in lines,
+                    'proxy_stage_seconds_count{stage="total"} 2' in lines,
+                    "proxy_connections_total 2" in lines,
+                    "proxy_workers 2" in lines,
+                    "# TYPE proxy_stage_seconds histogram" in lines]
+    correct_value = [True] * 7
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def timeout_test_cases():
+    """
+    Clients that stall are answered with 408 and origins that don't
+    answer with 504.
+    """
+    case = "Client stalling in the middle of its head gets 408"
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=2, header_timeout=0.5, first_byte_timeout=0.5,
+                                       client_idle_timeout=0.5))
+    server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+    server.start()
+    response = send_raw_request(port, b"GET / HTTP/1.1\r\nHost: www.goo")
+
+    actual_value = response.split(b"\r\n")[0]
+    correct_value = b"HTTP/1.0 408 Request Timeout"
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Origin that never answers gets 504"
+    origin, origin_port = open_listener()
+    started = time.monotonic()
+    response = send_raw_request(port, b"GET http://127.0.0.1:%d/ HTTP/1.1\r\n"
+                                      b"Connection: close\r\n\r\n" % origin_port)
+
+    actual_value = (response.split(b"\r\n")[0], time.monotonic() - started < 3)
+    correct_value = (b"HTTP/1.0 504 Gateway Timeout", True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Client stalling in the middle of its body gets 408"
+    response = send_raw_request(port, b"POST http://127.0.0.1:%d/ HTTP/1.1\r\n"
+                                      b"Content-Length: 10\r\n\r\nabc" % origin_port)
+
+    actual_value = response.split(b"\r\n")[0]
+    correct_value = b"HTTP/1.0 408 Request Timeout"
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    shutdown.set()
+    server.join(10)
+    listener.close()
+
+    #######################################
+    #######################################
+    case = "asyncio engine answers a silent origin with 504"
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(first_byte_timeout=0.5), "asyncio")
+    server = threading.Thread(target=asyncio.run, args=(
+        async_serve_forever(listener, context, shutdown),))
+    server.start()
+    response = send_raw_request(port, b"GET http://127.0.0.1:%d/ HTTP/1.1\r\n"
+                                      b"Connection: close\r\n\r\n" % origin_port)
+
+    actual_value = response.split(b"\r\n")[0]
+    correct_value = b"HTTP/1.0 504 Gateway Timeout"
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    shutdown.set()
+    server.join(10)
+    listener.close()
+    origin.close()
+
+
+def compression_test_cases():
+    """
+    Responses are compressed for clients that accept it, and cached
+    ones are compressed once.
+    """
+    case = "The accepted coding with the highest q-value is chosen"
+    values = ["gzip;q=0.5, deflate", "identity", "gzip;q=0", "*", "GZIP"]
+
+    actual_value = [choose_encoding([["Accept-Encoding", value]]) for value in values]
+    correct_value = ["deflate", None, None, choose_encoding([["Accept-Encoding", "br, gzip"]]),
+                     "gzip"]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Relayed chunked body is compressed on the way"
+    client_addr = ("127.0.0.1", 9877)
+    (origin, proxy_side) = socket.socketpair()
+    (client, proxy_client) = socket.socketpair()
+    text = b"some text " * 500
+    origin.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+                   b"Transfer-Encoding: chunked\r\n\r\n" +
+                   b"".join(b"%x\r\n%s\r\n" % (1000, text[i:i + 1000])
+                            for i in range(0, len(text), 1000)) + b"0\r\n\r\n")
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/", [],
+                              "HTTP/1.1")
+    request.keep_alive = True
+    upstream = OriginResponse(proxy_side)
+    upstream.read_head()
+    spool = BodySpool(upstream.status_line, upstream.status, upstream.headers, time.time(),
+                      time.time(), "GET", 1 << 20)
+    upstream.relay(proxy_client, spool, request, StreamEncoder("gzip"))
+    kept = spool.finish().body
+    proxy_client.close()
+    response = b""
+    while True:
+        packet = client.recv(65536)
+        if not packet:
+            break
+        response += packet
+    (head, body) = response.split(b"\r\n\r\n", 1)
+
+    actual_value = (gzip.decompress(decode_chunked(body)), b"Content-Encoding: gzip" in head,
+                    b"Vary: Accept-Encoding" in head, kept, request.keep_alive)
+    correct_value = (text, True, True, text, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+    for sock in (origin, proxy_side, client):
+        sock.close()
+
+    #######################################
+    #######################################
+    case = "Cached response is compressed once and kept next to the original"
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=2, compression=True))
+    now = time.time()
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/page",
+                              [["Host", "www.google.com"]])
+    store_response(context.cache, request, CacheEntry.from_response(
+        "HTTP/1.1 200 OK", 200, [["Cache-Control", "max-age=600"],
+                                 ["Content-Type", "text/html"]], text, now, now))
+    server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+    server.start()
+    raw = b"GET /page HTTP/1.1\r\nHost: www.google.com\r\nConnection: close\r\n"
+    responses = [send_raw_request(port, raw + b"Accept-Encoding: gzip\r\n\r\n")
+                 for i in range(2)] + [send_raw_request(port, raw + b"\r\n")]
+    shutdown.set()
+    server.join(10)
+    listener.close()
+
+    actual_value = ([gzip.decompress(response.split(b"\r\n\r\n", 1)[1])
+                     for response in responses[:2]],
+                    responses[2].split(b"\r\n\r\n", 1)[1],
+                    [b"Vary: Accept-Encoding\r\n" in response for response in responses],
+                    context.metrics.counters[("compressions", (("encoding", "gzip"),))],
+                    len(context.cache))
+    correct_value = ([text, text], text, [True, True, True], 1, 2)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Identity relay of a compressible response varies on Accept-Encoding"
+    origin, origin_port = open_listener()
+    origin_thread = threading.Thread(target=serve_canned_responses, args=(
+        origin, b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: no-store\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(text), text), 1), daemon=True)
+    origin_thread.start()
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=2, compression=True))
+    server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+    server.start()
+    response = send_raw_request(port, b"GET http://127.0.0.1:%d/ HTTP/1.1\r\n"
+                                      b"Host: 127.0.0.1\r\nConnection: close\r\n\r\n"
+                                % origin_port)
+    shutdown.set()
+    server.join(10)
+    origin_thread.join(10)
+    listener.close()
+    origin.close()
+
+    (head, body) = response.split(b"\r\n\r\n", 1)
+    actual_value = (b"Vary: Accept-Encoding" in head, b"Content-Encoding" in head, body)
+    correct_value = (True, False, text)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Bodies over cache_object_limit are not compressed, async copies are"
+    context = ProxyContext(ProxyConfig(compression=True, cache_object_limit=len(text) - 1),
+                           "asyncio")
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/page",
+                              [["Host", "www.google.com"], ["Accept-Encoding", "gzip"]])
+    headers = [["Cache-Control", "max-age=600"], ["Content-Type", "text/html"]]
+    large = CacheEntry.from_response("HTTP/1.1 200 OK", 200, headers, text, now, now)
+    small = CacheEntry.from_response("HTTP/1.1 200 OK", 200, headers, text[:2000], now, now)
+    variant = asyncio.run(async_compressed_variant(context, request, small))
+
+    identity = compressed_variant(context, request, large)
+    actual_value = (identity.body is large.body, get_header(identity.headers, "Vary"),
+                    asyncio.run(async_compressed_variant(context, request, large)) is identity,
+                    gzip.decompress(variant.body),
+                    compressed_variant(context, request, small) is variant)
+    correct_value = (True, "Accept-Encoding", True, text[:2000], True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def serve_canned_responses(listener, response, count):
+    """
+    Answers count requests on listener with response, one connection
+    each.
+    """
+    for i in range(count):
+        (conn, address) = listener.accept()
+        conn.recv(65536)
+        conn.sendall(response)
+        conn.close()
+
+
+def request_log_test_cases():
+    """
+    Request logs are read into requests, and their objects can be
+    fetched into the cache before serving.
+    """
+    case = "Request log lines become requests, other lines are skipped"
+    lines = ['{"request_id": "user-001", "title": "a change request"}',
+             '{"time": "2024-01-01 12:00:00,250", "method": "GET", '
+             '"url": "http://www.google.com:8080/a", "status": 200}',
+             '{"offset": 1.5, "request": "GET /b HTTP/1.1\\r\\nHost: www.google.com"}',
+             '{"method": "-", "url": "-", "status": 400}',
+             'not json']
+    records = [parse_request_record(line) for line in lines]
+
+    actual_value = [None if record is None else
+                    (record[2].method, record[2].requested_host, record[2].requested_port,
+                     record[2].requested_path, record[0] if record[0] == 1.5 else
+                     round(record[0] % 1, 3))
+                    for record in records]
+    correct_value = [None, ("GET", "www.google.com", 8080, "/a", 0.25),
+                     ("GET", "www.google.com", 80, "/b", 1.5), None, None]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Warming fetches each cacheable URL once into the cache"
+    origin, origin_port = open_listener()
+    origin_thread = threading.Thread(target=serve_canned_responses, args=(
+        origin, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nContent-Length: 4\r\n"
+                b"Connection: close\r\n\r\nwarm", 2))
+    origin_thread.start()
+    context = ProxyContext(ProxyConfig())
+    lines = ['{"method": "%s", "url": "http://127.0.0.1:%d/%s"}' % (method, origin_port, path)
+             for (method, path) in (("GET", "a"), ("GET", "b"), ("GET", "a"), ("POST", "c"))]
+    requests = [parse_request_record(line)[2] for line in lines]
+    results = warm_cache(context, requests, 2)
+    origin_thread.join(10)
+    origin.close()
+
+    actual_value = (dict(results), context.cache.get(cache_key(requests[1])).body)
+    correct_value = ({"stored": 2, "skipped": 2}, b"warm")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Warming counts an unexpected error as failed and keeps going"
+    # a port that isn't a number fails with TypeError, not an UpstreamError
+    requests = [HttpRequestInfo(("127.0.0.1", 9877), "GET", "127.0.0.1", "x", "/%d" % i,
+                                [["Host", "127.0.0.1"]]) for i in range(6)]
+    outcomes = []
+    warmer = threading.Thread(target=lambda: outcomes.append(warm_cache(context, requests, 1)),
+                              daemon=True)
+    warmer.start()
+    warmer.join(10)
+
+    actual_value = [dict(results) for results in outcomes]
+    correct_value = [{"failed": 6}]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Replay sends again on a new connection when an idle one was closed"
+    # keep-alive answers, but each connection is closed right after, as
+    # the proxy does once client_idle_timeout runs out
+    proxy_listener, proxy_port = open_listener()
+    proxy_thread = threading.Thread(target=serve_canned_responses, args=(
+        proxy_listener, b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok", 2), daemon=True)
+    proxy_thread.start()
+    raw = b"GET http://127.0.0.1/ HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+
+    async def replay_twice():
+        idle = []
+        first = await replay_send(idle, ("127.0.0.1", proxy_port), raw, "GET")
+        await asyncio.sleep(0.2)
+        second = await replay_send(idle, ("127.0.0.1", proxy_port), raw, "GET")
+        for (reader, writer) in idle:
+            writer.close()
+        return first[0], second[0]
+
+    actual_value = asyncio.run(replay_twice())
+    proxy_thread.join(10)
+    proxy_listener.close()
+    correct_value = (200, 200)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def peer_cache_test_cases():
+    """
+    Peers split the URLs between them with a consistent hash ring and
+    fetch the ones they don't own through their owner.
+    """
+    case = "Removing a node from the ring only moves its own keys"
+    nodes = ["127.0.0.1:%d" % port for port in (9001, 9002, 9003, 9004)]
+    keys = ["www.google.com:80/%d" % i for i in range(2000)]
+    before = HashRing(nodes)
+    after = HashRing(nodes[:3])
+    owners = [before.owner(key) for key in keys]
+    moved = [key for key in keys if before.owner(key) != after.owner(key)]
+
+    actual_value = (all(before.owner(key) == nodes[3] for key in moved),
+                    min(owners.count(node) for node in nodes) > 2000 / 4 * 0.6)
+    correct_value = (True, True)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A miss on a URL owned by a peer is fetched and cached by that peer"
+    origin, origin_port = open_listener()
+    origin_thread = threading.Thread(target=serve_canned_responses, args=(
+        origin, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nContent-Length: 4\r\n"
+                b"Connection: close\r\n\r\npeer", 2))
+    origin_thread.start()
+    listeners = [open_listener() for i in range(2)]
+    peers = ["127.0.0.1:%d" % port for (listener, port) in listeners]
+    contexts = [ProxyContext(ProxyConfig(workers=4, peers=peers, peer_self=node,
+                                         peer_check_interval=60))
+                for node in peers]
+    shutdowns = [threading.Event() for i in range(2)]
+    servers = [threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+               for ((listener, port), context, shutdown) in zip(listeners, contexts, shutdowns)]
+    for server in servers:
+        server.start()
+    # URLs of the origin the second proxy owns
+    urls = [url for url in ("http://127.0.0.1:%d/%d" % (origin_port, i) for i in range(100))
+            if contexts[0].peers.owner(resource_key(parse_request_record(
+                '{"method": "GET", "url": "%s"}' % url)[2])) is not None]
+    response = send_raw_request(listeners[0][1], b"GET %s HTTP/1.1\r\nConnection: close\r\n\r\n"
+                                % urls[0].encode())
+    request = parse_request_record('{"method": "GET", "url": "%s"}' % urls[0])[2]
+    # the peer stores the response once it has relayed all of it
+    wait_until(lambda: contexts[1].cache.get(cache_key(request)) is not None, 5)
+
+    actual_value = (response.split(b"\r\n\r\n")[1], len(contexts[0].cache),
+                    contexts[1].cache.get(cache_key(request)).body,
+                    contexts[0].metrics.counters[("requests", (("status", 200),
+                                                               ("cache", "PEER")))])
+    correct_value = (b"peer", 0, b"peer", 1)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A peer that fails is left out and the origin is asked instead"
+    shutdowns[1].set()
+    servers[1].join(10)
+    listeners[1][0].close()
+    contexts[0].upstream_pool.close_all()   # the connection to it the first fetch left
+    response = send_raw_request(listeners[0][1], b"GET %s HTTP/1.1\r\nConnection: close\r\n\r\n"
+                                % urls[1].encode())
+    shutdowns[0].set()
+    servers[0].join(10)
+    listeners[0][0].close()
+    origin_thread.join(10)
+    origin.close()
+
+    actual_value = (response.split(b"\r\n\r\n")[1], contexts[0].peers.stats(),
+                    contexts[0].peers.owner(resource_key(request)))
+    correct_value = (b"peer", {"nodes": 2, "down": 1}, None)
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def post_unread_body(port, head, body):
+    """
+    Sends a request whose body the proxy turns away, and returns what
+    arrives before the connection ends, and whether it ended cleanly:
+    closing with the body unread resets it instead, and a reset can
+    throw away an answer the client has not read yet.
+    """
+    conn = socket.create_connection(("127.0.0.1", port), timeout=5)
+    conn.sendall(head)
+
+    def send_body():
+        try:
+            conn.sendall(body)
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    sender = threading.Thread(target=send_body, daemon=True)
+    sender.start()
+    # the answer is only read once the proxy has had time to close
+    time.sleep(0.5)
+    response = b""
+    clean = True
+    try:
+        while True:
+            packet = conn.recv(65536)
+            if not packet:
+                break
+            response = response + packet
+    except OSError:
+        clean = False
+    sender.join(5)
+    conn.close()
+    return response, clean
+
+
+def admission_test_cases():
+    """
+    Clients over their rate get 429 and fetches over an origin's
+    concurrency cap get 503, after a short wait for their turn.
+    """
+    case = "Token bucket allows a burst, then makes callers wait their turn"
+    limiter = RateLimiter(rate=10, burst=2)
+
+    actual_value = [limiter.reserve("a", 0.15), limiter.reserve("a", 0.15),
+                    round(limiter.reserve("a", 0.15), 2), limiter.reserve("a", 0.15),
+                    limiter.reserve("b", 0.15)]
+    correct_value = [0.0, 0.0, 0.1, None, 0.0]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Concurrency cap hands a released slot to a waiting caller"
+    limit = ConcurrencyLimit(1)
+    origin = ("www.google.com", 80)
+    first = limit.acquire(origin, 0)
+    refused = limit.acquire(origin, 0.05)
+    threading.Timer(0.1, limit.release, args=(origin,)).start()
+    waited = limit.acquire(origin, 5)
+
+    async def async_slots():
+        async_limit = AsyncConcurrencyLimit(1)
+        results = [await async_limit.async_acquire(origin, 0),
+                   await async_limit.async_acquire(origin, 0.05)]
+        asyncio.get_running_loop().call_later(0.1, async_limit.release, origin)
+        results.append(await async_limit.async_acquire(origin, 5))
+        return results
+
+    actual_value = ([first, refused, waited, limit.acquire(("other", 80), 0)],
+                    asyncio.run(async_slots()))
+    correct_value = ([True, False, True, True], [True, False, True])
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Client over its rate gets 429, on every connection it opens"
+    client_addr = ("127.0.0.1", 9877)
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=2, client_rate=0.1, client_burst=2,
+                                       admission_wait=0))
+    now = time.time()
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/a",
+                              [["Host", "www.google.com"]])
+    store_response(context.cache, request, CacheEntry.from_response(
+        "HTTP/1.1 200 OK", 200, [["Cache-Control", "max-age=600"]], b"hello", now, now))
+    server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+    server.start()
+    responses = [send_raw_request(port, b"GET /a HTTP/1.1\r\nHost: www.google.com\r\n"
+                                        b"Connection: close\r\n\r\n") for i in range(3)]
+    shutdown.set()
+    server.join(10)
+    listener.close()
+
+    actual_value = [response.split(b"\r\n")[0] for response in responses]
+    correct_value = [b"HTTP/1.1 200 OK", b"HTTP/1.1 200 OK", b"HTTP/1.0 429 Too Many Requests"]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Origin-busy 503 closes a keep-alive connection, both engines"
+    results = []
+    for engine in ("threads", "asyncio"):
+        listener, port = open_listener()
+        shutdown = threading.Event()
+        context = ProxyContext(ProxyConfig(workers=2, origin_concurrency=1, admission_wait=0),
+                               engine)
+        # the only slot for the origin is taken
+        if engine == "asyncio":
+            asyncio.run(context.origin_slots.async_acquire(("127.0.0.1", 9), 0))
+            server = threading.Thread(target=asyncio.run, args=(
+                async_serve_forever(listener, context, shutdown),))
+        else:
+            context.origin_slots.acquire(("127.0.0.1", 9), 0)
+            server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+        server.start()
+        started = time.monotonic()
+        response = send_raw_request(port, b"GET http://127.0.0.1:9/ HTTP/1.1\r\n"
+                                          b"Host: 127.0.0.1:9\r\n\r\n")
+        results.append((response.split(b"\r\n")[0], time.monotonic() - started < 2))
+        shutdown.set()
+        server.join(10)
+        listener.close()
+
+    actual_value = results
+    correct_value = [(b"HTTP/1.0 503 Service Unavailable", True)] * 2
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "429 and 503 reach a client whose request body was never read, both engines"
+    body = b"x" * (1 << 19)
+    results = []
+    for engine in ("threads", "asyncio"):
+        for reason in ("client_rate", "origin_busy"):
+            listener, port = open_listener()
+            shutdown = threading.Event()
+            context = ProxyContext(ProxyConfig(workers=2, origin_concurrency=1,
+                                               client_rate=0.1 if reason == "client_rate"
+                                               else None, client_burst=1, admission_wait=0),
+                                   engine)
+            if reason == "client_rate":
+                context.client_rates.reserve("127.0.0.1", 0)
+            elif engine == "asyncio":
+                asyncio.run(context.origin_slots.async_acquire(("127.0.0.1", 9), 0))
+            else:
+                context.origin_slots.acquire(("127.0.0.1", 9), 0)
+            if engine == "asyncio":
+                server = threading.Thread(target=asyncio.run, args=(
+                    async_serve_forever(listener, context, shutdown),))
+            else:
+                server = threading.Thread(target=serve_forever,
+                                          args=(listener, context, shutdown))
+            server.start()
+            (response, clean) = post_unread_body(
+                port, b"POST http://127.0.0.1:9/ HTTP/1.1\r\nHost: 127.0.0.1:9\r\n"
+                      b"Content-Length: %d\r\n\r\n" % len(body), body)
+            results.append((response.split(b"\r\n")[0], clean))
+            shutdown.set()
+            server.join(10)
+            listener.close()
+
+    actual_value = results
+    correct_value = [(b"HTTP/1.0 429 Too Many Requests", True),
+                     (b"HTTP/1.0 503 Service Unavailable", True)] * 2
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
+def range_test_cases():
+    """
+    Range requests are answered from cached bodies with 206 or 416,
+    and a missed range can have the whole object filled behind it.
+    """
+    case = "Range header values become spans of the body"
+    values = ["bytes=0-4", "bytes=5-", "bytes=-3", "bytes=8-20", "bytes=10-", "bytes=-0",
+              "bytes=0-1,4-5", "items=0-1", "bytes=4-2", "bytes=x-"]
+
+    actual_value = [parse_range(value, 10) for value in values]
+    correct_value = [(0, 5), (5, 10), (7, 10), (8, 10), (10, 10), (10, 10),
+                     None, None, None, None]
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Cached body answers ranges with 206 and 416, both engines"
+    client_addr = ("127.0.0.1", 9877)
+    now = time.time()
+    request = HttpRequestInfo(client_addr, "GET", "www.google.com", 80, "/video",
+                              [["Host", "www.google.com"]])
+    raw = b"GET /video HTTP/1.1\r\nHost: www.google.com\r\nConnection: close\r\n"
+    headers = [b"Range: bytes=2-5", b"Range: bytes=20-",
+               b"Range: bytes=2-5\r\nIf-Range: \"v0\"", b"Range: bytes=-3\r\nIf-Range: \"v1\""]
+    results = []
+    for engine in ("threads", "asyncio"):
+        listener, port = open_listener()
+        shutdown = threading.Event()
+        context = ProxyContext(ProxyConfig(workers=2), engine)
+        store_response(context.cache, request, CacheEntry.from_response(
+            "HTTP/1.1 200 OK", 200, [["Cache-Control", "max-age=600"], ["ETag", '"v1"']],
+            b"0123456789", now, now))
+        if engine == "asyncio":
+            server = threading.Thread(target=asyncio.run, args=(
+                async_serve_forever(listener, context, shutdown),))
+        else:
+            server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+        server.start()
+        for header in headers:
+            (head, body) = send_raw_request(port, raw + header + b"\r\n\r\n").split(
+                b"\r\n\r\n", 1)
+            lines = head.split(b"\r\n")
+            results.append((lines[0], [line for line in lines
+                                       if line.startswith(b"Content-Range")], body))
+        shutdown.set()
+        server.join(10)
+        listener.close()
+
+    actual_value = results
+    correct_value = [(b"HTTP/1.1 206 Partial Content", [b"Content-Range: bytes 2-5/10"], b"2345"),
+                     (b"HTTP/1.1 416 Range Not Satisfiable", [b"Content-Range: bytes */10"],
+                      b""),
+                     (b"HTTP/1.1 200 OK", [], b"0123456789"),
+                     (b"HTTP/1.1 206 Partial Content", [b"Content-Range: bytes 7-9/10"],
+                      b"789")] * 2
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Missed range is forwarded and the whole object filled behind it"
+    origin, origin_port = open_listener()
+    asked = []
+
+    def answer_ranges(count):
+        for i in range(count):
+            (conn, address) = origin.accept()
+            head = conn.recv(65536)
+            asked.append(b"Range:" in head)
+            if b"Range:" in head:
+                conn.sendall(b"HTTP/1.1 206 Partial Content\r\nCache-Control: max-age=600\r\n"
+                             b"Content-Range: bytes 0-1/10\r\nContent-Length: 2\r\n"
+                             b"Connection: close\r\n\r\n01")
+            else:
+                conn.sendall(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\n"
+                             b"Content-Length: 10\r\nConnection: close\r\n\r\n0123456789")
+            conn.close()
+    origin_thread = threading.Thread(target=answer_ranges, args=(2,))
+    origin_thread.start()
+    listener, port = open_listener()
+    shutdown = threading.Event()
+    context = ProxyContext(ProxyConfig(workers=2, range_fills=1))
+    server = threading.Thread(target=serve_forever, args=(listener, context, shutdown))
+    server.start()
+    raw = (b"GET http://127.0.0.1:%d/video HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n"
+           b"Connection: close\r\n" % (origin_port, origin_port))
+    forwarded = send_raw_request(port, raw + b"Range: bytes=0-1\r\n\r\n")
+    origin_thread.join(10)
+    deadline = time.time() + 5
+    while context.metrics.counters[("range_fills", (("outcome", "stored"),))] == 0 and \
+            time.time() < deadline:
+        time.sleep(0.01)
+    served = send_raw_request(port, raw + b"Range: bytes=4-6\r\n\r\n")
+    shutdown.set()
+    server.join(10)
+    listener.close()
+    origin.close()
+    context.close()
+
+    actual_value = (forwarded.split(b"\r\n")[0], forwarded.split(b"\r\n\r\n", 1)[1], asked,
+                    served.split(b"\r\n")[0], served.split(b"\r\n\r\n", 1)[1])
+    correct_value = (b"HTTP/1.1 206 Partial Content", b"01", [True, False],
+                     b"HTTP/1.1 206 Partial Content", b"456")
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "Range fills queue for an origin slot and are dropped when none comes"
+    origin, origin_port = open_listener()
+    context = ProxyContext(ProxyConfig(range_fills=2, origin_concurrency=1,
+                                       admission_wait=0.05))
+    request = HttpRequestInfo(client_addr, "GET", "127.0.0.1", origin_port, "/video",
+                              [["Host", "127.0.0.1:%d" % origin_port], ["Range", "bytes=0-1"]])
+    key = ("127.0.0.1", origin_port)
+    busy = ("range_fills", (("outcome", "origin_busy"),))
+    stored = ("range_fills", (("outcome", "stored"),))
+    context.origin_slots.acquire(key, 0)
+    while_busy = context.range_filler.fill(context, request)
+    wait_until(lambda: context.metrics.counters[busy] == 1)
+    context.origin_slots.release(key)
+    when_free = context.range_filler.fill(context, request)
+    wait_until(lambda: context.origin_slots.active[key] == 1)
+    holding = dict(context.origin_slots.active)
+    # the origin only answers once the fill has been seen holding its slot
+    threading.Thread(target=answer_ranges, args=(1,)).start()
+    wait_until(lambda: context.metrics.counters[stored] == 1)
+    origin.close()
+    context.close()
+
+    actual_value = (while_busy, when_free, context.metrics.counters[busy], holding,
+                    context.metrics.counters[stored], dict(context.origin_slots.active))
+    correct_value = (True, True, 1, {key: 1}, 1, {})
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A range fill waits behind the client fetches queued before it"
+    origin, origin_port = open_listener()
+    context = ProxyContext(ProxyConfig(range_fills=1, origin_concurrency=1, admission_wait=5),
+                           "asyncio")
+    request = HttpRequestInfo(client_addr, "GET", "127.0.0.1", origin_port, "/video",
+                              [["Host", "127.0.0.1:%d" % origin_port], ["Range", "bytes=0-1"]])
+    key = ("127.0.0.1", origin_port)
+    slots = context.origin_slots
+
+    async def fill_behind_client():
+        await slots.async_acquire(key, 0)
+        client = asyncio.ensure_future(slots.async_acquire(key, 5))
+        await asyncio.sleep(0)
+        context.range_filler.fill(context, request)
+        while len(slots.waiters.get(key, ())) < 2:
+            await asyncio.sleep(0.01)
+        slots.release(key)
+        await client
+        # the client got the slot; the fill is still waiting for one
+        order = ["client", len(slots.waiters.get(key, ()))]
+        threading.Thread(target=answer_ranges, args=(1,)).start()
+        slots.release(key)
+        while context.metrics.counters[("range_fills", (("outcome", "stored"),))] == 0:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)   # for the fill's release to run on the loop
+        return order
+
+    actual_value = (asyncio.run(asyncio.wait_for(fill_behind_client(), 10)),
+                    dict(slots.active))
+    origin.close()
+    context.close()
+    correct_value = (["client", 1], {})
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+    #######################################
+    #######################################
+    case = "A range fill waiting for a slot gives up when the loop shuts down"
+    context = ProxyContext(ProxyConfig(range_fills=1, origin_concurrency=1, admission_wait=30),
+                           "asyncio")
+    slots = context.origin_slots
+
+    async def shut_down_behind_fill():
+        await slots.async_acquire(key, 0)
+        context.range_filler.fill(context, request)
+        while not slots.waiters.get(key):
+            await asyncio.sleep(0.01)
+        # asyncio.run cancels the fill's wait as it returns
+
+    asyncio.run(asyncio.wait_for(shut_down_behind_fill(), 10))
+    busy = ("range_fills", (("outcome", "origin_busy"),))
+
+    actual_value = wait_until(lambda: context.metrics.counters[busy] == 1, 5)
+    context.close()
+    correct_value = True
+    assert correct_value == actual_value,\
+        f"[Line {lineno()}] [failed] {case}"\
+        " Expected ( %s ) got ( %s )" % (correct_value, actual_value)
+    print(f"[success] {case}")
+
+
 def main():
     ###################
     # Run tests
@@ -258,6 +2537,30 @@ def main():
     # any of those functions.
     try:
         simple_http_validation_test_cases()
+        request_parsing_test_cases()
+        worker_pool_test_cases()
+        multi_process_test_cases()
+        asyncio_engine_test_cases()
+        body_framing_test_cases()
+        response_cache_test_cases()
+        http_caching_test_cases()
+        single_flight_test_cases()
+        upstream_pool_test_cases()
+        keep_alive_test_cases()
+        client_reader_test_cases()
+        request_body_test_cases()
+        tunnel_test_cases()
+        resolver_test_cases()
+        disk_cache_test_cases()
+        send_buffers_test_cases()
+        access_log_test_cases()
+        metrics_test_cases()
+        timeout_test_cases()
+        compression_test_cases()
+        request_log_test_cases()
+        peer_cache_test_cases()
+        admission_test_cases()
+        range_test_cases()
        # simple_http_parsing_test_cases()
     except AssertionError as e:
         print("Test case failed:\n", str(e))